@@ -47,12 +47,16 @@ unregister themselves (thereby allowing the server to disconnect when
 all users have unregistered), or to forceably terminate the
 connection, disconnecting all other users at the same time.
 
-The configuration file tells landialler how to contact the server. A
-sample configuration file looks like this:
+Normally landialler finds the server by broadcasting a query on the
+LAN, and remembers its address for next time (in ~/.landialler_server),
+only asking again if the server stops answering at that address. If
+the server can't be found that way the configuration file can tell
+landialler how to contact it. A sample configuration file looks like
+this:
 
   [server]
   hostname: 192.168.1.1  # your Unix box
-  port: 7293             # the default port
+  port: 6543             # the default port
 
 The configuration file should be called "landialler.conf". On POSIX
 operating systems (e.g. Unix or similar) it can either be placed in
@@ -72,14 +76,17 @@ __version__ = "0.3.0"
 
 
 import ConfigParser
+import httplib
 import os
 import socket
 import sys
+import threading
 import time
 import traceback
 import xmlrpclib
 
 import pygtk; pygtk.require("2.0")
+import gobject
 import gtk
 import gtk.glade
 
@@ -100,15 +107,51 @@ class Observable(object):
             observer.update()
 
 
+class PersistentTransport(xmlrpclib.Transport):
+
+    """Sends every request over the same HTTP/1.1 connection.
+
+    xmlrpclib.Transport already keeps its connection open between
+    requests, reconnecting if the server has closed it. This subclass
+    can also be given a socket that is already connected to the
+    server (see App._find_server()), which is used for the first
+    request rather than opening another connection.
+
+    """
+
+    def __init__(self, sock=None, use_datetime=0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self._sock = sock
+
+    def make_connection(self, host):
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        if self._sock is not None:
+            connection.sock, self._sock = self._sock, None
+        return connection
+
+
 class RemoteModem(Observable):
 
-    def __init__(self, server_proxy):
+    def __init__(self, server_proxy, status_proxy=None):
+        """Use status_proxy (if given) to wait for status changes.
+
+        A separate server proxy allows the status to be checked from
+        another thread.
+
+        """
         Observable.__init__(self)
         self._server_proxy = server_proxy
+        if status_proxy is None:
+            status_proxy = server_proxy
+        self._status_proxy = status_proxy
         self._checking_status = False
         self.num_users = 0
         self.is_connected = False
         self.seconds_online = 0
+        self.status_version = -1
+        self.dial_failed = False
+        self.hung_up_idle = False
+        self.throughput = None
 
     def _get_client_id(self):
         ip = socket.gethostbyname(socket.gethostname())
@@ -119,24 +162,155 @@ class RemoteModem(Observable):
 
     client_id = property(_get_client_id)
 
+    def _get_is_checking_status(self):
+        return self._checking_status
+
+    is_checking_status = property(_get_is_checking_status)
+
     def connect(self):
-        self._server_proxy.connect(self.client_id)
+        status = self._server_proxy.connect_and_get_status(self.client_id)
         self._checking_status = True
+        self.set_status(status)
 
     def disconnect(self, all=xmlrpclib.False):
         if bool(all):
             all = xmlrpclib.True
         self._checking_status = False
+        self._server_proxy.disconnect(self.client_id, all)
         self.is_connected = False
+        self.dial_failed = False
+        self.hung_up_idle = False
+        self.throughput = None
         self.notify_observers()
-        self._server_proxy.disconnect(self.client_id, all)
 
-    def get_status(self):
+    def fetch_status(self, last_version, timeout):
+        """Wait for the server's status to change, and return it.
+
+        Blocks for up to timeout seconds unless the status version
+        differs from last_version, so should be called from a
+        background thread.
+
+        """
+        return self._status_proxy.wait_for_status(
+            self.client_id, last_version, timeout)
+
+    def set_status(self, status):
         if self._checking_status:
-            self.num_users, self.is_connected, self.seconds_online = \
-                            self._server_proxy.get_status(self.client_id)
+            self.status_version = status["version"]
+            self.num_users = status["current_clients"]
+            self.is_connected = bool(status["is_connected"])
+            self.seconds_online = status["seconds_connected"]
+            self.dial_failed = status.get("phase") == "failed"
+            self.hung_up_idle = status.get("phase") == "idle"
         self.notify_observers()
 
+    def get_status(self, timeout=0):
+        if self._checking_status:
+            self.set_status(self.fetch_status(self.status_version, timeout))
+        else:
+            self.notify_observers()
+
+    def fetch_throughput(self):
+        """Fetch the traffic passing over the link from the server.
+
+        Uses the status proxy, so should be called from the same
+        thread as fetch_status(). Raises xmlrpclib.Fault if the server
+        doesn't measure it.
+
+        """
+        return self._status_proxy.get_throughput()
+
+    def set_throughput(self, throughput):
+        if self._checking_status:
+            self.throughput = throughput
+
+
+DISCOVERY_PORT = 6544
+DISCOVERY_QUERY = "LANDIALLER DISCOVER\n"
+DISCOVERY_REPLY = "LANDIALLER SERVER"
+
+
+def discover_server(port=DISCOVERY_PORT, timeout=2, address="<broadcast>"):
+    """Ask the LAN where the server is.
+
+    The query is broadcast every half second until a server replies,
+    or timeout seconds pass. Returns the server's hostname and port,
+    or None if no server replied.
+
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            try:
+                sock.sendto(DISCOVERY_QUERY, (address, port))
+                sock.settimeout(min(remaining, 0.5))
+                reply, (hostname, unused) = sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            except socket.error:
+                return None  # e.g. there's no network
+            words = reply.split()
+            if " ".join(words[:-1]) == DISCOVERY_REPLY and \
+                   words[-1].isdigit():
+                return hostname, int(words[-1])
+    finally:
+        sock.close()
+
+
+def connect_to(address, timeout=2):
+    """Return a socket connected to address, or None."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except socket.error:
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return sock
+
+
+class ServerCache(object):
+
+    """Remembers the address of the server found by discovery."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Return the saved hostname and port, or None."""
+        try:
+            f = open(self.path)
+            try:
+                hostname, port = f.read().split()
+            finally:
+                f.close()
+            return hostname, int(port)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, address):
+        try:
+            f = open(self.path, "w")
+            try:
+                f.write("%s %d\n" % address)
+            finally:
+                f.close()
+        except IOError:
+            pass  # we'll just have to discover the server next time
+
+
+def format_rate(bytes_per_second):
+    """Return a rate in bytes per second in a readable form."""
+    if bytes_per_second < 1024:
+        return "%d bytes/s" % bytes_per_second
+    return "%.1f KB/s" % (bytes_per_second / 1024.0)
+
 
 class WidgetWrapper(object):
 
@@ -182,7 +356,9 @@ class Dialog(Window):
 class MainWindow(Window):
 
     CHECK_STATUS_PERIOD = 1000 * 2
+    STATUS_TIMEOUT = 10  # seconds
     STATUS_LABEL = '<span size="larger" weight="bold">You are %s</span>'
+    THROUGHPUT_PERIOD = 1000 * 30
     TITLE = "LANdialler"
     UPDATE_TIMER_PERIOD = 100
 
@@ -193,7 +369,8 @@ class MainWindow(Window):
         self._set_status_disconnected()
         self._seconds_online = 0
         self._last_check_time = None
-        self._status_timeout = None
+        self._status_thread = None
+        self._is_throughput_available = True
         gtk.timeout_add(self.UPDATE_TIMER_PERIOD, self._update_timer)
         self.connect()
 
@@ -212,9 +389,16 @@ class MainWindow(Window):
         self._set_status_label("connected")
         time_str = time.strftime("%H:%M:%S", time.gmtime(seconds_online))
         user_str = { True: "user", False: "users" }[self._modem.num_users == 1]
-        self.details_label.set_label(
-            "%s %s, on-line for %s" %
-            (self._modem.num_users, user_str, time_str))
+        details = "%s %s, on-line for %s" % (self._modem.num_users,
+                                             user_str, time_str)
+        throughput = self._modem.throughput
+        if throughput is not None:
+            details += "\n%s in, %s out" % (
+                format_rate(throughput["rx_bytes_per_second"]),
+                format_rate(throughput["tx_bytes_per_second"]))
+            if throughput["is_saturated"]:
+                details += " (the connection is full)"
+        self.details_label.set_label(details)
         self.root_widget.set_title("%s (connected)" % MainWindow.TITLE)
         self.connect_button.set_sensitive(gtk.FALSE)
         self.disconnect_button.set_sensitive(gtk.TRUE)
@@ -226,9 +410,32 @@ class MainWindow(Window):
             self._set_status_connected(secs_online)
         return True
 
+    def _fetch_throughput(self):
+        """Ask the server how busy the link is (runs in a thread).
+
+        We stop asking if the server is too old to tell us. Any other
+        error is left for the next status check to report.
+
+        """
+        try:
+            throughput = self._modem.fetch_throughput()
+        except xmlrpclib.Fault:
+            self._is_throughput_available = False
+        except (socket.error, xmlrpclib.ProtocolError,
+                httplib.HTTPException):
+            pass
+        else:
+            gobject.idle_add(self._modem.set_throughput, throughput)
+
     def _set_status_disconnected(self):
         self._set_status_label("disconnected")
-        self.details_label.set_label("")
+        if self._modem.dial_failed:
+            self.details_label.set_label("Unable to dial up")
+        elif self._modem.hung_up_idle:
+            self.details_label.set_label(
+                "Hung up because nobody was using the connection")
+        else:
+            self.details_label.set_label("")
         self.root_widget.set_title(MainWindow.TITLE)
         self.connect_button.set_sensitive(gtk.TRUE)
         self.disconnect_button.set_sensitive(gtk.FALSE)
@@ -243,17 +450,59 @@ class MainWindow(Window):
         gtk.main_quit()
 
     def _check_status(self):
-        self._modem.get_status()
-        return gtk.TRUE
+        """Wait for the server's status to change (runs in a thread).
+
+        Each status is handed to the modem from the main loop. If the
+        server answers straight away without the status having changed
+        (as it does when too many clients are waiting) we wait for
+        CHECK_STATUS_PERIOD before asking again, or for as long as the
+        server asks us to if we've been asking too often.
+
+        While we're connected the throughput is fetched between
+        waits, once every THROUGHPUT_PERIOD at most. We don't cut the
+        waits short for it, so it may be shown up to STATUS_TIMEOUT
+        seconds late.
+
+        """
+        version = -1
+        throughput_due = 0
+        while self._modem.is_checking_status:
+            if (self._modem.is_connected and self._is_throughput_available
+                    and time.time() >= throughput_due):
+                throughput_due = time.time() + self.THROUGHPUT_PERIOD / 1000
+                self._fetch_throughput()
+            timeout = self.STATUS_TIMEOUT
+            started = time.time()
+            try:
+                status = self._modem.fetch_status(version, timeout)
+            except:
+                gobject.idle_add(self._report_error, sys.exc_info())
+                break
+            gobject.idle_add(self._modem.set_status, status)
+            if status.get("retry_after"):
+                time.sleep(status["retry_after"])
+            elif status["version"] == version:
+                if (time.time() - started) < (timeout / 2.0):
+                    time.sleep(self.CHECK_STATUS_PERIOD / 1000.0)
+            version = status["version"]
+
+    def _report_error(self, exc_info):
+        sys.excepthook(*exc_info)
+        return gtk.FALSE
+
+    def _start_checking_status(self):
+        thread = self._status_thread
+        if thread is None or not thread.isAlive():
+            self._status_thread = threading.Thread(target=self._check_status)
+            self._status_thread.setDaemon(True)
+            self._status_thread.start()
 
     def connect(self):
-        if self._status_timeout:
-            gtk.timeout_remove(self._status_timeout)
-        self._status_timeout = gtk.timeout_add(
-            self.CHECK_STATUS_PERIOD, self._check_status)
         self._modem.connect()
-        dialog = ConnectingDialog(self._modem)
-        dialog.show()
+        self._start_checking_status()
+        if not self._modem.is_connected:
+            dialog = ConnectingDialog(self._modem)
+            dialog.show()
 
     def on_connect_button_clicked(self, *args):
         self.connect()
@@ -286,7 +535,7 @@ class ConnectingDialog(Window):
         Window.destroy(self)
 
     def update(self):
-        if self._modem.is_connected:
+        if self._modem.is_connected or self._modem.dial_failed:
             self.destroy()
 
     def on_cancel_button_clicked(self, *args):
@@ -358,13 +607,29 @@ class ExceptionDialog(Window):
         self.on_close_button_clicked()
 
 
+class ServerNotFound(socket.error):
+
+    """Raised when none of the ways of finding the server worked.
+
+    The message says what went wrong with each of them.
+
+    """
+
+
 class ExceptionHandler(object):
 
     def __init__(self):
         sys.excepthook = self.handler
 
     def handler(self, exc_type, exc_value, exc_tb):
-        if isinstance(exc_value, socket.error):
+        if isinstance(exc_value, ServerNotFound):
+            dialog = ErrorDialog(
+                "Can't find server",
+                "The LANdialler server could not be found.\n\n%s" %
+                exc_value)
+            dialog.run()
+            gtk.main_quit()
+        elif isinstance(exc_value, socket.error):
             dialog = ErrorDialog(
                 "Can't contact server",
                 "The LANdialler server is not available. Please check "
@@ -384,26 +649,88 @@ class ExceptionHandler(object):
 
 class App(object):
 
+    CACHE_PATH = os.path.expanduser("~/.landialler_server")
+
     def __init__(self):
         self._config = ConfigParser.ConfigParser()
         self._config.read("landialler.conf")
+        self._cache = ServerCache(self.CACHE_PATH)
 
-    def _connect_to_server(self):
-        hostname = self._config.get("server", "hostname")
-        port = self._config.get("server", "port")
-        return xmlrpclib.ServerProxy("http://%s:%s/" % (hostname, port))
+    def _get_option(self, option, default=None):
+        try:
+            return self._config.get("server", option)
+        except ConfigParser.Error:
+            return default
+
+    def _find_server(self):
+        """Return the server's address and a socket connected to it.
+
+        The address in the config file is tried first, then the one
+        found by the last discovery. Only if neither answers do we ask
+        the LAN where the server is. Raises ServerNotFound if all
+        three fail.
+
+        """
+        problems = []
+        configured = None
+        if self._get_option("hostname") is None:
+            problems.append("No hostname is set in the configuration file.")
+        else:
+            configured = (self._get_option("hostname"),
+                          int(self._get_option("port", 6543)))
+            sock = connect_to(configured)
+            if sock is not None:
+                return configured, sock
+            problems.append("Nothing answered at %s:%d (the address in "
+                            "the configuration file)." % configured)
+        cached = self._cache.load()
+        if cached is None:
+            problems.append("No address was remembered from an earlier "
+                            "search.")
+        elif cached != configured:
+            sock = connect_to(cached)
+            if sock is not None:
+                return cached, sock
+            problems.append("Nothing answered at %s:%d (where the server "
+                            "was found last time)." % cached)
+        port = int(self._get_option("discovery_port", DISCOVERY_PORT))
+        address = discover_server(port)
+        if address is None:
+            problems.append("No server answered a search of the LAN (on "
+                            "UDP port %d). Discovery may be turned off on "
+                            "the server." % port)
+        else:
+            sock = connect_to(address)
+            if sock is not None:
+                self._cache.save(address)
+                return address, sock
+            problems.append("The server found on the LAN at %s:%d didn't "
+                            "answer." % address)
+        raise ServerNotFound("\n".join(problems))
+
+    def _connect_to_server(self, address, sock=None):
+        return xmlrpclib.ServerProxy("http://%s:%s/" % address,
+                                     PersistentTransport(sock))
         
     def main(self):
+        modem = None
         try:
+            gobject.threads_init()
             ExceptionHandler()
-            server = self._connect_to_server()
-            modem = RemoteModem(server)
+            address, sock = self._find_server()
+            modem = RemoteModem(self._connect_to_server(address, sock),
+                                self._connect_to_server(address))
             window = MainWindow(modem)
             window.show()
             gtk.main()
         except KeyboardInterrupt:
-            modem.disconnect()
-            gtk.main_quit()
+            if modem is not None:
+                try:
+                    modem.disconnect()
+                except socket.error:
+                    pass
+            if gtk.main_level() > 0:
+                gtk.main_quit()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,14 @@
 # $Id$
 
 
+import ConfigParser
 import os
+import shutil
+import SimpleXMLRPCServer
 import socket
+import tempfile
+import threading
+import time
 import unittest
 import xmlrpclib
 
@@ -30,8 +36,216 @@ class ObservableTest(unittest.TestCase):
         self.assertEqual(len(observer.getNamedCalls('update')), 0)
 
 
+class KeepAliveRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    timeout = 0.1
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingServer(SimpleXMLRPCServer.SimpleXMLRPCServer):
+
+    allow_reuse_address = True
+
+    def __init__(self, handler):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(
+            self, ("127.0.0.1", 0), handler, logRequests=False)
+        self.connections = 0
+        self.register_function(lambda x: x * 2, "double")
+
+    def get_request(self):
+        self.connections += 1
+        return SimpleXMLRPCServer.SimpleXMLRPCServer.get_request(self)
+
+
+class FormatRateTest(unittest.TestCase):
+
+    def test_format_rate(self):
+        """Check rates are shown in bytes or kilobytes per second"""
+        self.assertEqual(landialler.format_rate(512), "512 bytes/s")
+        self.assertEqual(landialler.format_rate(3277), "3.2 KB/s")
+
+
+class PersistentTransportTest(unittest.TestCase):
+
+    def start_server(self, handler, connect_first=False):
+        self.server = CountingServer(handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        host, port = self.server.socket.getsockname()
+        sock = None
+        if connect_first:
+            sock = landialler.connect_to((host, port))
+        self.transport = landialler.PersistentTransport(sock)
+        return xmlrpclib.ServerProxy("http://%s:%d/" % (host, port),
+                                     self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_connection_reused(self):
+        """Check requests share a connection"""
+        proxy = self.start_server(KeepAliveRequestHandler)
+        for i in range(3):
+            self.assertEqual(proxy.double(i), i * 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnect_after_timeout(self):
+        """Check the transport reconnects when the server hangs up"""
+        proxy = self.start_server(KeepAliveRequestHandler)
+        self.assertEqual(proxy.double(1), 2)
+        time.sleep(0.3)
+        self.assertEqual(proxy.double(2), 4)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_connected_socket_used(self):
+        """Check the first request uses a socket that's already open"""
+        proxy = self.start_server(KeepAliveRequestHandler,
+                                  connect_first=True)
+        self.assertEqual(proxy.double(1), 2)
+        self.assertEqual(proxy.double(2), 4)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_http_1_0_server(self):
+        """Check the transport works with servers that close connections"""
+        handler = SimpleXMLRPCServer.SimpleXMLRPCRequestHandler
+        proxy = self.start_server(handler)
+        self.assertEqual(proxy.double(1), 2)
+        self.assertEqual(proxy.double(2), 4)
+        self.assertEqual(self.server.connections, 2)
+
+
+class DiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+
+    def tearDown(self):
+        self.sock.close()
+
+    def answer(self, reply):
+        query, address = self.sock.recvfrom(512)
+        self.assertEqual(query, landialler.DISCOVERY_QUERY)
+        self.sock.sendto(reply, address)
+
+    def test_discover_server(self):
+        """Check the server's address is taken from its reply"""
+        thread = threading.Thread(target=self.answer,
+                                  args=("LANDIALLER SERVER 6543\n",))
+        thread.start()
+        address = landialler.discover_server(self.port, 1, "127.0.0.1")
+        thread.join()
+        self.assertEqual(address, ("127.0.0.1", 6543))
+
+    def test_no_server(self):
+        """Check discovery gives up when nobody replies"""
+        address = landialler.discover_server(self.port, 0.1, "127.0.0.1")
+        self.assertEqual(address, None)
+
+
+class ServerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "server")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save(self):
+        """Check a saved address is loaded next time"""
+        self.assertEqual(landialler.ServerCache(self.path).load(), None)
+        landialler.ServerCache(self.path).save(("192.168.1.1", 6543))
+        self.assertEqual(landialler.ServerCache(self.path).load(),
+                         ("192.168.1.1", 6543))
+
+    def test_corrupt_cache_ignored(self):
+        """Check a damaged cache file is treated as empty"""
+        f = open(self.path, "w")
+        f.write("garbage")
+        f.close()
+        self.assertEqual(landialler.ServerCache(self.path).load(), None)
+
+
+class FindServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = landialler.App()
+        self.app._config = ConfigParser.ConfigParser()
+        self.app._config.add_section("server")
+        self.app._cache = landialler.ServerCache(
+            os.path.join(self.directory, "server"))
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.address = self.listener.getsockname()
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(("127.0.0.1", 0))
+        self.closed_address = closed.getsockname()
+        closed.close()
+        self.discovered = None
+        self._discover_server = landialler.discover_server
+        landialler.discover_server = lambda port: self.discovered
+
+    def tearDown(self):
+        landialler.discover_server = self._discover_server
+        self.listener.close()
+        shutil.rmtree(self.directory)
+
+    def configure(self, address):
+        self.app._config.set("server", "hostname", address[0])
+        self.app._config.set("server", "port", str(address[1]))
+
+    def test_configured_first(self):
+        """Check the configured address is preferred to the cached one"""
+        self.configure(self.address)
+        self.app._cache.save(self.closed_address)
+        address, sock = self.app._find_server()
+        sock.close()
+        self.assertEqual(address, self.address)
+
+    def test_discovered(self):
+        """Check the server is looked for on the LAN as a last resort"""
+        self.configure(self.closed_address)
+        self.discovered = self.address
+        address, sock = self.app._find_server()
+        sock.close()
+        self.assertEqual(address, self.address)
+        self.assertEqual(self.app._cache.load(), self.address)
+
+    def test_not_found(self):
+        """Check the error says how each way of finding the server failed"""
+        self.configure(self.closed_address)
+        try:
+            self.app._find_server()
+        except landialler.ServerNotFound, e:
+            lines = str(e).split("\n")
+        else:
+            self.fail("ServerNotFound not raised")
+        self.assertEqual(len(lines), 3)
+        self.assert_("%s:%d" % self.closed_address in lines[0])
+        self.assert_("remembered" in lines[1])
+        self.assert_("search of the LAN" in lines[2])
+
+
 class RemoteModemTest(unittest.TestCase):
 
+    STATUS = {"version": 3, "current_clients": 2, "is_connected": True,
+              "seconds_connected": 23, "phase": "online"}
+
+    def mock_server(self):
+        return mock.Mock({'connect_and_get_status': self.STATUS,
+                          'wait_for_status': self.STATUS})
+
     def test_client_id(self):
         """Check remote modem can use an IP address as a client ID"""
         modem = landialler.RemoteModem(mock.Mock())
@@ -58,11 +272,13 @@ class RemoteModemTest(unittest.TestCase):
 
     def test_connect(self):
         """Check remote calls to connect() method"""
-        server = mock.Mock()
+        server = self.mock_server()
         modem = landialler.RemoteModem(server)
         modem.connect()
-        self.assertEqual(server.getNamedCalls('connect')[0].getParam(0),
-                         modem.client_id)
+        call = server.getNamedCalls('connect_and_get_status')[0]
+        self.assertEqual(call.getParam(0), modem.client_id)
+        self.assertEqual(modem.num_users, 2)
+        self.assertEqual(modem.status_version, 3)
         
     def test_disconnect(self):
         """Check remote calls to disconnect() method"""
@@ -84,44 +300,127 @@ class RemoteModemTest(unittest.TestCase):
 
     def test_get_status(self):
         """Check remote calls to get_status() method are observable"""
-        server = mock.Mock({'get_status': (2, True, 23)})
+        server = self.mock_server()
         modem = landialler.RemoteModem(server)
+        modem.connect()
         observer = mock.Mock()
         modem.add_observer(observer)
-        modem.connect()
         modem.get_status()
         self.assertEqual(len(observer.getNamedCalls('update')), 1)
 
     def test_read_status_from_modem(self):
         """Check modem status accessible to observers"""
-        server = mock.Mock({'get_status': (2, True, 23)})
+        server = self.mock_server()
         modem = landialler.RemoteModem(server)
         modem.connect()
         modem.get_status()
         self.assertEqual(modem.num_users, 2)
         self.assertEqual(modem.is_connected, True)
         self.assertEqual(modem.seconds_online, 23)
+        self.assertEqual(modem.status_version, 3)
+
+    def test_wait_for_status(self):
+        """Check the modem waits for the status to change"""
+        server = self.mock_server()
+        modem = landialler.RemoteModem(server)
+        modem.connect()
+        modem.get_status(10)
+        call = server.getNamedCalls('wait_for_status')[0]
+        self.assertEqual(call.getParam(0), modem.client_id)
+        self.assertEqual(call.getParam(1), 3)
+        self.assertEqual(call.getParam(2), 10)
+
+    def test_status_proxy(self):
+        """Check the status can be fetched through a separate proxy"""
+        server = self.mock_server()
+        status_server = self.mock_server()
+        modem = landialler.RemoteModem(server, status_server)
+        modem.connect()
+        self.assertEqual(modem.fetch_status(-1, 10), self.STATUS)
+        self.assertEqual(len(server.getNamedCalls('wait_for_status')), 0)
+        calls = status_server.getNamedCalls('wait_for_status')
+        self.assertEqual(len(calls), 1)
+
+    def test_dial_failed(self):
+        """Check the modem notices when the server can't dial up"""
+        status = {"version": 4, "current_clients": 1, "is_connected": False,
+                  "seconds_connected": 0, "phase": "failed"}
+        server = mock.Mock({'connect_and_get_status': status})
+        modem = landialler.RemoteModem(server)
+        modem.connect()
+        self.assertEqual(modem.dial_failed, True)
+        modem.disconnect()
+        self.assertEqual(modem.dial_failed, False)
+
+    def test_hung_up_idle(self):
+        """Check the modem notices when the server hangs up an idle link"""
+        status = {"version": 5, "current_clients": 1, "is_connected": False,
+                  "seconds_connected": 0, "phase": "idle"}
+        server = mock.Mock({'connect_and_get_status': self.STATUS,
+                            'wait_for_status': status})
+        modem = landialler.RemoteModem(server)
+        modem.connect()
+        self.assertEqual(modem.hung_up_idle, False)
+        modem.get_status()
+        self.assertEqual(modem.hung_up_idle, True)
+        modem.disconnect()
+        self.assertEqual(modem.hung_up_idle, False)
+
+    def test_throughput(self):
+        """Check the modem fetches the throughput through the status proxy"""
+        throughput = {"rx_bytes_per_second": 2048, "tx_bytes_per_second": 0,
+                      "is_saturated": False}
+        server = self.mock_server()
+        status_server = mock.Mock({'get_throughput': throughput})
+        modem = landialler.RemoteModem(server, status_server)
+        self.assertEqual(modem.fetch_throughput(), throughput)
+        self.assertEqual(len(server.getNamedCalls('get_throughput')), 0)
+        modem.set_throughput(throughput)
+        self.assertEqual(modem.throughput, None)
+        modem.connect()
+        modem.set_throughput(throughput)
+        self.assertEqual(modem.throughput, throughput)
+        modem.disconnect()
+        self.assertEqual(modem.throughput, None)
+
+    def test_late_status_ignored(self):
+        """Check status received after disconnecting is ignored"""
+        server = self.mock_server()
+        modem = landialler.RemoteModem(server)
+        modem.connect()
+        modem.disconnect()
+        modem.set_status(self.STATUS)
+        self.assertEqual(modem.is_connected, False)
+
+    def test_disconnect_order(self):
+        """Check modem still connected if server can't be told to hang up"""
+        server = mock.Mock({'connect_and_get_status': self.STATUS})
+        modem = landialler.RemoteModem(server)
+        modem.connect()
+        server.disconnect = None  # calling it raises TypeError
+        self.assertRaises(TypeError, modem.disconnect)
+        self.assertEqual(modem.is_connected, True)
 
     def test_read_status_when_interested(self):
         """Check get_status() only called when client is interested"""
-        server = mock.Mock({'get_status': (1, True, 23)})
+        server = self.mock_server()
         modem = landialler.RemoteModem(server)
-        self.assertEqual(len(server.getNamedCalls('get_status')), 0)
+        self.assertEqual(len(server.getNamedCalls('wait_for_status')), 0)
         modem.get_status()
-        self.assertEqual(len(server.getNamedCalls('get_status')), 0)
+        self.assertEqual(len(server.getNamedCalls('wait_for_status')), 0)
         modem.connect()
         modem.get_status()
-        self.assertEqual(len(server.getNamedCalls('get_status')), 1)
+        self.assertEqual(len(server.getNamedCalls('wait_for_status')), 1)
         modem.disconnect()
         modem.get_status()
-        self.assertEqual(len(server.getNamedCalls('get_status')), 1)
+        self.assertEqual(len(server.getNamedCalls('wait_for_status')), 1)
         modem.disconnect(all=True)
         modem.get_status()
-        self.assertEqual(len(server.getNamedCalls('get_status')), 1)
+        self.assertEqual(len(server.getNamedCalls('wait_for_status')), 1)
 
     def test_hang_up_sets_disconnected(self):
         """Check that modem doesn't appear to be connected after hang up"""
-        server = mock.Mock({'get_status': (1, True, 23)})
+        server = self.mock_server()
         modem = landialler.RemoteModem(server)
         modem.connect()
         modem.get_status()
@@ -75,253 +75,4515 @@ The author can be contacted at ashtong@users.sourceforge.net.
 """
 
 
+import array
+import asynchat
+import asyncore
+import bisect
 import ConfigParser
+import errno
 import getopt
+import heapq
+import marshal
 import os
+import pstats
+import Queue
+import select
+import signal
 import SimpleXMLRPCServer
 import SocketServer
+import socket
+import StringIO
+import struct
 import sys
 import syslog
+import tempfile
 import threading
 import time
+import traceback
 import xmlrpclib
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not available on non-POSIX systems
+
+try:
+    import cProfile as profile
+except ImportError:
+    try:
+        import profile  # Python 2.4 and earlier
+    except ImportError:
+        profile = None  # some distributions package it separately
+
 
 class Logger:
 
-    def __init__(self):
-        ident = os.path.splitext(os.path.basename(sys.argv[0]))[0]
-        syslog.openlog(ident, syslog.LOG_PID | syslog.LOG_CONS,
-                       syslog.LOG_DAEMON)
+    """Writes log messages to any number of sinks from its own thread.
+
+    Messages are queued, so logging never blocks the caller. Once the
+    queue holds max_queued messages further messages are dropped (and
+    counted) until the writer thread catches up. The writer takes up
+    to BATCH_SIZE messages off the queue at a time, handing each sink
+    those messages that are at or above the sink's level.
+
+    Messages are queued until start() is called, so that a daemon can
+    fork before the writer thread is started.
+
+    """
+
+    DEBUG, INFO, WARNING, ERROR = range(4)
+    LEVEL_NAMES = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+    MAX_QUEUED = 1000
+    BATCH_SIZE = 50
+    CLOSE_TIMEOUT = 5  # seconds
+
+    def __init__(self, max_queued=MAX_QUEUED):
+        self._queue = Queue.Queue(max_queued)
+        self._sinks = []  # (sink, level)
+        self._write_lock = threading.Lock()
+        self._drop_lock = threading.Lock()
+        self._writer = None
+        self.dropped = 0
+
+    def add_sink(self, sink, level=INFO):
+        self._sinks.append((sink, level))
+
+    def _log(self, level, msg):
+        try:
+            self._queue.put_nowait((level, time.time(), msg))
+        except Queue.Full:
+            self._drop_lock.acquire()
+            try:
+                self.dropped += 1
+            finally:
+                self._drop_lock.release()
+
+    def debug(self, msg):
+        self._log(self.DEBUG, msg)
+
+    def info(self, msg):
+        self._log(self.INFO, msg)
+
+    def warn(self, msg):
+        self._log(self.WARNING, msg)
+
+    def error(self, msg):
+        self._log(self.ERROR, msg)
+
+    def _count_dropped(self):
+        self._drop_lock.acquire()
+        try:
+            dropped = self.dropped
+            self.dropped = 0
+            return dropped
+        finally:
+            self._drop_lock.release()
+
+    def _write(self, records):
+        dropped = self._count_dropped()
+        if dropped:
+            records.append((self.WARNING, time.time(),
+                            'Dropped %d log messages' % dropped))
+        self._write_lock.acquire()
+        try:
+            for sink, level in self._sinks:
+                wanted = [record for record in records if record[0] >= level]
+                if wanted:
+                    try:
+                        sink.write(wanted)
+                    except:
+                        pass  # there's nowhere left to report it
+        finally:
+            self._write_lock.release()
+
+    def _get_batch(self):
+        records = []
+        while len(records) < self.BATCH_SIZE:
+            try:
+                records.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return records
+
+    def flush(self):
+        """Write all queued messages from the calling thread."""
+        records = self._get_batch()
+        while records:
+            self._write(records)
+            records = self._get_batch()
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            records.extend(self._get_batch())
+            is_closing = None in records
+            if is_closing:
+                records = [record for record in records if record is not None]
+            self._write(records)
+            if is_closing:
+                return
+
+    def start(self):
+        self._writer = threading.Thread(target=self._run, name='Logger')
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def close(self):
+        """Write any queued messages, then stop the writer thread."""
+        if self._writer is not None and self._writer.isAlive():
+            self._queue.put(None)
+            self._writer.join(self.CLOSE_TIMEOUT)
+        self._writer = None
+        self.flush()
+
+
+def format_log_record(record):
+    level, when, msg = record
+    return '%s %s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S',
+                                         time.localtime(when)),
+                           Logger.LEVEL_NAMES[level], msg)
+
+
+class SyslogSink(object):
+
+    PRIORITIES = {Logger.DEBUG: syslog.LOG_DEBUG,
+                  Logger.INFO: syslog.LOG_INFO,
+                  Logger.WARNING: syslog.LOG_WARNING,
+                  Logger.ERROR: syslog.LOG_ERR}
+
+    def __init__(self):
+        ident = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        syslog.openlog(ident, syslog.LOG_PID | syslog.LOG_CONS,
+                       syslog.LOG_DAEMON)
+
+    def write(self, records):
+        for level, when, msg in records:
+            syslog.syslog(self.PRIORITIES[level], msg)
+
+
+class StreamSink(object):
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, records):
+        self._stream.write(''.join(map(format_log_record, records)))
+        self._stream.flush()
+
+
+class FileSink(object):
+
+    """Appends log messages to a file, rotating it when it gets big.
+
+    When the file grows beyond max_bytes it is renamed to path.1 (and
+    any existing path.1 to path.2, and so on), keeping at most backups
+    old files.
+
+    """
+
+    MAX_BYTES = 1024 * 1024
+    BACKUPS = 3
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._file = open(path, 'a')
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self._backups - 1, 0, -1):
+            older = '%s.%d' % (self.path, i)
+            if os.path.exists(older):
+                os.rename(older, '%s.%d' % (self.path, i + 1))
+        if self._backups > 0:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a')
+
+    def write(self, records):
+        self._file.write(''.join(map(format_log_record, records)))
+        self._file.flush()
+        if self._file.tell() >= self._max_bytes:
+            self._rotate()
+
+
+class Histogram(object):
+
+    """Counts observed values in cumulative buckets (as Prometheus does)."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i in range(len(self.buckets)):
+            if value <= self.buckets[i]:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+
+    """Collects the server's metrics, to be read by Prometheus.
+
+    Counters and histograms are created when they're first updated.
+    Gauges are read by calling a function whenever the metrics are
+    rendered. Labels are passed as a tuple of (name, value) pairs.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptions = {}  # name -> (type, help)
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._gauges = {}  # name -> function
+
+    def describe(self, name, type, help):
+        self._descriptions[name] = (type, help)
+
+    def increment(self, name, labels=(), amount=1):
+        self._lock.acquire()
+        try:
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, labels=()):
+        self._lock.acquire()
+        try:
+            key = (name, labels)
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+        finally:
+            self._lock.release()
+
+    def set_gauge(self, name, help, function):
+        self.describe(name, 'gauge', help)
+        self._gauges[name] = function
+
+    def get_counter(self, name, labels=()):
+        return self._counters.get((name, labels), 0)
+
+    def get_histogram(self, name, labels=()):
+        return self._histograms.get((name, labels))
+
+    def _format_labels(self, labels):
+        if not labels:
+            return ''
+        pairs = ['%s="%s"' % (label, value) for label, value in labels]
+        return '{%s}' % ','.join(pairs)
+
+    def _format_number(self, value):
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
+
+    def render(self):
+        """Return the metrics in Prometheus' text exposition format."""
+        samples = {}  # name -> [(suffix, labels, value)]
+        for name, function in self._gauges.items():
+            samples[name] = [('', (), function())]
+        self._lock.acquire()
+        try:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(('', labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for i in range(len(histogram.buckets)):
+                    bucket = labels + (('le', histogram.buckets[i]),)
+                    lines.append(('_bucket', bucket, histogram.counts[i]))
+                lines.append(('_bucket', labels + (('le', '+Inf'),),
+                              histogram.count))
+                lines.append(('_sum', labels, histogram.sum))
+                lines.append(('_count', labels, histogram.count))
+        finally:
+            self._lock.release()
+        names = samples.keys()
+        names.sort()
+        output = []
+        for name in names:
+            if name in self._descriptions:
+                type, help = self._descriptions[name]
+                output.append('# HELP %s %s\n' % (name, help))
+                output.append('# TYPE %s %s\n' % (name, type))
+            for suffix, labels, value in samples[name]:
+                output.append('%s%s%s %s\n' % (
+                    name, suffix, self._format_labels(labels),
+                    self._format_number(value)))
+        return ''.join(output)
+
+
+def replace_file(path, data, mode=0600):
+    """Atomically replace the file at path with one containing data.
+
+    The data is written to a new file created with mkstemp() in the
+    same directory, so nobody can plant a symlink where the server
+    will write, and then renamed over path.
+
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                     dir=os.path.dirname(path) or '.')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            os.chmod(temp_path, mode)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp_path, path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class Profiler(object):
+
+    """Profiles the server while it's running.
+
+    Profiling is switched on and off by calling toggle(). While it's
+    on every call made through call() is timed, recording the wall
+    clock and CPU time taken, and is run under cProfile (or profile,
+    if that's all there is). Note that the CPU time is for the whole
+    process, so includes time spent by other threads.
+
+    When profiling is switched off the profiler's statistics are
+    written to path (for loading with the pstats module) and a table
+    of the timings is written to path.txt.
+
+    """
+
+    PATH = '/var/run/landiallerd.prof'
+
+    def __init__(self, path=PATH):
+        self.path = path
+        self.is_enabled = False
+        self._lock = threading.Lock()
+        self._timings = {}  # name -> [calls, wall time, CPU time]
+        self._stats = None
+
+    def start(self):
+        self._lock.acquire()
+        try:
+            self._timings = {}
+            self._stats = None
+            self.is_enabled = True
+        finally:
+            self._lock.release()
+        log.info('Profiling started')
+
+    def stop(self):
+        self._lock.acquire()
+        try:
+            self.is_enabled = False
+            self._dump()
+        finally:
+            self._lock.release()
+        log.info('Profiling stopped, results written to %s' % self.path)
+
+    def toggle(self):
+        try:
+            if self.is_enabled:
+                self.stop()
+            else:
+                self.start()
+        except:
+            log.error('Unable to profile: %s' % format_exception())
+
+    def call(self, name, function, *args):
+        """Call function(*args), profiling it if profiling is on."""
+        if not self.is_enabled:
+            return function(*args)
+        profiler = None
+        if profile is not None:
+            profiler = profile.Profile()
+        started = time.time()
+        cpu_started = time.clock()
+        try:
+            if profiler is None:
+                return function(*args)
+            else:
+                return profiler.runcall(function, *args)
+        finally:
+            self._record(name, time.time() - started,
+                         time.clock() - cpu_started, profiler)
+
+    def _record(self, name, wall_time, cpu_time, profiler):
+        self._lock.acquire()
+        try:
+            if not self.is_enabled:
+                return
+            timing = self._timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += wall_time
+            timing[2] += cpu_time
+            if profiler is not None:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profiler)
+                else:
+                    self._stats.add(profiler)
+        finally:
+            self._lock.release()
+
+    def _dump(self):
+        if self._stats is not None:
+            replace_file(self.path, marshal.dumps(self._stats.stats))
+        names = self._timings.keys()
+        names.sort()
+        lines = ['%-30s %8s %12s %12s %12s\n' %
+                 ('name', 'calls', 'wall (s)', 'mean (ms)', 'cpu (s)')]
+        for name in names:
+            calls, wall_time, cpu_time = self._timings[name]
+            lines.append('%-30s %8d %12.3f %12.3f %12.3f\n' %
+                         (name, calls, wall_time,
+                          wall_time * 1000 / calls, cpu_time))
+        replace_file(self.path + '.txt', ''.join(lines))
+
+
+log = Logger()
+metrics = Metrics()
+profiler = Profiler()
+metrics.describe('landialler_requests_total', 'counter',
+                 'XML-RPC calls handled, by method.')
+metrics.describe('landialler_request_duration_seconds', 'histogram',
+                 'Time taken to answer XML-RPC calls, by method.')
+metrics.describe('landialler_probe_duration_seconds', 'histogram',
+                 'Time taken to probe the link.')
+metrics.describe('landialler_dial_duration_seconds', 'histogram',
+                 'Time from dialling to the link coming up.')
+metrics.describe('landialler_dial_failures_total', 'counter',
+                 'Connect commands that failed.')
+metrics.describe('landialler_sweep_duration_seconds', 'histogram',
+                 'Time taken to look for clients that have gone away.')
+metrics.describe('landialler_expired_clients_total', 'counter',
+                 'Clients forgotten because they stopped checking in.')
+metrics.describe('landialler_idle_disconnects_total', 'counter',
+                 'Times the link was dropped for being idle.')
+metrics.describe('landialler_rate_limited_total', 'counter',
+                 'Status requests sent an old status, for asking too often.')
+
+
+def format_exception():
+    """Return the exception currently being handled as a string."""
+    return ''.join(traceback.format_exception(*sys.exc_info()))
+
+
+class Timer(object):
+
+    """Simple timer class to record elapsed times."""
+
+    def __init__(self):
+        """Run the start() method."""
+        self._start_time = None  # seconds since epoch
+        self._stop_time = None
+        self.reset()
+        self.is_running = False
+
+    def start(self, start_time=None):
+        """Start the timer (at start_time, if given)."""
+        if start_time is None:
+            start_time = time.time()
+        self._start_time = start_time
+        self.is_running = True
+
+    def stop(self):
+        """Stop the timer."""
+        self._stop_time = time.time()
+        self.is_running = False
+
+    def reset(self):
+        """Reset the timer to zero.
+
+        Note that reset() neither stops or starts the timer.
+
+        """
+        self._start_time = time.time()
+        self._stop_time = time.time()
+
+    def _get_elapsed_seconds(self):
+        """Return seconds since timer started."""
+        if self.is_running:
+            return int('%.0f' % (time.time() - self._start_time))
+        else:
+            return int('%.0f' % (self._stop_time - self._start_time))
+
+    elapsed_seconds = property(_get_elapsed_seconds)
+
+    def _get_start_time(self):
+        """Return the time the running timer started, or None."""
+        if self.is_running:
+            return self._start_time
+        return None
+
+    start_time = property(_get_start_time)
+
+
+class ShellProbe(object):
+
+    """Runs a shell command that exits with 0 if the link is up.
+
+    This is the slowest probe, as every call forks a shell, but works
+    with any command that the administrator cares to configure.
+
+    """
+
+    def __init__(self, command):
+        self.command = command
+
+    def is_connected(self):
+        return os.system(self.command) == 0
+
+
+class SysfsProbe(object):
+
+    """Reads the interface flags exported by Linux in sysfs."""
+
+    IFF_UP = 0x1
+    IFF_RUNNING = 0x40
+
+    def __init__(self, interface, root='/sys/class/net'):
+        self._path = os.path.join(root, interface, 'flags')
+
+    def is_connected(self):
+        try:
+            f = open(self._path)
+            try:
+                flags = int(f.read().strip(), 16)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return False
+        mask = self.IFF_UP | self.IFF_RUNNING
+        return (flags & mask) == mask
+
+
+class ProcNetDevProbe(object):
+
+    """Checks whether the interface is listed in /proc/net/dev.
+
+    PPP interfaces only exist while the link is up, so the presence
+    of the interface is enough to tell us that we're on line.
+
+    """
+
+    def __init__(self, interface, path='/proc/net/dev'):
+        self._prefix = interface + ':'
+        self._path = path
+
+    def is_connected(self):
+        try:
+            f = open(self._path)
+            try:
+                lines = f.readlines()
+            finally:
+                f.close()
+        except IOError:
+            return False
+        for line in lines[2:]:
+            if line.lstrip().startswith(self._prefix):
+                return True
+        return False
+
+
+class IoctlProbe(object):
+
+    """Asks the kernel for the interface's address with an ioctl.
+
+    Mirrors the behaviour of the traditional "ifconfig | grep inet"
+    command; the link is up if the interface has an IPv4 address. The
+    socket used for the ioctl is opened once and reused.
+
+    """
+
+    SIOCGIFADDR = 0x8915
+
+    def __init__(self, interface):
+        if fcntl is None:
+            raise ValueError('ioctl probe not supported on this platform')
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._request = struct.pack('256s', interface[:15])
+
+    def is_connected(self):
+        try:
+            fcntl.ioctl(self._socket.fileno(), self.SIOCGIFADDR,
+                        self._request)
+        except IOError:
+            return False
+        return True
+
+
+def read_option(config, section, option, default=None, method='get'):
+    """Return an option from the config file, or default if it's unset.
+
+    method names the ConfigParser method used to read (and convert)
+    the option.
+
+    """
+    if config.has_option(section, option):
+        return getattr(config, method)(section, option)
+    return default
+
+
+class ReadOnly(object):
+
+    """Base class for settings, whose attributes can't be changed."""
+
+    def _set(self, **values):
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read only' % self.__class__.__name__)
+
+
+class LinkSettings(ReadOnly):
+
+    """The commands and probe options used to dial a link.
+
+    The commands are read from section, and the probe options from
+    probe_section. For the main link these are the [commands] and
+    [probe] sections; other links keep everything in one section. The
+    interface is None unless it has been configured.
+
+    """
+
+    BACKENDS = ('shell', 'sysfs', 'proc', 'ioctl')
+
+    def __init__(self, config, section='commands', probe_section='probe'):
+        backend = read_option(config, probe_section, 'backend', 'shell')
+        if backend not in self.BACKENDS:
+            raise ValueError('unknown probe backend: %s' % backend)
+        if backend == 'ioctl' and fcntl is None:
+            raise ValueError('ioctl probe not supported on this platform')
+        is_connected = None
+        if backend == 'shell':
+            is_connected = config.get(section, 'is_connected')
+        timeout = read_option(config, section, 'timeout', None, 'getfloat')
+        if timeout is not None and timeout <= 0:
+            raise ValueError('timeout must be greater than 0 in [%s]' %
+                             section)
+        self._set(section=section,
+                  connect=config.get(section, 'connect'),
+                  disconnect=config.get(section, 'disconnect'),
+                  is_connected=is_connected,
+                  timeout=timeout,
+                  backend=backend,
+                  interface=read_option(config, probe_section, 'interface'))
+
+    def has_same_probe(self, other):
+        return (self.backend, self.interface, self.is_connected) == \
+               (other.backend, other.interface, other.is_connected)
+
+
+class ExtraLinkSettings(LinkSettings):
+
+    """The settings for an ExtraLink, from a [link NAME] section."""
+
+    def __init__(self, config, section):
+        LinkSettings.__init__(self, config, section, section)
+        name = section[len('link '):].strip()
+        clients = read_option(config, section, 'clients', None, 'getint')
+        throughput = read_option(config, section, 'throughput', None,
+                                 'getfloat')
+        if clients is None and throughput is None:
+            raise ValueError('no clients or throughput for link %s' % name)
+        self._set(name=name,
+                  clients=clients,
+                  throughput=throughput,
+                  hold_time=read_option(config, section, 'hold_time',
+                                        ExtraLink.HOLD_TIME, 'getfloat'))
+
+
+def create_probe(settings):
+    """Return the link probe chosen by a LinkSettings object.
+
+    The shell probe runs the is_connected command. The others check
+    the interface (ppp0, unless another has been configured).
+
+    """
+    if settings.backend == 'shell':
+        return ShellProbe(settings.is_connected)
+    interface = settings.interface or 'ppp0'
+    if settings.backend == 'sysfs':
+        return SysfsProbe(interface)
+    elif settings.backend == 'proc':
+        return ProcNetDevProbe(interface)
+    return IoctlProbe(interface)
+
+
+class ChildProcess(object):
+
+    """A command being run by the CommandSupervisor."""
+
+    def __init__(self, pid, command, callback, deadline):
+        self.pid = pid
+        self.command = command
+        self.callback = callback
+        self.deadline = deadline
+        self.signal = None  # last signal sent to the command
+
+
+class CommandSupervisor(object):
+
+    """Runs shell commands in the background.
+
+    spawn() returns as soon as the command has been started. Finished
+    commands are reaped by poll(), which should be called regularly;
+    the callback passed to spawn() is then called with the command's
+    exit status (as returned by os.system()).
+
+    Each command runs in its own process group. If a command is still
+    running after its timeout the group is sent SIGTERM, followed by
+    SIGKILL if it hasn't exited KILL_GRACE seconds later.
+
+    """
+
+    POLL_PERIOD = 0.25  # seconds
+    KILL_GRACE = 5
+
+    def __init__(self):
+        self._children = {}  # pid -> ChildProcess
+        self._lock = threading.Lock()
+
+    def _fork(self, command):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.setpgid(0, 0)
+                os.execl('/bin/sh', 'sh', '-c', command)
+            finally:
+                os._exit(127)
+        try:
+            os.setpgid(pid, pid)  # avoid racing the child
+        except OSError:
+            pass
+        return pid
+
+    def spawn(self, command, callback=None, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._lock.acquire()
+        try:
+            pid = self._fork(command)
+            self._children[pid] = ChildProcess(pid, command, callback,
+                                               deadline)
+        finally:
+            self._lock.release()
+        log.debug('Started "%s" (pid %d)' % (command, pid))
+        return pid
+
+    def count_children(self):
+        return len(self._children)
+
+    def _kill(self, child, now):
+        if child.signal is None:
+            child.signal = signal.SIGTERM
+            child.deadline = now + self.KILL_GRACE
+            log.warn('Terminating "%s"' % child.command)
+        else:
+            child.signal = signal.SIGKILL
+            child.deadline = None
+            log.warn('Killing "%s"' % child.command)
+        try:
+            os.killpg(child.pid, child.signal)
+        except OSError:
+            pass
+
+    def _reap(self):
+        finished = []
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for pid, child in self._children.items():
+                try:
+                    reaped, status = os.waitpid(pid, os.WNOHANG)
+                except OSError:
+                    reaped, status = pid, -1
+                if reaped:
+                    del self._children[pid]
+                    finished.append((child, status))
+                elif child.deadline is not None and now >= child.deadline:
+                    self._kill(child, now)
+        finally:
+            self._lock.release()
+        return finished
+
+    def poll(self):
+        for child, status in self._reap():
+            log.debug('"%s" exited (status %d)' % (child.command, status))
+            if child.callback is not None:
+                try:
+                    child.callback(status)
+                except:
+                    log.error('Error handling exit of "%s": %s' %
+                              (child.command, format_exception()))
+
+
+class CommandSupervisorThread(threading.Thread):
+
+    """Polls a CommandSupervisor from its own thread."""
+
+    def __init__(self, supervisor):
+        threading.Thread.__init__(self)
+        self._supervisor = supervisor
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('CommandSupervisor')
+
+    def run(self):
+        while not self.finished.isSet():
+            self._supervisor.poll()
+            self.finished.wait(self._supervisor.POLL_PERIOD)
+
+
+class Modem(object):
+
+    def __init__(self, settings, probe=None):
+        """Run the commands in settings (a LinkSettings object)."""
+        self.settings = settings
+        if probe is None:
+            probe = create_probe(settings)
+        self.probe = probe
+        self.supervisor = None
+        self.timer = Timer()
+
+    def apply_settings(self, settings):
+        """Switch to new settings, replacing the probe if it has changed."""
+        if not settings.has_same_probe(self.settings):
+            self.probe = create_probe(settings)
+        self.settings = settings
+
+    def _run(self, command, callback):
+        """Run command, passing its exit status to callback.
+
+        If the modem has a supervisor the command is run in the
+        background, otherwise we wait for it to finish.
+
+        """
+        if self.supervisor is None:
+            status = os.system(command)
+            if callback is not None:
+                callback(status)
+        else:
+            self.supervisor.spawn(command, callback, self.settings.timeout)
+
+    def connect(self, callback=None):
+        log.info('Connecting')
+        self.timer.reset()
+        self._run(self.settings.connect, callback)
+
+    def disconnect(self, callback=None):
+        log.info('Disconnecting, online for %s seconds' %
+                 self.timer.elapsed_seconds)
+        self.timer.stop()
+        self._run(self.settings.disconnect, callback)
+
+    def record_link_state(self, is_connected):
+        """Start (or stop) the timer if the link has come up (or down)."""
+        if is_connected and not self.timer.is_running:
+            self.timer.start()
+        elif not is_connected and self.timer.is_running:
+            self.timer.stop()
+        return is_connected
+
+    def is_connected(self):
+        return self.record_link_state(self.probe.is_connected())
+
+
+class Observable(object):
+
+    def __init__(self):
+        self._observers = {}
+
+    def add_observer(self, observer):
+        self._observers[observer] = None
+
+    def remove_observer(self, observer):
+        del self._observers[observer]
+
+    def notify_observers(self):
+        for observer in self._observers.keys():
+            observer.update()
+
+
+class LinkMonitor(threading.Thread, Observable):
+
+    """Probes the link in the background and caches the result.
+
+    The monitor wraps a Modem, publishing a timestamped snapshot of
+    the link state every PROBE_PERIOD seconds. Calls to is_connected()
+    return the snapshot without running the probe, unless it is older
+    than max_age seconds, in which case the caller probes the link
+    itself (set max_age to None to prevent this). Connecting or
+    disconnecting the modem wakes the monitor so that the change is
+    noticed promptly. Observers are notified whenever the state of
+    the link changes.
+
+    Once the link's state has been reported by an event (see
+    LinkEventListener) the monitor relies on events, only probing the
+    link if it hasn't heard anything for event_period seconds (or
+    never, if event_period is None).
+
+    """
+
+    PROBE_PERIOD = 1  # seconds
+    PROBE_TIMEOUT = 10
+    MAX_AGE = 3
+    EVENT_PERIOD = 60
+
+    def __init__(self, modem, period=PROBE_PERIOD, max_age=MAX_AGE):
+        threading.Thread.__init__(self)
+        Observable.__init__(self)
+        self._modem = modem
+        self.period = period
+        self.max_age = max_age
+        self.snapshot = (False, 0)  # (is_connected, time of probe)
+        self.event_period = self.EVENT_PERIOD
+        self.has_events = False
+        self._is_probing = False
+        self._probe_started = None
+        self._wakeup = threading.Event()
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('LinkMonitor')
+
+    def _get_modem(self):
+        return self._modem
+
+    modem = property(_get_modem)
+
+    def _get_timer(self):
+        return self._modem.timer
+
+    timer = property(_get_timer)
+
+    def _set_snapshot(self, is_connected):
+        was_connected = self.snapshot[0]
+        self.snapshot = (is_connected, time.time())
+        if is_connected != was_connected:
+            self.notify_observers()
+        return is_connected
+
+    def probe(self):
+        """Probe the link and publish a new snapshot."""
+        started = time.time()
+        is_connected = self._modem.is_connected()
+        metrics.observe('landialler_probe_duration_seconds',
+                        time.time() - started)
+        return self._set_snapshot(is_connected)
+
+    def publish(self, is_connected):
+        """Publish the result of a probe that was run elsewhere."""
+        self._set_snapshot(self._modem.record_link_state(is_connected))
+
+    def receive_event(self, is_connected):
+        """Publish the state of the link, as reported by an event."""
+        self.has_events = True
+        self.max_age = None
+        self.publish(is_connected)
+
+    def is_probe_due(self):
+        """Return False if recent events make probing unnecessary."""
+        if not self.has_events:
+            return True
+        if self.event_period is None:
+            return False
+        return (time.time() - self.snapshot[1]) >= self.event_period
+
+    def probe_in_background(self, supervisor):
+        """Probe the link without blocking the caller.
+
+        Shell probes are run by the supervisor and their result is
+        published when they exit. The other probes are quick enough
+        to run directly.
+
+        """
+        probe = self._modem.probe
+        if isinstance(probe, ShellProbe):
+            if not self._is_probing:
+                self._is_probing = True
+                self._probe_started = time.time()
+                supervisor.spawn(probe.command, self._probe_finished,
+                                 self.PROBE_TIMEOUT)
+        else:
+            self.probe()
+
+    def _probe_finished(self, status):
+        self._is_probing = False
+        metrics.observe('landialler_probe_duration_seconds',
+                        time.time() - self._probe_started)
+        self.publish(status == 0)
+
+    def is_connected(self):
+        is_connected, probed_at = self.snapshot
+        if self.max_age is not None:
+            if (time.time() - probed_at) > self.max_age:
+                return self.probe()
+        return is_connected
+
+    def connect(self, callback=None):
+        self._modem.connect(callback)
+        self._wakeup.set()
+
+    def disconnect(self, callback=None):
+        self._modem.disconnect(callback)
+        self._wakeup.set()
+
+    def stop(self):
+        self.finished.set()
+        self._wakeup.set()
+
+    def run(self):
+        while not self.finished.isSet():
+            self._wakeup.clear()
+            if self.is_probe_due():
+                self.probe()
+            self._wakeup.wait(self.period)
+
+
+class LinkEventListener(threading.Thread):
+
+    """Receives link events from pppd's ip-up and ip-down scripts.
+
+    The scripts (see landiallerd_hook.py) send a datagram such as "up
+    ppp0" to a Unix socket the moment an interface comes up or goes
+    down. Each event is handed to the interface's LinkMonitor, so the
+    clients hear about it without waiting for the link to be probed.
+
+    The listener runs in its own thread, or from the event loop (see
+    LinkEventDispatcher).
+
+    """
+
+    MAX_MESSAGE = 512
+    POLL_PERIOD = 1  # seconds
+
+    def __init__(self, path, monitors):
+        """Listen on path for events about monitors' interfaces.
+
+        monitors maps interface names to LinkMonitors. Raises
+        socket.error if another server is already listening on path.
+
+        """
+        threading.Thread.__init__(self)
+        self.path = path
+        self._monitors = monitors
+        self._remove_stale_socket(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        umask = os.umask(0177)  # only root and our user may send events
+        try:
+            self.socket.bind(path)
+        finally:
+            os.umask(umask)
+        set_close_on_exec(self.socket.fileno())
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('LinkEventListener')
+
+    def _remove_stale_socket(self, path):
+        # A socket left behind by the last server refuses connections;
+        # one that accepts them belongs to a server that's still
+        # running, and mustn't be taken from it.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            try:
+                probe.connect(path)
+            except socket.error:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                return
+        finally:
+            probe.close()
+        raise socket.error(errno.EADDRINUSE,
+                           'another server is listening on %s' % path)
+
+    def handle_message(self, message):
+        try:
+            event, interface = message.split()
+        except ValueError:
+            log.warn('Ignoring malformed link event: %r' % message)
+            return
+        monitor = self._monitors.get(interface)
+        if monitor is None or event not in ('up', 'down'):
+            log.debug('Ignoring link event: %s %s' % (event, interface))
+            return
+        log.info('Link %s is %s' % (interface, event))
+        monitor.receive_event(event == 'up')
+
+    def read(self):
+        """Read and handle the next event."""
+        try:
+            message = self.socket.recv(self.MAX_MESSAGE)
+        except socket.timeout:
+            return
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        self.handle_message(message)
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def stop(self):
+        self.finished.set()
+
+    def run(self):
+        self.socket.settimeout(self.POLL_PERIOD)
+        while not self.finished.isSet():
+            try:
+                self.read()
+            except:
+                log.error('Error reading link event: %s' %
+                          format_exception())
+                self.finished.wait(self.POLL_PERIOD)
+
+
+class DatagramDispatcher(asyncore.dispatcher):
+
+    """Reads a listener's datagram socket from the event loop.
+
+    The listener owns the socket and handles each datagram in its
+    read() method; subclasses say how errors are logged.
+
+    """
+
+    def __init__(self, listener):
+        listener.socket.setblocking(0)
+        asyncore.dispatcher.__init__(self, listener.socket)
+        self._listener = listener
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self._listener.read()
+
+
+class LinkEventDispatcher(DatagramDispatcher):
+
+    """Reads link events from the event loop."""
+
+    def handle_error(self):
+        log.error('Error reading link event: %s' % format_exception())
+
+
+class DiscoveryResponder(threading.Thread):
+
+    """Tells clients on the LAN where to find the server.
+
+    Clients that don't know the server's address broadcast QUERY to
+    the discovery port. The responder replies to each query with
+    REPLY and the port on which the server takes requests; the client
+    learns the server's address from the reply's source address.
+
+    Like LinkEventListener, the responder runs in its own thread or
+    from the event loop (see DiscoveryDispatcher).
+
+    """
+
+    PORT = 6544
+    QUERY = 'LANDIALLER DISCOVER'
+    REPLY = 'LANDIALLER SERVER'
+    MAX_MESSAGE = 512
+    POLL_PERIOD = 1  # seconds
+
+    def __init__(self, port, server_port):
+        threading.Thread.__init__(self)
+        self.server_port = server_port
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('', port))
+        set_close_on_exec(self.socket.fileno())
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('DiscoveryResponder')
+
+    def handle_message(self, message, address):
+        if message.strip() != self.QUERY:
+            log.debug('Ignoring discovery message from %s: %r' %
+                      (address[0], message))
+            return
+        log.debug('Discovered by %s' % address[0])
+        self.socket.sendto('%s %d\n' % (self.REPLY, self.server_port),
+                           address)
+
+    def read(self):
+        """Read and answer the next query."""
+        try:
+            message, address = self.socket.recvfrom(self.MAX_MESSAGE)
+        except socket.timeout:
+            return
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        self.handle_message(message, address)
+
+    def close(self):
+        self.socket.close()
+
+    def stop(self):
+        self.finished.set()
+
+    def run(self):
+        self.socket.settimeout(self.POLL_PERIOD)
+        while not self.finished.isSet():
+            try:
+                self.read()
+            except:
+                log.error('Error answering discovery query: %s' %
+                          format_exception())
+                self.finished.wait(self.POLL_PERIOD)
+
+
+class DiscoveryDispatcher(DatagramDispatcher):
+
+    """Answers discovery queries from the event loop."""
+
+    def handle_error(self):
+        log.error('Error answering discovery query: %s' %
+                  format_exception())
+
+
+class ExtraLink(object):
+
+    """A link in a LinkPool, and the load at which it's needed.
+
+    The link is needed when at least clients clients are connected,
+    or when at least throughput bytes per second are passing over the
+    pool's links (either threshold may be None).
+
+    If the link can't be brought up we wait RETRY_DELAY seconds
+    before trying again, doubling the delay after each consecutive
+    failure (up to MAX_RETRY_DELAY).
+
+    """
+
+    HOLD_TIME = 60  # seconds
+    RETRY_DELAY = 30  # seconds
+    MAX_RETRY_DELAY = 15 * 60  # seconds
+
+    def __init__(self, name, monitor, clients=None, throughput=None,
+                 hold_time=HOLD_TIME, interface=None):
+        self.name = name
+        self.monitor = monitor
+        self.clients = clients
+        self.throughput = throughput
+        self.hold_time = hold_time
+        self.interface = interface
+        self.is_needed = False
+        self._brought_up_at = None
+        self._lock = threading.Lock()
+        self._attempt = 0
+        self._failures = 0
+        self._retry_at = 0
+
+    def is_busy(self, clients, throughput):
+        if self.clients is not None and clients >= self.clients:
+            return True
+        if self.throughput is not None and throughput >= self.throughput:
+            return True
+        return False
+
+    def has_been_up_for_hold_time(self, now):
+        return (now - self._brought_up_at) >= self.hold_time
+
+    def can_bring_up(self, now):
+        """Return False if we're waiting to retry a failed attempt."""
+        return now >= self._retry_at
+
+    def bring_up(self, now):
+        self._lock.acquire()
+        try:
+            self.is_needed = True
+            self._brought_up_at = now
+            self._attempt += 1
+            attempt = self._attempt
+        finally:
+            self._lock.release()
+        self.monitor.connect(
+            lambda status: self._connect_finished(status, attempt))
+
+    def _connect_finished(self, status, attempt):
+        # Called by the supervisor thread. The link may have been
+        # dropped (or brought up again) while the command was running,
+        # in which case the result is no longer of interest.
+        self._lock.acquire()
+        try:
+            if attempt != self._attempt or not self.is_needed:
+                return
+            if status == 0:
+                self._failures = 0
+                return
+            delay = min(self.RETRY_DELAY * 2 ** self._failures,
+                        self.MAX_RETRY_DELAY)
+            self._failures += 1
+            self._retry_at = time.time() + delay
+            self.is_needed = False
+        finally:
+            self._lock.release()
+        log.warn('Unable to bring up link %s (exit status %s), '
+                 'will try again in %d seconds' % (self.name, status, delay))
+
+    def drop(self):
+        self._lock.acquire()
+        try:
+            self.is_needed = False
+        finally:
+            self._lock.release()
+        self.monitor.disconnect()
+
+    def apply_settings(self, settings):
+        """Switch to new settings (see ExtraLinkSettings)."""
+        self.monitor.modem.apply_settings(settings)
+        self.clients = settings.clients
+        self.throughput = settings.throughput
+        self.hold_time = settings.hold_time
+
+    def get_status(self):
+        return {'name': self.name,
+                'is_connected': bool(self.monitor.is_connected()),
+                'is_needed': self.is_needed}
+
+
+def create_link(settings):
+    """Return the ExtraLink described by an ExtraLinkSettings object."""
+    monitor = LinkMonitor(Modem(settings))
+    monitor.setName('LinkMonitor-%s' % settings.name)
+    return ExtraLink(settings.name, monitor, settings.clients,
+                     settings.throughput, settings.hold_time,
+                     settings.interface)
+
+
+class LinkPool(threading.Thread):
+
+    """Brings up extra links when the main link is busy.
+
+    The main link is dialled by the ModemProxy, as usual. While it's
+    up, each call to balance() brings up any extra link that is busy
+    enough (see ExtraLink) and drops those that have been up for
+    their hold time and are no longer needed. The extra links are
+    dropped as soon as the main link goes down.
+
+    Throughput is the total traffic over the ThroughputSamplers passed
+    to the constructor (i.e. the main link's, which are sampled by
+    their owner) and over the interfaces of the extra links, which
+    the pool samples itself each time it balances.
+
+    """
+
+    PERIOD = 5  # seconds
+
+    def __init__(self, modem_proxy, links, samplers=(), period=PERIOD,
+                 proc_net_dev='/proc/net/dev'):
+        threading.Thread.__init__(self)
+        self._modem_proxy = modem_proxy
+        self.links = links
+        self.period = period
+        self._samplers = list(samplers)
+        self._link_samplers = []
+        for link in links:
+            if link.interface is not None:
+                self._link_samplers.append(ThroughputSampler(
+                    link.interface, period=period, path=proc_net_dev))
+            link.monitor.add_observer(self)
+        self.throughput = 0.0  # bytes per second
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('LinkPool')
+
+    def update(self):
+        """Called by a link's monitor when the link goes up or down."""
+        self._modem_proxy.links_changed()
+
+    def _measure_throughput(self):
+        for sampler in self._link_samplers:
+            sampler.period = self.period
+            sampler.sample()
+        throughput = 0.0
+        for sampler in self._samplers + self._link_samplers:
+            throughput += sampler.get_bytes_per_second(self.period)
+        self.throughput = throughput
+        return throughput
+
+    def balance(self):
+        """Bring up or drop the extra links to suit the current load."""
+        now = time.time()
+        throughput = self._measure_throughput()
+        clients = self._modem_proxy.count_clients()
+        is_main_link_up = self._modem_proxy.is_connected()
+        has_changed = False
+        for link in self.links:
+            is_busy = is_main_link_up and link.is_busy(clients, throughput)
+            if is_busy and not link.is_needed and link.can_bring_up(now):
+                log.info('Bringing up link %s (%d clients, %d bytes/s)' %
+                         (link.name, clients, throughput))
+                link.bring_up(now)
+                has_changed = True
+            elif link.is_needed and not is_busy:
+                if not is_main_link_up or \
+                       link.has_been_up_for_hold_time(now):
+                    log.info('Dropping link %s' % link.name)
+                    link.drop()
+                    has_changed = True
+        if has_changed:
+            self._modem_proxy.links_changed()
+
+    def get_links(self):
+        """Return a list of structs describing the extra links.
+
+        Each struct contains the link's name, whether it is connected,
+        and whether it is needed (i.e. has been brought up).
+
+        """
+        return [link.get_status() for link in self.links]
+
+    def stop(self):
+        self.finished.set()
+
+    def run(self):
+        while not self.finished.isSet():
+            try:
+                self.balance()
+            except:
+                log.error('Error balancing links: %s' % format_exception())
+            self.finished.wait(self.period)
+
+
+class ThroughputSampler(threading.Thread, Observable):
+
+    """Measures the traffic over the link's interface.
+
+    Each call to sample() reads the byte and packet counters from
+    /proc/net/dev and records the rates since the previous sample in
+    a ring buffer of the last HISTORY samples. The file is kept open
+    between samples, and only the interface's own line is parsed (we
+    check the line found last time before searching the file for
+    it), so sampling every second costs very little.
+
+    The link is considered saturated while the average rate over the
+    last few samples, in either direction, is close to the capacity
+    (in bytes per second) passed to the constructor.
+
+    Observers are notified after each sample is recorded.
+
+    """
+
+    PERIOD = 1  # seconds
+    HISTORY = 60  # samples
+    SATURATED_SAMPLES = 5
+    SATURATED_FRACTION = 0.9
+
+    def __init__(self, interface, capacity=0, period=PERIOD,
+                 history=HISTORY, path='/proc/net/dev'):
+        threading.Thread.__init__(self)
+        Observable.__init__(self)
+        self.interface = interface
+        self.capacity = capacity
+        self.period = period
+        self._path = path
+        self._fd = None
+        self._prefix = interface + ':'
+        self._line_start = None
+        self._line_head = None
+        self._counters = None
+        self._sampled_at = None
+        self._lock = threading.Lock()
+        self._samples = [None] * history
+        self._next = 0
+        self._count = 0
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('ThroughputSampler')
+
+    def _read(self):
+        if self._fd is None:
+            self._fd = os.open(self._path, os.O_RDONLY)
+        os.lseek(self._fd, 0, 0)
+        chunks = []
+        while True:
+            chunk = os.read(self._fd, 8192)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def _find_line(self, data):
+        start = self._line_start
+        if start is not None and \
+               data[start:start + len(self._line_head)] == self._line_head:
+            return start
+        index = data.find(self._prefix)
+        while index != -1:
+            if index == 0 or data[index - 1] in ' \n':
+                start = data.rfind('\n', 0, index) + 1
+                self._line_start = start
+                self._line_head = data[start:index + len(self._prefix)]
+                return start
+            index = data.find(self._prefix, index + 1)
+        self._line_start = None
+        return None
+
+    def read_counters(self):
+        """Return bytes and packets received and sent, or None.
+
+        None is returned if the interface doesn't exist (e.g. because
+        the link is down).
+
+        """
+        try:
+            data = self._read()
+        except OSError:
+            self.close()
+            return None
+        start = self._find_line(data)
+        if start is None:
+            return None
+        end = data.find('\n', start)
+        if end == -1:
+            end = len(data)
+        fields = data[start + len(self._line_head):end].split()
+        return (long(fields[0]), long(fields[8]),
+                long(fields[1]), long(fields[9]))
+
+    def sample(self):
+        """Record the rates since the last sample."""
+        now = time.time()
+        counters = self.read_counters()
+        rates = (0.0, 0.0, 0.0, 0.0)
+        previous, sampled_at = self._counters, self._sampled_at
+        if counters is not None and previous is not None and \
+               now > sampled_at:
+            elapsed = now - sampled_at
+            rates = []
+            for count, last in zip(counters, previous):
+                if count < last:  # the interface has been recreated
+                    last = 0
+                rates.append((count - last) / elapsed)
+            rates = tuple(rates)
+        self._counters = counters
+        self._sampled_at = now
+        if sampled_at is None:
+            return
+        self._lock.acquire()
+        try:
+            self._samples[self._next] = rates
+            self._next = (self._next + 1) % len(self._samples)
+            self._count = min(self._count + 1, len(self._samples))
+        finally:
+            self._lock.release()
+        self.notify_observers()
+
+    def get_samples(self, count=None):
+        """Return up to count of the most recent samples, oldest first.
+
+        Each sample is a tuple of the bytes received and sent, and the
+        packets received and sent, per second.
+
+        """
+        self._lock.acquire()
+        try:
+            if count is None or count > self._count:
+                count = self._count
+            size = len(self._samples)
+            first = self._next - count
+            return [self._samples[(first + i) % size] for i in range(count)]
+        finally:
+            self._lock.release()
+
+    def get_bytes_per_second(self, seconds):
+        """Return the mean bytes received and sent per second.
+
+        The mean is taken over the samples recorded in the last
+        seconds seconds (or over the last sample, if it covers more).
+
+        """
+        count = max(1, int(seconds / self.period))
+        samples = self.get_samples(count)
+        if not samples:
+            return 0.0
+        return sum([s[0] + s[1] for s in samples]) / len(samples)
+
+    def is_saturated(self):
+        """Return True if the link is running at (nearly) full speed."""
+        samples = self.get_samples(self.SATURATED_SAMPLES)
+        if not self.capacity or not samples:
+            return False
+        received = sum([s[0] for s in samples]) / len(samples)
+        sent = sum([s[1] for s in samples]) / len(samples)
+        limit = self.capacity * self.SATURATED_FRACTION
+        return received >= limit or sent >= limit
+
+    def get_throughput(self):
+        """Return a struct describing the recent traffic.
+
+        See API.get_throughput().
+
+        """
+        samples = self.get_samples()
+        current = (0.0, 0.0, 0.0, 0.0)
+        if samples:
+            current = samples[-1]
+        return {'interface': self.interface,
+                'period': self.period,
+                'capacity': self.capacity,
+                'is_saturated': self.is_saturated(),
+                'rx_bytes_per_second': int(current[0]),
+                'tx_bytes_per_second': int(current[1]),
+                'rx_packets_per_second': int(current[2]),
+                'tx_packets_per_second': int(current[3]),
+                'history': [[int(s[0]), int(s[1])] for s in samples]}
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._line_start = None
+
+    def stop(self):
+        self.finished.set()
+
+    def run(self):
+        while not self.finished.isSet():
+            try:
+                self.sample()
+            except:
+                log.error('Error sampling throughput: %s' %
+                          format_exception())
+            self.finished.wait(self.period)
+
+
+class ClientRegistry(object):
+
+    """Records when each client was last seen.
+
+    A client expires timeout seconds after it was last seen. The
+    expiry deadlines are kept in a heap, so finding the clients that
+    have expired only involves looking at those clients. Refreshing a
+    client pushes a new deadline without removing the old one, which
+    is discarded when it reaches the top of the heap.
+
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._last_seen = {}
+        self._deadlines = []  # heap of (deadline, client_id)
+
+    def __contains__(self, client_id):
+        return client_id in self._last_seen
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def touch(self, client_id):
+        """Record that the client has just been seen."""
+        now = time.time()
+        self._last_seen[client_id] = now
+        heapq.heappush(self._deadlines, (now + self.timeout, client_id))
+        if len(self._deadlines) > (2 * len(self._last_seen) + 16):
+            self._compact()
+
+    def remove(self, client_id):
+        if client_id in self._last_seen:
+            del self._last_seen[client_id]
+
+    def get_client_ids(self):
+        return self._last_seen.keys()
+
+    def get_last_seen(self, client_id):
+        return self._last_seen.get(client_id)
+
+    def _compact(self):
+        self._deadlines = [(last_seen + self.timeout, client_id)
+                           for client_id, last_seen in self._last_seen.items()]
+        heapq.heapify(self._deadlines)
+
+    def _is_current(self, deadline, client_id):
+        last_seen = self._last_seen.get(client_id)
+        return last_seen is not None and \
+               (last_seen + self.timeout) == deadline
+
+    def next_deadline(self):
+        """Return the time at which the next client expires, or None."""
+        while self._deadlines:
+            deadline, client_id = self._deadlines[0]
+            if self._is_current(deadline, client_id):
+                return deadline
+            heapq.heappop(self._deadlines)
+        return None
+
+    def pop_expired(self, now):
+        """Return the clients whose deadline is now or has passed.
+
+        The clients aren't removed from the registry.
+
+        """
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, client_id = heapq.heappop(self._deadlines)
+            if self._is_current(deadline, client_id):
+                expired.append(client_id)
+        return expired
+
+
+class ModemProxy(Observable):
+
+    """Shares the modem between clients.
+
+    The proxy dials when the first client connects and hangs up when
+    the last one leaves. Its methods may be called concurrently by
+    the server's worker threads, so they are serialised with a lock.
+    The connect and disconnect commands are queued while the lock is
+    held and run (in order) once it has been released, so a slow
+    command never holds up clients that only want the status.
+
+    Every change to the number of clients, the state of the link or
+    the dial phase increments the proxy's version number and wakes any
+    threads blocked in wait_for_change(). The proxy's observers are
+    notified once the lock has been released (and any commands run),
+    so they never see the proxy half way through a change.
+
+    """
+
+    CLIENT_TIMEOUT = 30
+    RESTORED_DIAL_TIMEOUT = 2 * 60  # seconds
+
+    OFFLINE = 'offline'
+    DIALLING = 'dialling'
+    FAILED = 'failed'
+    ONLINE = 'online'
+    IDLE = 'idle'  # offline, having hung up because the link was idle
+
+    def __init__(self, modem):
+        Observable.__init__(self)
+        self._modem = modem
+        self._clients = ClientRegistry(self.CLIENT_TIMEOUT)
+        self._is_dialling = False
+        self._dial_started = None
+        self._dial_deadline = None  # when a restored dial is given up
+        self._dial_failed = False
+        self._hung_up_idle = False
+        self._was_connected = False
+        self.version = 0
+        self._lock = threading.RLock()
+        self._depth = 0  # how many times the lock is held
+        self._changed = threading.Condition(self._lock)
+        self._commands = []  # (method, callback) to run once unlocked
+        self._is_changed = False  # observers need to be notified
+        self._command_lock = threading.Lock()
+        self.link_pool = None
+        self.accounting = None
+        if hasattr(modem, 'add_observer'):
+            modem.add_observer(self)
+
+    def _acquire(self):
+        self._lock.acquire()
+        self._depth += 1
+
+    def _release(self):
+        """Release the lock, then run commands and notify observers."""
+        self._depth -= 1
+        is_outermost = self._depth == 0
+        is_changed = is_outermost and self._is_changed
+        if is_changed:
+            self._is_changed = False
+        self._lock.release()
+        if is_outermost:
+            self._run_commands()
+        if is_changed:
+            self.notify_observers()
+
+    def _queue_command(self, method, callback):
+        # must be called with the lock held
+        self._commands.append((method, callback))
+
+    def _pop_command(self):
+        self._lock.acquire()
+        try:
+            if self._commands:
+                return self._commands.pop(0)
+            return None
+        finally:
+            self._lock.release()
+
+    def _run_commands(self):
+        """Run the queued commands, unless another thread is doing so.
+
+        Only one thread runs commands at a time, so they're run in the
+        order they were queued. A thread that finds another running
+        them leaves its own commands for that thread, which checks the
+        queue again before it gives up.
+
+        """
+        while self._command_lock.acquire(False):
+            try:
+                command = self._pop_command()
+                while command is not None:
+                    method, callback = command
+                    method(callback)
+                    command = self._pop_command()
+            finally:
+                self._command_lock.release()
+            self._lock.acquire()
+            try:
+                if not self._commands:
+                    return
+            finally:
+                self._lock.release()
+
+    def _note_change(self):
+        # must be called with the lock held
+        self.version += 1
+        self._changed.notifyAll()
+        self._is_changed = True
+
+    def wait_for_change(self, version, timeout):
+        """Wait until the version differs from version.
+
+        Returns the current version, which will be unchanged if
+        timeout seconds pass first.
+
+        """
+        deadline = time.time() + timeout
+        self._lock.acquire()
+        try:
+            while self.version == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return self.version
+        finally:
+            self._lock.release()
+
+    def update(self):
+        """Called by the modem when the state of the link changes."""
+        self.is_connected()
+
+    def add_client(self, client_id):
+        self._acquire()
+        try:
+            if client_id not in self._clients:
+                self._clients.touch(client_id)
+                self._start_session(client_id)
+                self._note_change()
+            if not (self._is_dialling or self.is_connected()):
+                self._is_dialling = True
+                self._dial_failed = False
+                self._hung_up_idle = False
+                self._dial_started = time.time()
+                self._dial_deadline = None
+                self._queue_command(self._modem.connect,
+                                    self._connect_finished)
+                self._note_change()
+        finally:
+            self._release()
+
+    def _connect_finished(self, status):
+        if status == 0:
+            return
+        log.warn('Connect command failed (exit status %s)' % status)
+        metrics.increment('landialler_dial_failures_total')
+        self._acquire()
+        try:
+            if self._is_dialling:
+                self._is_dialling = False
+                self._dial_failed = True
+                self._note_change()
+        finally:
+            self._release()
+
+    def _disconnect_finished(self, status):
+        if status != 0:
+            log.warn('Disconnect command failed (exit status %s)' % status)
+
+    def refresh_client(self, client_id):
+        self._acquire()
+        try:
+            is_new = client_id not in self._clients
+            self._clients.touch(client_id)
+            if is_new:
+                self._start_session(client_id)
+                self._note_change()
+        finally:
+            self._release()
+
+    def _start_session(self, client_id, started_at=None):
+        if self.accounting is not None:
+            self.accounting.start_session(client_id, started_at)
+
+    def remove_client(self, client_id, stopped_at=None):
+        """Forget a client, hanging up if it was the last one.
+
+        The client's session is recorded as having ended at
+        stopped_at (by default, now).
+
+        """
+        self._acquire()
+        try:
+            if client_id in self._clients:
+                self._clients.remove(client_id)
+                if self.accounting is not None:
+                    self.accounting.stop_session(client_id, stopped_at)
+                self._note_change()
+            if not self._clients:
+                if self.is_connected() or self._is_dialling:
+                    self.disconnect()
+        finally:
+            self._release()
+
+    def remove_old_clients(self):
+        """Forget clients that haven't been seen for CLIENT_TIMEOUT."""
+        started = time.time()
+        self._acquire()
+        try:
+            for client_id in self._clients.pop_expired(started):
+                self.remove_client(client_id,
+                                   self._clients.get_last_seen(client_id))
+                metrics.increment('landialler_expired_clients_total')
+        finally:
+            self._release()
+        metrics.observe('landialler_sweep_duration_seconds',
+                        time.time() - started)
+
+    def seconds_until_expiry(self):
+        """Return the time until remove_old_clients() has work to do.
+
+        If there are no clients it can't have anything to do for at
+        least CLIENT_TIMEOUT seconds.
+
+        """
+        self._acquire()
+        try:
+            deadline = self._clients.next_deadline()
+        finally:
+            self._release()
+        if deadline is None:
+            return self.CLIENT_TIMEOUT
+        return max(deadline - time.time(), 0)
+
+    def count_clients(self):
+        return len(self._clients)
+
+    def is_connected(self):
+        self._acquire()
+        try:
+            is_connected = bool(self._modem.is_connected())
+            if is_connected and self._is_dialling:
+                metrics.observe('landialler_dial_duration_seconds',
+                                time.time() - self._dial_started)
+            if is_connected:
+                self._is_dialling = False
+                self._dial_failed = False
+                if not self._was_connected:
+                    self._hung_up_idle = False
+            elif self._is_dialling and self._dial_deadline is not None \
+                     and time.time() >= self._dial_deadline:
+                log.warn('Restored dial timed out')
+                self._is_dialling = False
+                self._dial_failed = True
+                self._note_change()
+            if is_connected != self._was_connected:
+                self._was_connected = is_connected
+                self._note_change()
+            return is_connected
+        finally:
+            self._release()
+
+    def get_time_connected(self):
+        return self._modem.timer.elapsed_seconds
+
+    def get_phase(self):
+        self._acquire()
+        try:
+            if self.is_connected():
+                return self.ONLINE
+            elif self._is_dialling:
+                return self.DIALLING
+            elif self._dial_failed:
+                return self.FAILED
+            elif self._hung_up_idle:
+                return self.IDLE
+            else:
+                return self.OFFLINE
+        finally:
+            self._release()
+
+    def links_changed(self):
+        """Called by the link pool when its links change state."""
+        self._acquire()
+        try:
+            self._note_change()
+        finally:
+            self._release()
+
+    def get_links(self):
+        if self.link_pool is None:
+            return []
+        return self.link_pool.get_links()
+
+    def get_status(self):
+        """Return the status of the proxy as a tuple.
+
+        The tuple contains the version, the number of clients, the
+        state of the link, the time online, the dial phase and the
+        state of any extra links. The values are read together, so
+        the version always matches the rest of the status.
+
+        """
+        self._acquire()
+        try:
+            is_connected = self.is_connected()
+            return (self.version, len(self._clients), is_connected,
+                    self.get_time_connected(), self.get_phase(),
+                    self.get_links())
+        finally:
+            self._release()
+
+    def disconnect(self, is_idle=False):
+        """Hang up, even if there are clients.
+
+        If is_idle is True the phase becomes IDLE (rather than
+        OFFLINE) until the next time we dial, so that the clients can
+        tell why the link went down.
+
+        """
+        self._acquire()
+        try:
+            self._is_dialling = False
+            self._dial_failed = False
+            self._hung_up_idle = is_idle
+            self._queue_command(self._modem.disconnect,
+                                self._disconnect_finished)
+            self._note_change()
+        finally:
+            self._release()
+
+    def release_waiters(self):
+        """Return from every call to wait_for_change() straight away."""
+        self._acquire()
+        try:
+            self._note_change()
+        finally:
+            self._release()
+
+    def _get_open_sessions(self):
+        if self.accounting is None:
+            return {}
+        return self.accounting.get_open_sessions()
+
+    def get_state(self):
+        """Return the state that should survive a restart, as a dict."""
+        self._acquire()
+        try:
+            return {'version': self.version,
+                    'clients': self._clients.get_client_ids(),
+                    'is_connected': self._was_connected,
+                    'is_dialling': self._is_dialling,
+                    'dial_started': self._dial_started,
+                    'dial_failed': self._dial_failed,
+                    'hung_up_idle': self._hung_up_idle,
+                    'start_time': self._modem.timer.start_time,
+                    'sessions': self._get_open_sessions()}
+        finally:
+            self._release()
+
+    def restore_state(self, state):
+        """Pick up where a previous server left off.
+
+        The modem isn't dialled or probed. The clients are treated as
+        though they had just been seen, giving them CLIENT_TIMEOUT
+        seconds to check in with the new server. Their sessions carry
+        on from when they started.
+
+        We can't hear how a dial that was in progress turns out, so
+        it's treated as having failed if the link isn't up within
+        RESTORED_DIAL_TIMEOUT seconds of it starting. Anything missing
+        from the state takes its default value.
+
+        """
+        self._acquire()
+        try:
+            sessions = state.get('sessions', {})
+            for client_id in state.get('clients', []):
+                self._clients.touch(client_id)
+                self._start_session(client_id, sessions.get(client_id))
+            self._was_connected = state.get('is_connected', False)
+            self._is_dialling = state.get('is_dialling', False)
+            self._dial_started = state.get('dial_started')
+            self._dial_failed = state.get('dial_failed', False)
+            self._hung_up_idle = state.get('hung_up_idle', False)
+            if self._is_dialling:
+                self._dial_deadline = (self._dial_started or time.time()) + \
+                                      self.RESTORED_DIAL_TIMEOUT
+            if state.get('start_time') is not None:
+                self._modem.timer.start(state['start_time'])
+            self.version = state.get('version', 0) + 1
+        finally:
+            self._release()
+
+
+class StateFile(object):
+
+    """Saves the ModemProxy's state so that the server can restart.
+
+    The state is saved whenever it changes (the StateFile observes
+    the proxy). It is written to a temporary file which is renamed
+    over the old one, so the file is never left half written. State
+    that is more than MAX_AGE seconds old is ignored, as the clients
+    would have given up on the server by then. So that a long quiet
+    spell doesn't make the state look old, heartbeat() saves it again
+    every HEARTBEAT_PERIOD seconds while any clients are connected.
+
+    Only one thread saves at a time. Changes made while it's saving
+    are left for that thread to save once it's finished, so a burst
+    of changes only costs a couple of saves, and an old state can't
+    be renamed over a newer one.
+
+    """
+
+    FORMAT = 1
+    MAX_AGE = ModemProxy.CLIENT_TIMEOUT  # seconds
+    HEARTBEAT_PERIOD = MAX_AGE / 3  # seconds
+
+    def __init__(self, path, modem_proxy):
+        self.path = path
+        self._modem_proxy = modem_proxy
+        self._save_lock = threading.Lock()
+        self._is_dirty = False
+        self._saved_at = None
+
+    def update(self):
+        """Called by the proxy when its state changes."""
+        self._is_dirty = True
+        while self._is_dirty and self._save_lock.acquire(False):
+            try:
+                self._is_dirty = False
+                try:
+                    self.save()
+                except (IOError, OSError), e:
+                    log.warn('Unable to save state: %s' % e)
+            finally:
+                self._save_lock.release()
+
+    def heartbeat(self):
+        """Save the state again if clients could still need it."""
+        if self._modem_proxy.count_clients() == 0:
+            return
+        if (self._saved_at is None or
+                time.time() - self._saved_at >= self.HEARTBEAT_PERIOD):
+            self.update()
+
+    def save(self):
+        saved_at = time.time()
+        data = marshal.dumps((self.FORMAT, saved_at,
+                              self._modem_proxy.get_state()))
+        replace_file(self.path, data, 0644)
+        self._saved_at = saved_at
+
+    def load(self):
+        """Return the saved state, or None if there isn't any."""
+        try:
+            f = open(self.path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return None
+        try:
+            format, saved_at, state = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            log.warn('Ignoring corrupt state file %s' % self.path)
+            return None
+        if format != self.FORMAT or not isinstance(state, dict):
+            return None
+        if not (0 <= time.time() - saved_at <= self.MAX_AGE):
+            return None
+        return state
+
+    def restore(self):
+        """Restore the proxy's saved state, then start saving it."""
+        state = self.load()
+        if state is not None:
+            log.info('Restoring state (%d clients)' %
+                     len(state.get('clients', [])))
+            self._modem_proxy.restore_state(state)
+        self._modem_proxy.add_observer(self)
+
+
+class StateFileThread(threading.Thread):
+
+    """Calls a StateFile's heartbeat() from its own thread."""
+
+    def __init__(self, state_file):
+        threading.Thread.__init__(self)
+        self._state_file = state_file
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('StateFile')
+
+    def run(self):
+        while not self.finished.isSet():
+            self._state_file.heartbeat()
+            self.finished.wait(self._state_file.HEARTBEAT_PERIOD)
+
+
+class AccountingLog(object):
+
+    """Records how long each client has used the connection.
+
+    A session runs from the moment the proxy hears from a client to
+    the moment the client disconnects (or, if it expires, was last
+    seen). When a session ends a fixed size record of the client, the
+    start and the stop time is appended to the "sessions" file in
+    directory. Client IDs are stored once, in the "clients" file,
+    and referred to by number.
+
+    Two small indexes keep queries fast however long the log grows.
+    The "days" file records the first session that ended on each day
+    (UTC), so a query for a range of time only reads the records for
+    the days it covers. A session is recorded when it ends, or (if
+    the client expired) a little later, so a record may follow the
+    first record of the next day; queries read an extra day of
+    records to allow for it. The "totals" file holds the number of
+    sessions and seconds used by each client, so totals for all time
+    don't involve reading the log at all. It is saved every
+    SAVE_INTERVAL sessions and when the log is closed, and the
+    sessions recorded since it was saved are added to it when the log
+    is next opened.
+
+    """
+
+    RECORD = '!III'  # client number, start, stop
+    DAY = '!II'  # day, number of the first record that ended on it
+    SECONDS_PER_DAY = 24 * 60 * 60
+    FORMAT = 1
+    SAVE_INTERVAL = 100  # sessions
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._record_size = struct.calcsize(self.RECORD)
+        self._client_ids = []  # client number -> client ID
+        self._client_numbers = {}  # client ID -> client number
+        self._days = []  # days on which sessions ended, in order
+        self._first_records = []  # number of first record for each day
+        self._count = 0  # records in the log
+        self._totals = {}  # client number -> [sessions, seconds]
+        self._saved_count = 0  # records included in the totals file
+        self._open_sessions = {}  # client ID -> start time
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._sessions_fd = os.open(self._get_path('sessions'),
+                                    os.O_RDWR | os.O_APPEND | os.O_CREAT,
+                                    0644)
+        set_close_on_exec(self._sessions_fd)
+        self._load()
+
+    def _get_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_file(self, name):
+        try:
+            f = open(self._get_path(name), 'rb')
+        except IOError:
+            return ''
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _append_file(self, name, data):
+        f = open(self._get_path(name), 'ab')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def _load(self):
+        for line in self._read_file('clients').splitlines():
+            client_id = line.decode('string_escape')
+            self._client_numbers[client_id] = len(self._client_ids)
+            self._client_ids.append(client_id)
+        data = self._read_file('days')
+        size = struct.calcsize(self.DAY)
+        for offset in range(0, len(data) - size + 1, size):
+            day, first_record = struct.unpack(self.DAY,
+                                              data[offset:offset + size])
+            self._days.append(day)
+            self._first_records.append(first_record)
+        length = os.fstat(self._sessions_fd).st_size
+        if length % self._record_size:  # we died while appending
+            length -= length % self._record_size
+            os.ftruncate(self._sessions_fd, length)
+        self._count = length / self._record_size
+        count = 0
+        try:
+            format, count, totals = marshal.loads(self._read_file('totals'))
+            if format == self.FORMAT and count <= self._count:
+                self._totals = totals
+            else:
+                count = 0
+        except (EOFError, ValueError, TypeError):
+            pass
+        for client, start, stop in self._read_records(count, self._count):
+            self._add_to_totals(client, start, stop)
+        self._saved_count = count
+        while self._days and self._first_records[-1] > self._count:
+            del self._days[-1]
+            del self._first_records[-1]
+
+    def _read_records(self, first, last):
+        """Return the records numbered from first up to (not) last."""
+        if last <= first:
+            return []
+        size = self._record_size
+        os.lseek(self._sessions_fd, first * size, 0)
+        length = (last - first) * size
+        chunks = []
+        while length > 0:
+            chunk = os.read(self._sessions_fd, min(length, 65536))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length -= len(chunk)
+        data = ''.join(chunks)
+        return [struct.unpack(self.RECORD, data[i:i + size])
+                for i in range(0, len(data) - size + 1, size)]
+
+    def _add_to_totals(self, client, start, stop):
+        totals = self._totals.setdefault(client, [0, 0])
+        totals[0] += 1
+        totals[1] += stop - start
+
+    def _get_client_number(self, client_id):
+        number = self._client_numbers.get(client_id)
+        if number is None:
+            self._append_file('clients',
+                              client_id.encode('string_escape') + '\n')
+            number = len(self._client_ids)
+            self._client_ids.append(client_id)
+            self._client_numbers[client_id] = number
+        return number
+
+    def _save_totals(self):
+        replace_file(self._get_path('totals'),
+                     marshal.dumps((self.FORMAT, self._count, self._totals)),
+                     0644)
+        self._saved_count = self._count
+
+    def _append_session(self, client_id, start, stop):
+        client = self._get_client_number(client_id)
+        stop = max(stop, start)
+        day = stop / self.SECONDS_PER_DAY
+        if not self._days or day > self._days[-1]:
+            self._append_file('days', struct.pack(self.DAY, day, self._count))
+            self._days.append(day)
+            self._first_records.append(self._count)
+        os.write(self._sessions_fd,
+                 struct.pack(self.RECORD, client, start, stop))
+        self._count += 1
+        self._add_to_totals(client, start, stop)
+        if self._count - self._saved_count >= self.SAVE_INTERVAL:
+            self._save_totals()
+
+    def _normalise(self, client_id):
+        if isinstance(client_id, unicode):
+            return client_id.encode('utf-8')
+        return client_id
+
+    def start_session(self, client_id, started_at=None):
+        """Record that a client has started to use the connection."""
+        if started_at is None:
+            started_at = time.time()
+        client_id = self._normalise(client_id)
+        self._lock.acquire()
+        try:
+            self._open_sessions.setdefault(client_id, int(started_at))
+        finally:
+            self._lock.release()
+
+    def stop_session(self, client_id, stopped_at=None):
+        """Record that a client has finished using the connection."""
+        if stopped_at is None:
+            stopped_at = time.time()
+        client_id = self._normalise(client_id)
+        self._lock.acquire()
+        try:
+            start = self._open_sessions.pop(client_id, None)
+            if start is None:
+                return
+            try:
+                self._append_session(client_id, start, int(stopped_at))
+            except (IOError, OSError), e:
+                log.warn('Unable to record session for %s: %s' %
+                         (client_id, e))
+        finally:
+            self._lock.release()
+
+    def get_open_sessions(self):
+        """Return a dict of the start time of each session in progress."""
+        self._lock.acquire()
+        try:
+            return self._open_sessions.copy()
+        finally:
+            self._lock.release()
+
+    def _find_record(self, when):
+        # number of the first record that ended on or after when's day
+        index = bisect.bisect_left(self._days, when / self.SECONDS_PER_DAY)
+        if index == len(self._days):
+            return self._count
+        return self._first_records[index]
+
+    def get_usage(self, start=None, end=None):
+        """Return the usage of each client between start and end.
+
+        Sessions count towards the time in which they ended, and
+        sessions that are still in progress count as ending now. The
+        result is a dict of client ID to a list of the number of
+        sessions and the number of seconds used. Leave start or end as
+        None for no limit.
+
+        """
+        now = int(time.time())
+        self._lock.acquire()
+        try:
+            if start is None and end is None:
+                usage = {}
+                for client, (sessions, seconds) in self._totals.items():
+                    usage[self._client_ids[client]] = [sessions, seconds]
+            else:
+                first, last = 0, self._count
+                if start is not None:
+                    first = self._find_record(start)
+                if end is not None:
+                    last = self._find_record(end +
+                                             2 * self.SECONDS_PER_DAY)
+                usage = {}
+                for client, began, stopped in \
+                        self._read_records(first, last):
+                    if (start is None or stopped >= start) and \
+                           (end is None or stopped < end):
+                        totals = usage.setdefault(self._client_ids[client],
+                                                  [0, 0])
+                        totals[0] += 1
+                        totals[1] += stopped - began
+            if (start is None or now >= start) and (end is None or now < end):
+                for client_id, began in self._open_sessions.items():
+                    totals = usage.setdefault(client_id, [0, 0])
+                    totals[0] += 1
+                    totals[1] += max(now - began, 0)
+            return usage
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Save the totals and close the log."""
+        self._lock.acquire()
+        try:
+            if self._sessions_fd is None:
+                return
+            try:
+                self._save_totals()
+            except (IOError, OSError), e:
+                log.warn('Unable to save usage totals: %s' % e)
+            os.close(self._sessions_fd)
+            self._sessions_fd = None
+        finally:
+            self._lock.release()
+
+
+class TokenBucket(object):
+
+    """Allows rate events per second, in bursts of up to burst events."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._updated_at = time.time()
+
+    def _refill(self, now):
+        elapsed = max(now - self._updated_at, 0)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def take(self, now):
+        """Take a token, returning the seconds to wait if there are none.
+
+        Returns 0 if a token was taken.
+
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class RateLimiter(object):
+
+    """Limits how often clients can ask for the status.
+
+    Each client has a TokenBucket allowing client_rate requests per
+    second (in bursts of client_burst), and the server as a whole
+    allows rate requests per second (in bursts of burst). A rate of 0
+    means there is no limit. Requests that exceed either limit are
+    counted in the landialler_rate_limited_total metric.
+
+    Buckets are kept for at most MAX_CLIENTS clients. Once that many
+    clients are busy, new ones are only limited by the server's rate.
+
+    """
+
+    CLIENT_RATE = 2  # requests per second
+    CLIENT_BURST = 10
+    RATE = 100
+    BURST = 200
+    MAX_CLIENTS = 1024
+
+    def __init__(self, client_rate=CLIENT_RATE, client_burst=CLIENT_BURST,
+                 rate=RATE, burst=BURST):
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self._lock = threading.Lock()
+        self._buckets = {}  # client ID -> TokenBucket
+        self._bucket = None
+        if rate:
+            self._bucket = TokenBucket(rate, burst)
+
+    def _get_bucket(self, client_id, now):
+        bucket = self._buckets.get(client_id)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_CLIENTS:
+                self._forget_idle_clients(now)
+                if len(self._buckets) >= self.MAX_CLIENTS:
+                    return None
+            bucket = TokenBucket(self.client_rate, self.client_burst)
+            self._buckets[client_id] = bucket
+        return bucket
+
+    def _forget_idle_clients(self, now):
+        for client_id, bucket in self._buckets.items():
+            if bucket.is_full(now):
+                del self._buckets[client_id]
+
+    def count_clients(self):
+        return len(self._buckets)
+
+    def check(self, client_id):
+        """Return 0 if the client may make a request now.
+
+        Otherwise return the number of seconds that the client should
+        wait before trying again.
+
+        """
+        now = time.time()
+        retry_after = 0
+        self._lock.acquire()
+        try:
+            if self.client_rate:
+                bucket = self._get_bucket(client_id, now)
+                if bucket is not None:
+                    retry_after = bucket.take(now)
+                    scope = 'client'
+            if not retry_after and self._bucket is not None:
+                retry_after = self._bucket.take(now)
+                scope = 'server'
+        finally:
+            self._lock.release()
+        if retry_after:
+            metrics.increment('landialler_rate_limited_total',
+                              (('scope', scope),))
+        return retry_after
+
+
+class API(object):
+    
+    """Implements the LANdialler API.
+
+    All accessible methods in this class form a part of the LANdialler
+    XML-RPC API, and are called directly whenever a client makes an
+    HTTP request to the server.
+
+    Set rate_limiter to a RateLimiter to stop clients from asking for
+    the status too often. A client that exceeds the limit is sent
+    the last status that was sent to anybody (which costs almost
+    nothing to produce) rather than the current one.
+
+    Set accounting to the proxy's AccountingLog to let clients ask
+    how much each client has used the connection, and history to a
+    ConnectionHistory to let them draw graphs of its use.
+
+    """
+
+    MAX_WAIT = ModemProxy.CLIENT_TIMEOUT / 2  # seconds
+
+    rate_limiter = None
+    accounting = None
+    history = None
+
+    def __init__(self, modem_proxy, max_waiters=None, sampler=None):
+        """Limit concurrent calls to wait_for_status() to max_waiters.
+
+        Once max_waiters clients are waiting for the status to change
+        any further calls to wait_for_status() return immediately. By
+        default there is no limit. The sampler is the
+        ThroughputSampler used by get_throughput().
+
+        """
+        self._modem_proxy = modem_proxy
+        self._sampler = sampler
+        self._last_status = None
+        self._waiters = None
+        if max_waiters is not None:
+            self._waiters = threading.Semaphore(max_waiters)
+
+    def connect(self, client_id):
+        """Register this client and open the connection if necessary.
+
+        Always returns True.
+
+        """
+        log.info('%s connected' % client_id)
+        self._modem_proxy.add_client(client_id)
+        return xmlrpclib.True
+
+    def disconnect(self, client_id, all=xmlrpclib.False):
+        """Disconnect this client and/or close the connection.
+
+        Always returns True.
+
+        The client argument should uniquely identify the client, and
+        should be usable as a dictionary key.
+
+        """
+        message = '%s disconnected' % client_id
+        if bool(all):
+            message += ' (all users)'
+        log.info(message)
+        self._modem_proxy.remove_client(client_id)
+        if bool(all):
+            self._modem_proxy.disconnect()
+        return xmlrpclib.True
+                
+    def get_status(self, client_id):
+        """Returns the number of clients and connection status.
+
+        The values returned are:
+
+        current_clients    -- The number of users sharing the connection
+        is_connected       -- True if connected, False otherwise
+        seconds_connected  -- Number of seconds connected
+
+        If the client is asking too often the status may be out of
+        date. Unlike wait_for_status(), get_status() can't tell the
+        client how long to wait before asking again, as old clients
+        expect exactly three values; they just keep getting the last
+        status that was sent out until they slow down.
+
+        """
+        if self._get_retry_after(client_id):
+            # The status may be out of date, so it's returned as a list
+            # (rather than a tuple) to keep it out of the ResponseCache.
+            status = self._get_last_status()
+            return [status['current_clients'], status['is_connected'],
+                    status['seconds_connected']]
+        self._modem_proxy.refresh_client(client_id)
+        return (self._modem_proxy.count_clients(),
+                self._modem_proxy.is_connected(),
+                self._modem_proxy.get_time_connected())
+
+    def connect_and_get_status(self, client_id):
+        """Register this client, then return the status.
+
+        Saves the client a round trip when it starts up. The status
+        is returned in the same form as by wait_for_status().
+
+        """
+        self.connect(client_id)
+        return self._get_status()
+
+    def _get_status(self):
+        version, clients, is_connected, seconds, phase, links = \
+                 self._modem_proxy.get_status()
+        status = {'version': version,
+                  'current_clients': clients,
+                  'is_connected': is_connected,
+                  'seconds_connected': seconds,
+                  'phase': phase,
+                  'links': links}
+        self._last_status = status
+        return status
+
+    def _get_last_status(self):
+        status = self._last_status
+        if status is None:
+            return self._get_status()
+        status = status.copy()
+        status['seconds_connected'] = self._modem_proxy.get_time_connected()
+        return status
+
+    def _get_retry_after(self, client_id):
+        if self.rate_limiter is None:
+            return 0
+        return self.rate_limiter.check(client_id)
+
+    def wait_for_status(self, client_id, last_version, timeout):
+        """Wait for the status to change, then return it.
+
+        Returns as soon as the status version differs from
+        last_version, or after timeout seconds (which is limited to
+        MAX_WAIT). Like get_status(), this tells the server that the
+        client is still interested in the connection. The status is
+        returned as a struct containing:
+
+        version            -- Changes whenever any other field changes
+                              (apart from seconds_connected)
+        current_clients    -- The number of users sharing the connection
+        is_connected       -- True if connected, False otherwise
+        seconds_connected  -- Number of seconds connected
+        phase              -- "offline", "dialling", "online", "failed"
+                              (if the connect command failed) or
+                              "idle" (if we hung up because nobody
+                              was using the link)
+        links              -- A list of structs describing any extra
+                              links (see LinkPool.get_links())
+        retry_after        -- Only included if the client is asking
+                              too often, in which case the status may
+                              be out of date, and the client should
+                              wait this many seconds before asking
+                              again
+
+        """
+        retry_after = self._get_retry_after(client_id)
+        if retry_after:
+            status = self._get_last_status()
+            status['retry_after'] = retry_after
+            return status
+        proxy = self._modem_proxy
+        proxy.refresh_client(client_id)
+        timeout = min(timeout, self.MAX_WAIT)
+        if timeout > 0:
+            waiters = self._waiters
+            if waiters is None:
+                proxy.wait_for_change(last_version, timeout)
+            elif waiters.acquire(False):
+                try:
+                    proxy.wait_for_change(last_version, timeout)
+                finally:
+                    waiters.release()
+            proxy.refresh_client(client_id)
+        return self._get_status()
+
+    def get_throughput(self):
+        """Return the traffic passing over the link.
+
+        The rates are measured every period seconds. The values
+        returned in the struct are:
+
+        interface              -- The interface being measured
+        period                 -- Seconds between measurements
+        capacity               -- The link's speed in bytes per second
+                                  (0 if it hasn't been configured)
+        is_saturated           -- True if the link is running at (or
+                                  near to) its capacity
+        rx_bytes_per_second    -- Bytes received in the last period
+        tx_bytes_per_second    -- Bytes sent in the last period
+        rx_packets_per_second  -- Packets received in the last period
+        tx_packets_per_second  -- Packets sent in the last period
+        history                -- A list of [received, sent] bytes per
+                                  second over recent periods, oldest
+                                  first
+
+        """
+        if self._sampler is None:
+            raise xmlrpclib.Fault(1, 'throughput is not being measured')
+        return self._sampler.get_throughput()
+
+    def _get_usage(self, start, end):
+        if self.accounting is None:
+            raise xmlrpclib.Fault(1, 'usage is not being recorded')
+        return self.accounting.get_usage(start or None, end or None)
+
+    def get_usage(self, start=0, end=0):
+        """Return how much each client used the connection.
+
+        Sessions are counted in the period in which they ended;
+        sessions in progress count as ending now. Pass start and end
+        as seconds since the epoch (0 for no limit). Returns a list
+        of structs, each containing:
+
+        client_id  -- The client's ID
+        sessions   -- The number of sessions
+        seconds    -- The total length of the sessions
+
+        """
+        usage = []
+        for client_id, (sessions, seconds) in \
+                self._get_usage(start, end).items():
+            usage.append({'client_id': client_id, 'sessions': sessions,
+                          'seconds': seconds})
+        return usage
+
+    def get_client_usage(self, client_id, start=0, end=0):
+        """Return the usage of a single client, as get_usage() does."""
+        sessions, seconds = self._get_usage(start, end).get(client_id,
+                                                            (0, 0))
+        return {'client_id': client_id, 'sessions': sessions,
+                'seconds': seconds}
+
+    def get_history(self, resolution, since=0):
+        """Return averages of the connection's use over time.
+
+        The resolution is "minute", "hour" or "day". Periods that
+        ended before since (seconds since the epoch) are left out;
+        the last day is kept by the minute, the last month by the
+        hour and the last ten years by the day. The values returned
+        in the struct are:
+
+        resolution  -- The length of each period, in seconds
+        fields      -- The names of the values in each period
+        periods     -- A list of periods, oldest first, each a list
+                       of its start time followed by the average
+                       values in the order given by fields
+
+        """
+        if self.history is None:
+            raise xmlrpclib.Fault(1, 'history is not being kept')
+        try:
+            periods = self.history.get_history(resolution, since)
+        except KeyError:
+            raise xmlrpclib.Fault(1, 'unknown resolution: %s' % resolution)
+        return {'resolution': self.history.get_resolution(resolution),
+                'fields': ['start'] + list(self.history.FIELDS),
+                'periods': periods}
+
+
+class ResponseCache(object):
+
+    """Caches the marshalled responses to the status methods.
+
+    Between changes of state the status methods return the same value
+    to every client (only the number of seconds online moves on), so
+    the response to each method is marshalled once per version of the
+    proxy's status and once per second, rather than once per request.
+    The cache is emptied whenever the proxy's status changes.
+
+    """
+
+    METHODS = ('get_status', 'wait_for_status', 'connect_and_get_status')
+
+    def __init__(self, modem_proxy):
+        self._modem_proxy = modem_proxy
+        self._lock = threading.Lock()
+        self._responses = {}  # method -> (key, response)
+        modem_proxy.add_observer(self)
+
+    def update(self):
+        """Called by the proxy when its status changes."""
+        self._lock.acquire()
+        try:
+            self._responses.clear()
+        finally:
+            self._lock.release()
+
+    def is_cacheable(self, method):
+        return method in self.METHODS
+
+    def _get_key(self):
+        proxy = self._modem_proxy
+        return (proxy.version, proxy.get_time_connected())
+
+    def dispatch(self, method, params, dispatch_method):
+        """Call dispatch_method(method, params), returning marshalled XML.
+
+        The method is always called, as the status methods also tell
+        the proxy that the client is still interested. Its result is
+        only marshalled if the status has changed since the response
+        was last cached. Status structs carry their own version; for
+        other results, if the status changes while the method is
+        being called the result is marshalled but not cached.
+
+        Results given to clients that are asking too often may be out
+        of date, and are never cached. The API marks them by including
+        retry_after in a struct, or by returning a list.
+
+        """
+        key = self._get_key()
+        result = dispatch_method(method, params)
+        if isinstance(result, list):  # only for this client
+            return xmlrpclib.dumps((result,), methodresponse=1)
+        if isinstance(result, dict):
+            if 'retry_after' in result:  # only for this client
+                return xmlrpclib.dumps((result,), methodresponse=1)
+            key = (result['version'], result['seconds_connected'])
+        elif self._get_key() != key:
+            return xmlrpclib.dumps((result,), methodresponse=1)
+        self._lock.acquire()
+        try:
+            cached_key, response = self._responses.get(method, (None, None))
+            if cached_key != key:
+                response = xmlrpclib.dumps((result,), methodresponse=1)
+                self._responses[method] = (key, response)
+            return response
+        finally:
+            self._lock.release()
+
+
+class CachingDispatcher:
+
+    """Mixin for XML-RPC servers that serves responses from a cache.
+
+    Set response_cache to a ResponseCache to enable it. Calls to
+    other methods are dispatched in the usual way.
+
+    """
+
+    response_cache = None
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, *args):
+        cache = self.response_cache
+        try:
+            params, method = xmlrpclib.loads(data)
+        except:
+            cache = None
+        if cache is None or not cache.is_cacheable(method):
+            return SimpleXMLRPCServer.SimpleXMLRPCDispatcher.\
+                   _marshaled_dispatch(self, data, dispatch_method, *args)
+        if dispatch_method is None:
+            dispatch_method = self._dispatch
+        try:
+            return cache.dispatch(method, params, dispatch_method)
+        except xmlrpclib.Fault, fault:
+            return xmlrpclib.dumps(fault)
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            return xmlrpclib.dumps(
+                xmlrpclib.Fault(1, '%s:%s' % (exc_type, exc_value)))
+
+
+def record_request(method, seconds):
+    metrics.increment('landialler_requests_total', (('method', method),))
+    metrics.observe('landialler_request_duration_seconds', seconds,
+                    (('method', method),))
+
+
+class InstrumentedDispatcher:
+
+    """Mixin for XML-RPC servers that records the time taken by calls.
+
+    Calls to methods that the server doesn't provide are recorded as
+    "unknown", so that clients can't create any number of metrics.
+
+    """
+
+    _method_names = None  # forgotten whenever a method is registered
+
+    def register_function(self, function, name=None):
+        self._method_names = None
+        SimpleXMLRPCServer.SimpleXMLRPCDispatcher.register_function(
+            self, function, name)
+
+    def register_instance(self, instance, *args):
+        self._method_names = None
+        SimpleXMLRPCServer.SimpleXMLRPCDispatcher.register_instance(
+            self, instance, *args)
+
+    def register_introspection_functions(self):
+        self._method_names = None
+        SimpleXMLRPCServer.SimpleXMLRPCDispatcher.\
+            register_introspection_functions(self)
+
+    def register_multicall_functions(self):
+        self._method_names = None
+        SimpleXMLRPCServer.SimpleXMLRPCDispatcher.\
+            register_multicall_functions(self)
+
+    def _get_method_label(self, method):
+        if self._method_names is None:
+            self._method_names = self.system_listMethods()
+        if method in self._method_names:
+            return str(method)  # xmlrpclib returns unicode method names
+        return 'unknown'
+
+    def _dispatch(self, method, params):
+        started = time.time()
+        label = self._get_method_label(method)
+        try:
+            return profiler.call(
+                label, SimpleXMLRPCServer.SimpleXMLRPCDispatcher._dispatch,
+                self, method, params)
+        finally:
+            record_request(label, time.time() - started)
+
+
+class AutoDisconnectThread(threading.Thread):
+
+    """Forgets clients that have gone away.
+
+    The thread sleeps until the next client is due to expire, rather
+    than checking at regular intervals.
+
+    """
+
+    def __init__(self, modem_proxy):
+        threading.Thread.__init__(self)
+        self._modem_proxy = modem_proxy
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('AutoDisconnect')
+
+    def run(self):
+        proxy = self._modem_proxy
+        while not self.finished.isSet():
+            profiler.call('remove_old_clients', proxy.remove_old_clients)
+            self.finished.wait(proxy.seconds_until_expiry())
+
+
+class IdleDetector(object):
+
+    """Hangs up when nobody has used the link for a while.
+
+    The detector watches a ThroughputSampler. While the link is up,
+    each sample in which fewer than threshold bytes per second pass
+    over it (in both directions together) counts as idle. If the
+    link is idle for window seconds the proxy hangs up, even though
+    clients are still connected (they may just have been left
+    running), and reports the IDLE phase until somebody dials again.
+    Set window to None to keep the link up.
+
+    """
+
+    THRESHOLD = 256  # bytes per second
+
+    def __init__(self, modem_proxy, sampler, threshold=THRESHOLD,
+                 window=None):
+        self._modem_proxy = modem_proxy
+        self._sampler = sampler
+        self.threshold = threshold
+        self.window = window
+        self._idle_since = None
+        sampler.add_observer(self)
+
+    def update(self):
+        """Called by the sampler after each sample."""
+        if self.window is None or not self._modem_proxy.is_connected():
+            self._idle_since = None
+            return
+        now = time.time()
+        received, sent = self._sampler.get_samples(1)[-1][:2]
+        if received + sent >= self.threshold or self._idle_since is None:
+            self._idle_since = now
+        elif (now - self._idle_since) >= self.window:
+            log.info('Link idle for %d seconds, disconnecting' %
+                     (now - self._idle_since))
+            metrics.increment('landialler_idle_disconnects_total')
+            self._idle_since = None
+            self._modem_proxy.disconnect(is_idle=True)
+
+
+class HistoryTier(object):
+
+    """A ring of averages of the samples taken in each period.
+
+    Samples are added to a running total for the current period
+    (resolution seconds long). When a sample arrives for a later
+    period the averages are stored in the ring, which holds the last
+    size periods. The ring is kept in arrays allocated up front, so
+    its memory use never grows.
+
+    """
+
+    def __init__(self, resolution, size, fields):
+        self.resolution = resolution
+        self._starts = array.array('d', [0.0]) * size
+        self._averages = [array.array('f', [0.0]) * size
+                          for i in range(fields)]
+        self._next = 0
+        self._count = 0
+        self._period = None  # start of the period being summed
+        self._sums = [0.0] * fields
+        self._samples = 0
+
+    def __len__(self):
+        return self._count
+
+    def _store(self):
+        if not self._samples:
+            return
+        index = self._next
+        self._starts[index] = self._period
+        for averages, total in zip(self._averages, self._sums):
+            averages[index] = total / self._samples
+        self._next = (index + 1) % len(self._starts)
+        self._count = min(self._count + 1, len(self._starts))
+        self._sums = [0.0] * len(self._sums)
+        self._samples = 0
+
+    def add(self, now, values):
+        period = now - (now % self.resolution)
+        if self._period is None or period > self._period:
+            self._store()
+            self._period = period
+        for i in range(len(values)):
+            self._sums[i] += values[i]
+        self._samples += 1
+
+    def _get_index(self, position):
+        # convert a position (0 is the oldest period) to an index
+        return (self._next - self._count + position) % len(self._starts)
+
+    def _find(self, since):
+        # position of the first period that ends after since
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) / 2
+            start = self._starts[self._get_index(middle)]
+            if start + self.resolution <= since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get_periods(self, since=0):
+        """Return the periods that ended after since, oldest first.
+
+        Each period is a list of its start time followed by the
+        averages. The period in progress is included, so that the
+        most recent samples are never missing.
+
+        """
+        periods = []
+        for position in range(self._find(since), self._count):
+            index = self._get_index(position)
+            periods.append([int(self._starts[index])] +
+                           [averages[index] for averages in self._averages])
+        if self._samples and self._period + self.resolution > since:
+            periods.append([int(self._period)] +
+                           [total / self._samples for total in self._sums])
+        return periods
+
+
+class ConnectionHistory(object):
+
+    """Keeps a history of the link, the clients and the traffic.
+
+    After each sample taken by the ThroughputSampler the state of the
+    link (1 if up, 0 if down), the number of clients and the bytes
+    received and sent per second are added to one HistoryTier for
+    each of the RESOLUTIONS, so that the last day can be graphed a
+    minute at a time and the last ten years a day at a time, in a
+    fixed amount of memory.
+
+    """
+
+    FIELDS = ('link_up', 'clients', 'rx_bytes_per_second',
+              'tx_bytes_per_second')
+    RESOLUTIONS = (('minute', 60, 24 * 60),  # name, seconds, periods kept
+                   ('hour', 60 * 60, 31 * 24),
+                   ('day', 24 * 60 * 60, 10 * 366))
+
+    def __init__(self, modem_proxy, sampler, resolutions=RESOLUTIONS):
+        self._modem_proxy = modem_proxy
+        self._sampler = sampler
+        self._lock = threading.Lock()
+        self._tiers = {}
+        for name, resolution, size in resolutions:
+            self._tiers[name] = HistoryTier(resolution, size,
+                                            len(self.FIELDS))
+        sampler.add_observer(self)
+
+    def update(self):
+        """Called by the sampler after each sample."""
+        received, sent = self._sampler.get_samples(1)[-1][:2]
+        values = (int(self._modem_proxy.is_connected()),
+                  self._modem_proxy.count_clients(), received, sent)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for tier in self._tiers.values():
+                tier.add(now, values)
+        finally:
+            self._lock.release()
+
+    def get_history(self, resolution, since=0):
+        """Return the periods of the given resolution since a time.
+
+        See API.get_history(). Raises KeyError if there is no such
+        resolution.
+
+        """
+        tier = self._tiers[resolution]
+        self._lock.acquire()
+        try:
+            return tier.get_periods(since)
+        finally:
+            self._lock.release()
+
+    def get_resolution(self, resolution):
+        """Return the length of the named resolution's periods."""
+        return self._tiers[resolution].resolution
+
+
+METRICS_PATH = '/metrics'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+LISTEN_FDS_START = 3
+
+# Python 2 doesn't define SO_DOMAIN; this is its value on Linux
+SO_DOMAIN = getattr(socket, 'SO_DOMAIN', None)
+if SO_DOMAIN is None and sys.platform.startswith('linux'):
+    SO_DOMAIN = 39
+
+
+def set_close_on_exec(fd, close_on_exec=True):
+    if fcntl is None:
+        return
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if close_on_exec:
+        flags |= fcntl.FD_CLOEXEC
+    else:
+        flags &= ~fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+
+def get_inherited_socket(environ=os.environ):
+    """Return the listening socket passed to us on startup, or None.
+
+    Follows systemd's convention for socket activation; LISTEN_PID
+    holds our process ID, and LISTEN_FDS the number of sockets passed
+    (starting at file descriptor 3). Only the first socket is used.
+
+    """
+    try:
+        pid = int(environ.get('LISTEN_PID', ''))
+        count = int(environ.get('LISTEN_FDS', ''))
+    except ValueError:
+        return None
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        if name in environ:
+            del environ[name]  # don't pass them on to our commands
+    if pid != os.getpid() or count < 1:
+        return None
+    sock = socket_from_fd(LISTEN_FDS_START)
+    os.close(LISTEN_FDS_START)
+    set_close_on_exec(sock.fileno())
+    return sock
+
+
+def socket_from_fd(fd):
+    """Return a socket object for a copy of the descriptor fd.
+
+    fromfd() has to be told the socket's family and type, so we ask
+    the socket itself (on platforms where we know how to ask for the
+    family; elsewhere it's assumed to be AF_INET). Raises ValueError
+    unless it's an IPv4 or IPv6 stream socket.
+
+    """
+    families = [socket.AF_INET]
+    if hasattr(socket, 'AF_INET6'):
+        families.append(socket.AF_INET6)
+    try:
+        probe = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock_type = probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+            family = socket.AF_INET
+            if SO_DOMAIN is not None:
+                family = probe.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+        finally:
+            probe.close()
+    except socket.error, e:
+        raise ValueError('descriptor %d is not a socket: %s' % (fd, e))
+    if sock_type != socket.SOCK_STREAM or family not in families:
+        raise ValueError('socket %d is not a TCP socket (family %d, '
+                         'type %d)' % (fd, family, sock_type))
+    # fromfd() returns a bare _socket.socket, whose makefile() doesn't
+    # cope with timeouts, so we wrap it like socket.socket() does
+    return socket.socket(_sock=socket.fromfd(fd, family, sock_type))
+
+
+class ReusableSimpleXMLRPCServer(SimpleXMLRPCServer.SimpleXMLRPCServer):
+
+    """Reuses the address, or a socket that's already listening.
+
+    Set listening_socket before calling the constructor to serve
+    from a socket that has already been bound (see
+    get_inherited_socket()).
+
+    """
+
+    allow_reuse_address = True
+    listening_socket = None
+
+    def server_bind(self):
+        if self.listening_socket is None:
+            SimpleXMLRPCServer.SimpleXMLRPCServer.server_bind(self)
+        else:
+            self.socket.close()
+            self.socket = self.listening_socket
+            self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        if self.listening_socket is None:
+            SimpleXMLRPCServer.SimpleXMLRPCServer.server_activate(self)
+
+
+def get_wait_params(body):
+    """Return the parameters if body is a call to wait_for_status().
+
+    Returns None for any other request, or if body can't be parsed.
+
+    """
+    try:
+        params, method = xmlrpclib.loads(body)
+    except:
+        return None
+    if method != 'wait_for_status' or len(params) != 3:
+        return None
+    return params
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+
+    """Handles a single request on a persistent HTTP/1.1 connection.
+
+    Rather than waiting for the client's next request, the handler
+    returns as soon as it has sent its response. The server watches
+    the connection while it's idle, freeing up the worker thread.
+
+    Calls to wait_for_status() are handed to the server (see
+    PooledXMLRPCServer.defer_request()) without being answered, in
+    which case is_deferred is set.
+
+    """
+
+    protocol_version = 'HTTP/1.1'
+    MAX_REQUEST_SIZE = 64 * 1024  # bytes
+    is_deferred = False
+
+    def setup(self):
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.setup(self)
+        self.connection.settimeout(self.server.keepalive_timeout)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('content-length'))
+        except (TypeError, ValueError):
+            length = None
+        if length is not None and 0 <= length <= self.MAX_REQUEST_SIZE:
+            data = self.rfile.read(length)
+            if self.server.defer_request(self, data):
+                self.is_deferred = True
+                return
+            self.rfile = StringIO.StringIO(data)  # read it again
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def do_GET(self):
+        """Serve the metrics (to Prometheus) from /metrics."""
+        if self.path != METRICS_PATH:
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DeferredRequest(object):
+
+    """A wait_for_status() request that a PooledXMLRPCServer has parked.
+
+    The StatusWaiters send the response with send_result() once it's
+    ready, from whichever thread they're called by. The connection is
+    then handed back to the server, as if a worker had answered it.
+
+    """
+
+    def __init__(self, server, request, client_address, keep_alive):
+        self._server = server
+        self.request = request
+        self.client_address = client_address
+        self.keep_alive = keep_alive
+
+    def send_result(self, response):
+        headers = ['HTTP/1.1 200 OK',
+                   'Content-Type: text/xml',
+                   'Content-Length: %d' % len(response)]
+        if not self.keep_alive:
+            headers.append('Connection: close')
+        try:
+            self.request.sendall('\r\n'.join(headers) + '\r\n\r\n' +
+                                 response)
+        except socket.error:
+            self.keep_alive = False
+        self._server.finish_deferred(self)
+
+    def close(self):
+        self.keep_alive = False
+        self._server.finish_deferred(self)
+
+
+class PooledXMLRPCServer(CachingDispatcher, InstrumentedDispatcher,
+                         ReusableSimpleXMLRPCServer):
+
+    """Handles requests with a fixed size pool of worker threads.
+
+    Accepted connections are queued for the workers. The queue holds
+    at most backlog connections; when it is full the server stops
+    accepting until a worker becomes free, leaving any other clients
+    waiting in the kernel's listen queue (which is the same size).
+
+    Connections that the client wants to keep open are handed back to
+    the server's own thread between requests, and are closed if they
+    remain idle for keepalive_timeout seconds.
+
+    The pool can be resized while the server is running, with
+    set_workers() and set_backlog(). Surplus workers are retired by
+    counting them off rather than by queueing anything for them, so
+    resizing never waits for room in the queue.
+
+    Calls to wait_for_status() are handed to status_waiters (if it
+    has been set), so that clients waiting for the status to change
+    don't hold on to a worker. The server's thread expires them.
+
+    """
+
+    status_waiters = None
+
+    WORKERS = 4
+    BACKLOG = 16
+    KEEPALIVE_TIMEOUT = 15  # seconds
+    POLL_PERIOD = 0.5
+
+    def __init__(self, addr, workers=WORKERS, backlog=BACKLOG,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, logRequests=False,
+                 listening_socket=None):
+        self.request_queue_size = backlog
+        self.listening_socket = listening_socket
+        self.keepalive_timeout = keepalive_timeout
+        ReusableSimpleXMLRPCServer.__init__(self, addr,
+                                            KeepAliveRequestHandler,
+                                            logRequests)
+        self._idle = {}  # socket -> (client address, time parked)
+        self._deferred = {}  # DeferredRequest -> None
+        self._idle_lock = threading.Lock()
+        self._wakeup_fds = os.pipe()
+        self._is_closing = False
+        self._is_serving = False
+        self._has_stopped = threading.Event()
+        self._has_stopped.set()
+        self._requests = []  # (request, client address)
+        self._backlog = backlog
+        self._retiring = 0  # workers that should exit when idle
+        self._queue_changed = threading.Condition(threading.Lock())
+        self._workers = []
+        self._workers_started = 0
+        self.workers = 0
+        self.set_workers(workers)
+
+    def _start_worker(self):
+        self._workers_started += 1
+        worker = threading.Thread(target=self._work,
+                                  name='Worker-%d' % self._workers_started)
+        worker.setDaemon(True)
+        worker.start()
+        self._workers.append(worker)
+
+    def set_workers(self, workers):
+        """Start or stop workers, so that there are workers in the pool.
+
+        Surplus workers exit once there are no requests left for them.
+
+        """
+        self._workers = [w for w in self._workers if w.isAlive()]
+        self._queue_changed.acquire()
+        try:
+            change = workers - self.workers
+            if change > 0:
+                reprieved = min(change, self._retiring)
+                self._retiring -= reprieved
+                change -= reprieved
+            else:
+                self._retiring -= change
+                self._queue_changed.notifyAll()
+            self.workers = workers
+        finally:
+            self._queue_changed.release()
+        for i in range(change):
+            self._start_worker()
+
+    def _retire_workers(self):
+        self._queue_changed.acquire()
+        try:
+            self._retiring += self.workers
+            self._queue_changed.notifyAll()
+        finally:
+            self._queue_changed.release()
+
+    def set_backlog(self, backlog):
+        """Change the number of connections queued for the workers."""
+        self._queue_changed.acquire()
+        try:
+            self._backlog = backlog
+            self._queue_changed.notifyAll()
+        finally:
+            self._queue_changed.release()
+        self.socket.listen(backlog)
+
+    def process_request(self, request, client_address):
+        self._queue_changed.acquire()
+        try:
+            while len(self._requests) >= self._backlog:
+                self._queue_changed.wait()
+            self._requests.append((request, client_address))
+            self._queue_changed.notifyAll()
+        finally:
+            self._queue_changed.release()
+
+    def _get_request(self):
+        """Return the next request, or None if the worker should exit."""
+        self._queue_changed.acquire()
+        try:
+            while not self._requests:
+                if self._retiring > 0:
+                    self._retiring -= 1
+                    return None
+                self._queue_changed.wait()
+            request = self._requests.pop(0)
+            self._queue_changed.notifyAll()
+            return request
+        finally:
+            self._queue_changed.release()
+
+    def _work(self):
+        while True:
+            item = self._get_request()
+            if item is None:
+                break
+            request, client_address = item
+            keep_alive = False
+            try:
+                handler = self.RequestHandlerClass(request, client_address,
+                                                   self)
+                if handler.is_deferred:
+                    continue  # finish_deferred() will park or close it
+                keep_alive = not handler.close_connection
+            except:
+                self.handle_error(request, client_address)
+            if keep_alive:
+                self._park(request, client_address)
+            else:
+                self.close_request(request)
+
+    def _wake_up(self):
+        fds = self._wakeup_fds
+        if fds is not None:
+            os.write(fds[1], 'x')
+
+    def _park(self, request, client_address):
+        self._idle_lock.acquire()
+        try:
+            if self._is_closing:
+                self.close_request(request)
+                return
+            self._idle[request] = (client_address, time.time())
+            # while we hold the lock server_close() can't close the pipe
+            self._wake_up()
+        finally:
+            self._idle_lock.release()
+
+    def defer_request(self, handler, body):
+        """Hand a wait_for_status() request to the status_waiters.
 
-    def info(self, msg):
-        syslog.syslog(syslog.LOG_INFO, msg)
+        Returns False (leaving the handler to answer the request) if
+        body isn't a call to wait_for_status(), or if there are no
+        status_waiters.
 
-    def warn(self, msg):
-        syslog.syslog(syslog.LOG_WARNING, msg)
-        
-    def error(self, msg):
-        syslog.syslog(syslog.LOG_ERR, msg)
+        """
+        if self.status_waiters is None:
+            return False
+        params = get_wait_params(body)
+        if params is None:
+            return False
+        deferred = DeferredRequest(self, handler.request,
+                                   handler.client_address,
+                                   not handler.close_connection)
+        self._idle_lock.acquire()
+        try:
+            if self._is_closing:
+                return False
+            self._deferred[deferred] = None
+        finally:
+            self._idle_lock.release()
+        self.status_waiters.add(deferred, params)
+        return True
+
+    def finish_deferred(self, deferred):
+        """Park or close a deferred request's connection once answered."""
+        self._idle_lock.acquire()
+        try:
+            if deferred not in self._deferred:
+                return  # closed by server_close()
+            del self._deferred[deferred]
+        finally:
+            self._idle_lock.release()
+        if deferred.keep_alive:
+            self._park(deferred.request, deferred.client_address)
+        else:
+            self.close_request(deferred.request)
 
+    def _resume(self, request):
+        self._idle_lock.acquire()
+        try:
+            client_address, parked_at = self._idle.pop(request)
+        finally:
+            self._idle_lock.release()
+        self.process_request(request, client_address)
 
-log = Logger()
+    def _close_idle_connections(self):
+        now = time.time()
+        self._idle_lock.acquire()
+        try:
+            for request, (client_address, parked_at) in self._idle.items():
+                if (now - parked_at) > self.keepalive_timeout:
+                    del self._idle[request]
+                    self.close_request(request)
+        finally:
+            self._idle_lock.release()
 
+    def _accept(self):
+        try:
+            request, client_address = self.get_request()
+        except socket.error:
+            return
+        if self.verify_request(request, client_address):
+            self.process_request(request, client_address)
+        else:
+            self.close_request(request)
 
-class Timer(object):
+    def serve_forever(self):
+        self._is_serving = True
+        self._has_stopped.clear()
+        try:
+            self._serve()
+        finally:
+            self._has_stopped.set()
 
-    """Simple timer class to record elapsed times."""
+    def _wait_for_input(self, inputs):
+        """Return the inputs (sockets or descriptors) that are readable.
 
-    def __init__(self):
-        """Run the start() method."""
-        self._start_time = None  # seconds since epoch
-        self._stop_time = None
-        self.reset()
-        self.is_running = False
+        Uses poll() where the platform has it, as select() can't watch
+        descriptors numbered FD_SETSIZE (usually 1024) or above, which
+        would limit the number of idle keep-alive connections.
 
-    def start(self):
-        """Start the timer."""
-        self._start_time = time.time()
-        self.is_running = True
+        """
+        if not hasattr(select, 'poll'):
+            return select.select(inputs, [], [], self.POLL_PERIOD)[0]
+        poller = select.poll()
+        by_fd = {}
+        for item in inputs:
+            if isinstance(item, int):
+                fd = item
+            else:
+                fd = item.fileno()
+            by_fd[fd] = item
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        events = poller.poll(int(self.POLL_PERIOD * 1000))
+        return [by_fd[fd] for fd, event in events]
+
+    def _serve(self):
+        wakeup = self._wakeup_fds[0]
+        while self._is_serving:
+            self._idle_lock.acquire()
+            try:
+                idle = self._idle.keys()
+            finally:
+                self._idle_lock.release()
+            try:
+                readable = self._wait_for_input([self.socket, wakeup] + idle)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for ready in readable:
+                if ready is self.socket:
+                    self._accept()
+                elif ready == wakeup:
+                    os.read(wakeup, 512)
+                else:
+                    self._resume(ready)
+            self._close_idle_connections()
+            if self.status_waiters is not None:
+                self.status_waiters.expire()
 
     def stop(self):
-        """Stop the timer."""
-        self._stop_time = time.time()
-        self.is_running = False
+        """Ask serve_forever() to return (e.g. from a signal handler)."""
+        self._is_serving = False
+        self._wake_up()
 
-    def reset(self):
-        """Reset the timer to zero.
+    def shutdown(self):
+        """Stop serve_forever(), waiting for it to return."""
+        self.stop()
+        self._has_stopped.wait()
 
-        Note that reset() neither stops or starts the timer.
+    def finish_requests(self, timeout):
+        """Wait for the workers to handle the requests they've been given.
+
+        Call once serve_forever() has returned. The workers exit once
+        they've finished.
 
         """
-        self._start_time = time.time()
-        self._stop_time = time.time()
+        self._retire_workers()
+        deadline = time.time() + timeout
+        for worker in self._workers:
+            worker.join(max(deadline - time.time(), 0))
 
-    def _get_elapsed_seconds(self):
-        """Return seconds since timer started."""
-        if self.is_running:
-            return int('%.0f' % (time.time() - self._start_time))
-        else:
-            return int('%.0f' % (self._stop_time - self._start_time))
+    def server_close(self):
+        """Close the server's sockets.
 
-    elapsed_seconds = property(_get_elapsed_seconds)
+        Workers that are still handling a request close its connection
+        when they finish, rather than parking it.
 
+        """
+        self._idle_lock.acquire()
+        try:
+            self._is_closing = True
+            idle = self._idle.keys()
+            self._idle.clear()
+            for deferred in self._deferred.keys():
+                idle.append(deferred.request)
+                if self.status_waiters is not None:
+                    self.status_waiters.remove(deferred)
+            self._deferred.clear()
+            wakeup_fds, self._wakeup_fds = self._wakeup_fds, None
+        finally:
+            self._idle_lock.release()
+        self._retire_workers()
+        for request in idle:
+            self.close_request(request)
+        ReusableSimpleXMLRPCServer.server_close(self)
+        for fd in wakeup_fds:
+            os.close(fd)
 
-class Modem(object):
 
-    def __init__(self, config_parser):
-        self._config_parser = config_parser
-        self.timer = Timer()
+class EventLoop(object):
 
-    def connect(self):
-        log.info('Connecting')
-        self.timer.reset()
-        os.system(self._config_parser.get('commands', 'connect'))
+    """Runs the asyncore loop along with scheduled tasks.
 
-    def disconnect(self):
-        log.info('Disconnecting, online for %s seconds' %
-                 self.timer.elapsed_seconds)
-        self.timer.stop()
-        os.system(self._config_parser.get('commands', 'disconnect'))
+    The loop uses poll() where the platform has it, as select() can't
+    watch descriptors numbered FD_SETSIZE (usually 1024) or above,
+    which would limit the number of idle keep-alive connections.
 
-    def is_connected(self):
-        rval = os.system(self._config_parser.get('commands', 'is_connected'))
-        if rval == 0:
-            if not self.timer.is_running:
-                self.timer.start()
-            return True
+    """
+
+    MAX_TIMEOUT = 30  # seconds
+
+    def __init__(self):
+        self._tasks = []  # heap of (when, sequence number, callback)
+        self._sequence = 0
+        self._is_running = False
+
+    def call_later(self, delay, callback):
+        self._sequence += 1
+        heapq.heappush(self._tasks,
+                       (time.time() + delay, self._sequence, callback))
+
+    def call_every(self, period, callback):
+        """Call callback now, and every period seconds thereafter.
+
+        The period may be a function that returns the number of
+        seconds, so that it can be changed while the task is running.
+
+        """
+
+        def task():
+            try:
+                callback()
+            finally:
+                if callable(period):
+                    self.call_later(period(), task)
+                else:
+                    self.call_later(period, task)
+
+        self.call_later(0, task)
+
+    def _run_due_tasks(self):
+        now = time.time()
+        while self._tasks and self._tasks[0][0] <= now:
+            when, sequence, callback = heapq.heappop(self._tasks)
+            try:
+                callback()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                log.error('Scheduled task failed: %s' %
+                          format_exception())
+
+    def _get_timeout(self):
+        if not self._tasks:
+            return self.MAX_TIMEOUT
+        delay = self._tasks[0][0] - time.time()
+        return max(0, min(delay, self.MAX_TIMEOUT))
+
+    def stop(self):
+        self._is_running = False
+
+    def run(self):
+        self._is_running = True
+        while self._is_running:
+            if hasattr(select, 'poll'):
+                asyncore.poll2(self._get_timeout())
+            else:
+                asyncore.poll(self._get_timeout())
+            self._run_due_tasks()
+
+
+class XMLRPCChannel(asynchat.async_chat):
+
+    """Reads HTTP requests from a client and dispatches them.
+
+    Persistent HTTP/1.1 connections are supported, so a client may
+    send any number of requests over the same channel.
+
+    """
+
+    MAX_REQUEST_SIZE = 64 * 1024  # bytes
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock)
+        self._server = server
+        self._keep_alive = False
+        self.is_waiting = False
+        self.last_active = time.time()
+        self._reset()
+
+    def _reset(self):
+        self._data = []
+        self._headers = None
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self._data.append(data)
+        self.last_active = time.time()
+
+    def found_terminator(self):
+        data = ''.join(self._data)
+        self._data = []
+        if self._headers is None:
+            self._read_headers(data)
         else:
-            return False
+            self._handle_request(data)
+
+    def _read_headers(self, data):
+        lines = data.split('\r\n')
+        try:
+            method, path, version = lines[0].split()
+        except ValueError:
+            self._send_error(400, 'Bad Request')
+            return
+        self._headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                self._headers[name.strip().lower()] = value.strip()
+        connection = self._headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self._keep_alive = connection != 'close'
+        else:
+            self._keep_alive = connection == 'keep-alive'
+        if method == 'GET' and path == METRICS_PATH:
+            self._reset()
+            self._send_response(200, 'OK', metrics.render(),
+                                METRICS_CONTENT_TYPE)
+            return
+        if method != 'POST':
+            self._send_error(501, 'Not Implemented')
+            return
+        try:
+            length = int(self._headers.get('content-length', 0))
+        except ValueError:
+            self._send_error(400, 'Bad Request')
+            return
+        if length > self.MAX_REQUEST_SIZE:
+            self._send_error(413, 'Request Entity Too Large')
+        elif length > 0:
+            self.set_terminator(length)
+        else:
+            self._handle_request('')
 
+    def _handle_request(self, body):
+        self._reset()
+        if not self._server.defer_request(self, body):
+            response = self._server._marshaled_dispatch(body)
+            self._send_response(200, 'OK', response)
 
-class ModemProxy(object):
+    def send_result(self, response):
+        """Send the marshalled response to a request that was deferred."""
+        self.is_waiting = False
+        self.last_active = time.time()
+        self._send_response(200, 'OK', response)
 
-    CLIENT_TIMEOUT = 30
+    def _send_error(self, code, message):
+        self._keep_alive = False
+        self._send_response(code, message, message, 'text/plain')
 
-    def __init__(self, modem):
-        self._modem = modem
-        self._clients = {}
-        self._is_dialling = False
+    def _send_response(self, code, message, body, content_type='text/xml'):
+        headers = ['HTTP/1.1 %d %s' % (code, message),
+                   'Content-Type: %s' % content_type,
+                   'Content-Length: %d' % len(body)]
+        if not self._keep_alive:
+            headers.append('Connection: close')
+        self.push('\r\n'.join(headers) + '\r\n\r\n' + body)
+        if not self._keep_alive:
+            self.close_when_done()
 
-    def add_client(self, client_id):
-        if client_id not in self._clients:
-            self._clients[client_id] = time.time()
-        if not (self._is_dialling or self.is_connected()):
-            self._is_dialling = True
-            self._modem.connect()
+    def handle_error(self):
+        log.error('Closing connection: %s' % format_exception())
+        self.close()
 
-    def refresh_client(self, client_id):
-        self._clients[client_id] = time.time()
+    def close(self):
+        self._server.forget_channel(self)
+        asynchat.async_chat.close(self)
 
-    def remove_client(self, client_id):
-        if client_id in self._clients:
-            del self._clients[client_id]
-        if not self._clients:
-            if self.is_connected() or self._is_dialling:
-                self.disconnect()
 
-    def remove_old_clients(self):
-        for client_id, time_last_seen in self._clients.items():
-            if (time.time() - time_last_seen) > self.CLIENT_TIMEOUT:
-                self.remove_client(client_id)
+class AsyncXMLRPCServer(asyncore.dispatcher, CachingDispatcher,
+                        InstrumentedDispatcher,
+                        SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
 
-    def count_clients(self):
-        return len(self._clients.keys())
+    """Serves XML-RPC requests from the EventLoop's thread.
 
-    def is_connected(self):
-        if self._modem.is_connected():
-            self._is_dialling = False
-            return True
+    Each client connection is handled by an XMLRPCChannel, so idle
+    connections cost a file descriptor rather than a thread. Call
+    close_idle_channels() periodically to close connections that
+    have been idle for more than keepalive_timeout seconds.
+
+    Calls to wait_for_status() are handed to status_waiters (if it
+    has been set), so that they don't block the loop.
+
+    """
+
+    status_waiters = None
+
+    def __init__(self, addr, backlog=PooledXMLRPCServer.BACKLOG,
+                 keepalive_timeout=PooledXMLRPCServer.KEEPALIVE_TIMEOUT,
+                 listening_socket=None):
+        asyncore.dispatcher.__init__(self)
+        SimpleXMLRPCServer.SimpleXMLRPCDispatcher.__init__(self)
+        self.keepalive_timeout = keepalive_timeout
+        self._channels = {}
+        if listening_socket is None:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind(addr)
+            self.listen(backlog)
         else:
+            listening_socket.setblocking(0)
+            self.set_socket(listening_socket)
+            self.accepting = True
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, client_address = pair
+            self._channels[XMLRPCChannel(sock, self)] = None
+
+    def defer_request(self, channel, body):
+        if self.status_waiters is None:
+            return False
+        params = get_wait_params(body)
+        if params is None:
             return False
+        channel.is_waiting = True
+        self.status_waiters.add(channel, params)
+        return True
 
-    def get_time_connected(self):
-        return self._modem.timer.elapsed_seconds
+    def forget_channel(self, channel):
+        if channel in self._channels:
+            del self._channels[channel]
+        if self.status_waiters is not None:
+            self.status_waiters.remove(channel)
 
-    def disconnect(self):
-        self._is_dialling = False
-        self._modem.disconnect()
+    def count_channels(self):
+        return len(self._channels)
 
+    def set_backlog(self, backlog):
+        self.socket.listen(backlog)
 
-class API(object):
-    
-    """Implements the LANdialler API.
+    def close_idle_channels(self):
+        now = time.time()
+        for channel in self._channels.keys():
+            if channel.is_waiting:
+                continue
+            if (now - channel.last_active) > self.keepalive_timeout:
+                channel.close()
 
-    All accessible methods in this class form a part of the LANdialler
-    XML-RPC API, and are called directly whenever a client makes an
-    HTTP request to the server.
+    def handle_error(self):
+        log.error('Error accepting connection: %s' % format_exception())
+
+    def finish_requests(self, timeout):
+        """Send any responses that haven't been sent yet.
+
+        Call once the event loop has stopped. No further connections
+        are accepted.
+
+        """
+        self.del_channel()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not [c for c in self._channels.keys() if c.writable()]:
+                break
+            asyncore.poll(0.1)
+
+
+class StatusWaiters(object):
+
+    """Answers wait_for_status() requests without blocking.
+
+    Requests are put to one side until the proxy's status changes, or
+    until they time out (call expire() regularly), and are then
+    answered by calling the API without waiting. Each request is
+    represented by a channel with send_result() and close() methods
+    (an XMLRPCChannel or a DeferredRequest).
+
+    The waiters may be used from several threads. Replies are sent by
+    whichever thread changed the status, or called expire().
 
     """
 
-    def __init__(self, modem_proxy):
+    response_cache = None
+
+    def __init__(self, api, modem_proxy):
+        self._api = api
         self._modem_proxy = modem_proxy
+        self._lock = threading.Lock()
+        self._waiting = {}  # channel -> (params, deadline, time added)
+        modem_proxy.add_observer(self)
 
-    def connect(self, client_id):
-        """Register this client and open the connection if necessary.
+    def _dispatch(self, method, params):
+        client_id, last_version, timeout = params
+        return profiler.call(method, self._api.wait_for_status,
+                             client_id, last_version, 0)
 
-        Always returns True.
+    def count(self):
+        return len(self._waiting)
 
-        """
-        log.info('%s connected' % client_id)
-        self._modem_proxy.add_client(client_id)
-        return xmlrpclib.True
+    def add(self, channel, params):
+        client_id, last_version, timeout = params
+        timeout = min(timeout, self._api.MAX_WAIT)
+        now = time.time()
+        if timeout > 0:
+            self._modem_proxy.refresh_client(client_id)
+            self._lock.acquire()
+            try:
+                # update() can't miss a change made after this check
+                if last_version == self._modem_proxy.version:
+                    self._waiting[channel] = (params, now + timeout, now)
+                    return
+            finally:
+                self._lock.release()
+        self._respond(channel, params, now)
 
-    def disconnect(self, client_id, all=xmlrpclib.False):
-        """Disconnect this client and/or close the connection.
+    def remove(self, channel):
+        self._lock.acquire()
+        try:
+            if channel in self._waiting:
+                del self._waiting[channel]
+        finally:
+            self._lock.release()
 
-        Always returns True.
+    def _respond(self, channel, params, started):
+        method = 'wait_for_status'
+        try:
+            if self.response_cache is None:
+                response = xmlrpclib.dumps(
+                    (self._dispatch(method, params),), methodresponse=1)
+            else:
+                response = self.response_cache.dispatch(
+                    method, params, self._dispatch)
+        except:
+            log.error('wait_for_status failed: %s' % format_exception())
+            channel.close()
+        else:
+            channel.send_result(response)
+        record_request(method, time.time() - started)
 
-        The client argument should uniquely identify the client, and
-        should be usable as a dictionary key.
+    def update(self):
+        """Called by the proxy when its status changes."""
+        self._lock.acquire()
+        try:
+            waiting = self._waiting.items()
+            self._waiting.clear()
+        finally:
+            self._lock.release()
+        for channel, (params, deadline, started) in waiting:
+            self._respond(channel, params, started)
 
-        """
-        message = '%s disconnected' % client_id
-        if bool(all):
-            message += ' (all users)'
-        log.info(message)
-        self._modem_proxy.remove_client(client_id)
-        if bool(all):
-            self._modem_proxy.disconnect()
-        return xmlrpclib.True
-                
-    def get_status(self, client_id):
-        """Returns the number of clients and connection status.
+    def expire(self):
+        now = time.time()
+        expired = []
+        self._lock.acquire()
+        try:
+            for channel, item in self._waiting.items():
+                params, deadline, started = item
+                if deadline <= now:
+                    del self._waiting[channel]
+                    expired.append((channel, item))
+        finally:
+            self._lock.release()
+        for channel, (params, deadline, started) in expired:
+            self._respond(channel, params, started)
 
-        The values returned are:
 
-        current_clients    -- The number of users sharing the connection
-        is_connected       -- True if connected, False otherwise
-        seconds_connected  -- Number of seconds connected
+class Settings(ReadOnly):
 
-        """
-        self._modem_proxy.refresh_client(client_id)
-        return (self._modem_proxy.count_clients(),
-                self._modem_proxy.is_connected(),
-                self._modem_proxy.get_time_connected())
-    
+    """The server's configuration, as read from the config file.
 
-class AutoDisconnectThread(threading.Thread):
+    The file is parsed, and its options checked, once; ValueError is
+    raised if any of them are invalid. Settings can't be changed, so
+    a new config file is applied by loading a new Settings object and
+    switching to it in one go (see App.reload()).
 
-    INTER_CHECK_PERIOD = 5  # seconds
+    """
 
-    def __init__(self, modem_proxy):
-        threading.Thread.__init__(self)
-        self._modem_proxy = modem_proxy
-        self.finished = threading.Event()
-        self.setDaemon(True)
-        self.setName('AutoDisconnect')
+    RESTART_OPTIONS = ('port', 'interface', 'state_file', 'event_socket',
+                       'log_max_bytes', 'log_backups', 'accounting_dir',
+                       'discovery_port')
+    POSITIVE_OPTIONS = ('probe_period', 'workers', 'backlog',
+                        'keepalive_timeout', 'throughput_period',
+                        'link_pool_period')
+    NON_NEGATIVE_OPTIONS = ('max_status_age', 'link_capacity',
+                            'client_rate', 'server_rate', 'idle_threshold',
+                            'discovery_port')
 
-    def run(self):
-        proxy = self._modem_proxy
-        while not self.finished.isSet():
-            proxy.remove_old_clients()
-            self.finished.wait(self.INTER_CHECK_PERIOD)
+    def __init__(self, config):
+        try:
+            self._read(config)
+        except ConfigParser.Error, e:
+            raise ValueError(str(e))
+        for option in self.POSITIVE_OPTIONS:
+            if getattr(self, option) <= 0:
+                raise ValueError('%s must be greater than 0' % option)
+        for option in self.NON_NEGATIVE_OPTIONS:
+            if getattr(self, option) < 0:
+                raise ValueError('%s must not be negative' % option)
+        if (self.client_rate and self.client_burst < 1) or \
+               (self.server_rate and self.server_burst < 1):
+            raise ValueError('bursts must be at least 1 request')
 
+    def _read(self, config):
+        links = []
+        for section in config.sections():
+            if section.startswith('link '):
+                links.append(ExtraLinkSettings(config, section))
+        event_probe_period = read_option(
+            config, 'general', 'event_probe_period',
+            LinkMonitor.EVENT_PERIOD, 'getfloat')
+        if event_probe_period <= 0:
+            event_probe_period = None
+        idle_timeout = read_option(config, 'general', 'idle_timeout', 0,
+                                   'getfloat')
+        if idle_timeout <= 0:
+            idle_timeout = None
 
-class ReusableSimpleXMLRPCServer(SimpleXMLRPCServer.SimpleXMLRPCServer):
+        def get(option, default, method='get'):
+            return read_option(config, 'general', option, default, method)
+
+        self._set(
+            link=LinkSettings(config),
+            links=tuple(links),
+            interface=read_option(config, 'probe', 'interface', 'ppp0'),
+            port=config.getint('general', 'port'),
+            probe_period=get('probe_period', LinkMonitor.PROBE_PERIOD,
+                             'getfloat'),
+            max_status_age=get('max_status_age', LinkMonitor.MAX_AGE,
+                               'getfloat'),
+            workers=get('workers', PooledXMLRPCServer.WORKERS, 'getint'),
+            backlog=get('backlog', PooledXMLRPCServer.BACKLOG, 'getint'),
+            keepalive_timeout=get('keepalive_timeout',
+                                  PooledXMLRPCServer.KEEPALIVE_TIMEOUT,
+                                  'getfloat'),
+            log_max_bytes=get('log_max_bytes', FileSink.MAX_BYTES, 'getint'),
+            log_backups=get('log_backups', FileSink.BACKUPS, 'getint'),
+            event_socket=get('event_socket', None),
+            discovery_port=get('discovery_port', 0, 'getint'),
+            event_probe_period=event_probe_period,
+            state_file=get('state_file', None),
+            accounting_dir=get('accounting_dir', None),
+            profile_file=get('profile_file', Profiler.PATH),
+            throughput_period=get('throughput_period',
+                                  ThroughputSampler.PERIOD, 'getfloat'),
+            link_capacity=get('link_capacity', 0, 'getint'),
+            link_pool_period=get('link_pool_period', LinkPool.PERIOD,
+                                 'getfloat'),
+            client_rate=get('client_rate', RateLimiter.CLIENT_RATE,
+                            'getfloat'),
+            client_burst=get('client_burst', RateLimiter.CLIENT_BURST,
+                             'getint'),
+            server_rate=get('server_rate', RateLimiter.RATE, 'getfloat'),
+            server_burst=get('server_burst', RateLimiter.BURST, 'getint'),
+            idle_timeout=idle_timeout,
+            idle_threshold=get('idle_threshold', IdleDetector.THRESHOLD,
+                               'getint'))
+
+    def _get_link_interfaces(self):
+        return [(link.name, link.interface) for link in self.links]
+
+    def get_restart_options(self, other):
+        """Return the options changed by other that need a restart."""
+        options = [option for option in self.RESTART_OPTIONS
+                   if getattr(self, option) != getattr(other, option)]
+        if self._get_link_interfaces() != other._get_link_interfaces():
+            options.append('links')
+        return options
 
-     allow_reuse_address = True
 
- 
 class App(object):
 
+    REEXEC_VARIABLE = 'LANDIALLERD_REEXEC'
+    STATE_FILE_VARIABLE = 'LANDIALLERD_STATE_FILE'
+    REEXEC_TIMEOUT = 10  # seconds to wait for commands to finish
+
     def __init__(self):
         self._become_daemon = True
-        self._config = self._load_config_file()
-        modem = Modem(self._config)
-        self._modem_proxy = ModemProxy(modem)
+        self._use_event_loop = False
+        self._log_level = Logger.INFO
+        self._log_file = None
+        self._use_syslog = False
+        try:
+            self._listening_socket = get_inherited_socket()
+        except ValueError, e:
+            print 'Terminating - unable to use inherited socket: %s' % e
+            sys.exit()
+        self._supervisor = None
+        self._server = None
+        self._stop_serving = None
+        self._is_reexec_requested = False
+        self._api = None
+        self._reload_lock = threading.Lock()
+        self._settings = self._load_settings()
+        try:
+            self._modem = Modem(self._settings.link)
+            self._link_monitor = LinkMonitor(self._modem)
+            self._modem_proxy = ModemProxy(self._link_monitor)
+            self._sampler = self._create_sampler()
+            self._link_pool = self._create_link_pool()
+            for monitor in self._get_link_monitors():
+                self._configure_monitor(monitor, self._settings)
+            self._idle_detector = IdleDetector(
+                self._modem_proxy, self._sampler,
+                self._settings.idle_threshold, self._settings.idle_timeout)
+            self._accounting = self._create_accounting()
+            self._history = ConnectionHistory(self._modem_proxy,
+                                              self._sampler)
+            self._state_file = self._create_state_file()
+            self._link_events = self._create_link_event_listener()
+            self._discovery = self._create_discovery_responder()
+        except ValueError, e:
+            print 'Terminating - error in config file: %s' % e
+            sys.exit()
+        metrics.set_gauge('landialler_clients',
+                          'Clients sharing the connection.',
+                          self._modem_proxy.count_clients)
+        metrics.set_gauge('landialler_link_up',
+                          '1 if the link was up when last probed.',
+                          lambda: int(self._link_monitor.snapshot[0]))
+
+    def _create_link_pool(self):
+        """Return a LinkPool for the [link NAME] sections, or None."""
+        links = [create_link(settings) for settings in self._settings.links]
+        if not links:
+            return None
+        pool = LinkPool(self._modem_proxy, links, [self._sampler],
+                        self._settings.link_pool_period)
+        self._modem_proxy.link_pool = pool
+        return pool
+
+    def _configure_monitor(self, monitor, settings):
+        monitor.period = settings.probe_period
+        monitor.event_period = settings.event_probe_period
+        if monitor.has_events or (self._use_event_loop and isinstance(
+                monitor.modem.probe, ShellProbe)):
+            monitor.max_age = None  # see _serve_events()
+        else:
+            monitor.max_age = settings.max_status_age
+
+    def _create_sampler(self):
+        return ThroughputSampler(self._settings.interface,
+                                 self._settings.link_capacity,
+                                 self._settings.throughput_period)
+
+    def _create_accounting(self):
+        """Return an AccountingLog for the accounting_dir, or None."""
+        directory = self._settings.accounting_dir
+        if directory is None:
+            return None
+        try:
+            accounting = AccountingLog(directory)
+        except (IOError, OSError), e:
+            log.error('Unable to record usage in %s: %s' % (directory, e))
+            return None
+        self._modem_proxy.accounting = accounting
+        return accounting
+
+    def _create_state_file(self):
+        """Restore the state saved by the last server, if any.
+
+        A server that re-executes itself hands its state over in a
+        temporary file if no state_file has been configured.
+
+        """
+        path = os.environ.get(self.STATE_FILE_VARIABLE)
+        if path is not None:
+            del os.environ[self.STATE_FILE_VARIABLE]
+        elif self._settings.state_file is not None:
+            path = self._settings.state_file
+        else:
+            return None
+        state_file = StateFile(path, self._modem_proxy)
+        state_file.restore()
+        return state_file
+
+    def _create_link_event_listener(self):
+        """Return a LinkEventListener for the event_socket, or None."""
+        path = self._settings.event_socket
+        if path is None:
+            return None
+        monitors = {self._settings.interface: self._link_monitor}
+        if self._link_pool is not None:
+            for link in self._link_pool.links:
+                if link.interface is not None:
+                    monitors[link.interface] = link.monitor
+        try:
+            return LinkEventListener(path, monitors)
+        except socket.error, e:
+            log.error('Unable to listen for link events on %s: %s' %
+                      (path, e))
+            return None
+
+    def _create_discovery_responder(self):
+        """Return a DiscoveryResponder for the discovery_port, or None."""
+        port = self._settings.discovery_port
+        if not port:
+            return None
+        server_port = self._settings.port
+        if self._listening_socket is not None:
+            server_port = self._listening_socket.getsockname()[1]
+        try:
+            return DiscoveryResponder(port, server_port)
+        except socket.error, e:
+            log.error('Unable to answer discovery queries on port %d: %s' %
+                      (port, e))
+            return None
+
+    def _get_link_monitors(self):
+        monitors = [self._link_monitor]
+        if self._link_pool is not None:
+            monitors.extend([link.monitor for link in self._link_pool.links])
+        return monitors
 
-    def _load_config_file(self):
+    def _create_rate_limiter(self, settings):
+        return RateLimiter(settings.client_rate, settings.client_burst,
+                           settings.server_rate, settings.server_burst)
+
+    def _read_settings(self):
+        config = ConfigParser.ConfigParser()
         try:
-            config = ConfigParser.ConfigParser()
             config.read(['/usr/local/etc/landiallerd.conf',
                          '/etc/landiallerd.conf',
                          'landiallerd.conf'])
-            return config
-        except Exception, e:
-            print 'Terminating - error reading config file: %s' % e
+        except ConfigParser.Error, e:
+            raise ValueError(str(e))
+        return Settings(config)
+
+    def _load_settings(self):
+        try:
+            return self._read_settings()
+        except ValueError, e:
+            print 'Terminating - error in config file: %s' % e
             sys.exit()
 
+    def _apply_settings(self, settings):
+        self._modem.apply_settings(settings.link)
+        if self._link_pool is not None:
+            self._link_pool.period = settings.link_pool_period
+            links = dict([(link.name, link) for link in settings.links])
+            for link in self._link_pool.links:
+                if link.name in links:
+                    link.apply_settings(links[link.name])
+        for monitor in self._get_link_monitors():
+            self._configure_monitor(monitor, settings)
+        self._sampler.capacity = settings.link_capacity
+        self._sampler.period = settings.throughput_period
+        self._idle_detector.threshold = settings.idle_threshold
+        self._idle_detector.window = settings.idle_timeout
+        profiler.path = settings.profile_file
+        if self._api is not None:
+            self._api.rate_limiter = self._create_rate_limiter(settings)
+        if self._server is not None:
+            self._server.keepalive_timeout = settings.keepalive_timeout
+            self._server.set_backlog(settings.backlog)
+            if isinstance(self._server, PooledXMLRPCServer):
+                self._server.set_workers(settings.workers)
+        self._settings = settings
+
+    def reload(self):
+        """Re-read the config file and switch to the new settings.
+
+        The current settings are kept if the new ones are invalid.
+        Options that can't be changed while the server is running (see
+        Settings.RESTART_OPTIONS) take effect when it is next started.
+
+        """
+        self._reload_lock.acquire()
+        try:
+            try:
+                settings = self._read_settings()
+            except ValueError, e:
+                log.error('Not reloading - error in config file: %s' % e)
+                return
+            for option in self._settings.get_restart_options(settings):
+                log.warn('Restart the server to change %s' % option)
+            self._apply_settings(settings)
+            log.info('Reloaded config file')
+        finally:
+            self._reload_lock.release()
+
     def check_platform(self):
         if os.name != "posix":
             print "Sorry, only POSIX compliant systems are supported."
@@ -334,12 +4596,16 @@ class App(object):
 
         # See "Python Standard Library", pg. 29, O'Reilly, for more
         # info on the following.
-        pid = os.fork()
-        if pid:  # we're the parent if pid is set
-            os._exit(0)
+        if self.REEXEC_VARIABLE in os.environ:
+            # we were a daemon before we re-executed ourselves
+            del os.environ[self.REEXEC_VARIABLE]
+        else:
+            pid = os.fork()
+            if pid:  # we're the parent if pid is set
+                os._exit(0)
 
-        os.setpgrp()
-        os.umask(0)
+            os.setpgrp()
+            os.umask(0)
 
         class DevNull:
 
@@ -351,11 +4617,229 @@ class App(object):
         sys.stderr = DevNull()
 
     def getopt(self):
-        opts, args = getopt.getopt(sys.argv[1:], "dfhl:s")
+        opts, args = getopt.getopt(sys.argv[1:], "defhl:s")
 
         for o, v in opts:
-            if o == "-f":
+            if o == "-d":
+                self._log_level = Logger.DEBUG
+            elif o == "-e":
+                self._use_event_loop = True
+            elif o == "-f":
                 self._become_daemon = False
+            elif o == "-l":
+                self._log_file = v
+            elif o == "-s":
+                self._use_syslog = True
+
+    def _toggle_profiling(self, signum, frame):
+        # toggle from another thread, as the signal may have arrived
+        # while this one holds the profiler's lock
+        thread = threading.Thread(target=profiler.toggle)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _request_reload(self, signum, frame):
+        # reload from another thread, so that we don't reconfigure the
+        # server in the middle of whatever was interrupted
+        thread = threading.Thread(target=self.reload)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _request_reexec(self, signum, frame):
+        self._is_reexec_requested = True
+        if self._stop_serving is not None:
+            self._stop_serving()
+
+    def install_signal_handlers(self):
+        """Handle SIGHUP (reload), SIGUSR1 (profile) and SIGUSR2 (re-exec)."""
+        profiler.path = self._settings.profile_file
+        signal.signal(signal.SIGHUP, self._request_reload)
+        signal.signal(signal.SIGUSR1, self._toggle_profiling)
+        signal.signal(signal.SIGUSR2, self._request_reexec)
+
+    def _wait_for_commands(self):
+        deadline = time.time() + self.REEXEC_TIMEOUT
+        while self._supervisor.count_children() and time.time() < deadline:
+            self._supervisor.poll()
+            time.sleep(CommandSupervisor.POLL_PERIOD)
+
+    def _get_open_fds(self):
+        try:
+            return [int(fd) for fd in os.listdir('/proc/self/fd')]
+        except OSError:
+            return range(os.sysconf('SC_OPEN_MAX'))
+
+    def reexec(self):
+        """Replace this process with a fresh copy of the server.
+
+        The new server inherits the listening socket (so clients are
+        never refused) and restores our state (so the link isn't
+        dropped). Requests that have already been accepted are
+        answered first (including those waiting for the status to
+        change), and any commands that are running are given a chance
+        to finish, so that their exit status isn't lost.
+
+        """
+        log.info('Re-executing %s' % sys.argv[0])
+        self._modem_proxy.release_waiters()
+        self._server.finish_requests(self.REEXEC_TIMEOUT)
+        self._wait_for_commands()
+        state_file = self._state_file
+        if state_file is None:
+            fd, path = tempfile.mkstemp(prefix='landiallerd-',
+                                        suffix='.state')
+            os.close(fd)
+            state_file = StateFile(path, self._modem_proxy)
+        state_file.save()
+        listening_fd = self._server.socket.fileno()
+        for fd in self._get_open_fds():
+            if fd > 2 and fd != listening_fd:
+                try:
+                    set_close_on_exec(fd)
+                except IOError:
+                    pass  # already closed
+        if listening_fd == LISTEN_FDS_START:
+            set_close_on_exec(listening_fd, False)
+        else:
+            os.dup2(listening_fd, LISTEN_FDS_START)
+        os.environ['LISTEN_FDS'] = '1'
+        os.environ['LISTEN_PID'] = str(os.getpid())
+        os.environ[self.STATE_FILE_VARIABLE] = state_file.path
+        if self._become_daemon:
+            os.environ[self.REEXEC_VARIABLE] = '1'
+        if self._accounting is not None:
+            self._accounting.close()
+        log.close()
+        try:
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        except OSError, e:
+            log.error('Unable to re-execute: %s' % e)
+            log.flush()
+            raise
+
+    def start_logging(self):
+        """Add the log sinks chosen on the command line.
+
+        Messages go to syslog unless a log file is given (or -s is
+        used as well), and also to stderr if we're in the foreground.
+
+        """
+        if self._use_syslog or self._log_file is None:
+            log.add_sink(SyslogSink(), self._log_level)
+        if self._log_file is not None:
+            try:
+                sink = FileSink(self._log_file,
+                                self._settings.log_max_bytes,
+                                self._settings.log_backups)
+            except IOError, e:
+                if not self._use_syslog:
+                    log.add_sink(SyslogSink(), self._log_level)
+                log.error('Unable to open log file: %s' % e)
+            else:
+                log.add_sink(sink, self._log_level)
+        if not self._become_daemon:
+            log.add_sink(StreamSink(sys.stderr), self._log_level)
+        log.start()
+
+    def _serve_threads(self, addr):
+        supervisor = self._supervisor = CommandSupervisor()
+        CommandSupervisorThread(supervisor).start()
+        for monitor in self._get_link_monitors():
+            monitor.modem.supervisor = supervisor
+            monitor.start()
+        if self._link_pool is not None:
+            self._link_pool.start()
+        if self._link_events is not None:
+            self._link_events.start()
+        if self._discovery is not None:
+            self._discovery.start()
+        self._sampler.start()
+        thread = AutoDisconnectThread(self._modem_proxy)
+        thread.start()
+        if self._state_file is not None:
+            StateFileThread(self._state_file).start()
+
+        settings = self._settings
+        server = PooledXMLRPCServer(
+            addr, settings.workers, settings.backlog,
+            settings.keepalive_timeout,
+            listening_socket=self._listening_socket)
+        self._server = server
+        self._stop_serving = server.stop
+        # waiting requests are parked by status_waiters (rather than
+        # holding a worker), so the API itself mustn't wait (e.g.
+        # within system.multicall)
+        self._api = API(self._modem_proxy, max_waiters=0,
+                        sampler=self._sampler)
+        self._api.rate_limiter = self._create_rate_limiter(settings)
+        self._api.accounting = self._accounting
+        self._api.history = self._history
+        server.register_instance(self._api)
+        server.register_introspection_functions()
+        server.register_multicall_functions()
+        server.response_cache = ResponseCache(self._modem_proxy)
+        server.status_waiters = StatusWaiters(self._api, self._modem_proxy)
+        server.status_waiters.response_cache = server.response_cache
+        server.serve_forever()
+
+    def _serve_events(self, addr):
+        """Serve clients, dial and probe from a single thread."""
+        supervisor = self._supervisor = CommandSupervisor()
+        server = AsyncXMLRPCServer(
+            addr, self._settings.backlog, self._settings.keepalive_timeout,
+            listening_socket=self._listening_socket)
+        self._server = server
+        # the API mustn't block the loop (e.g. within system.multicall)
+        api = API(self._modem_proxy, max_waiters=0, sampler=self._sampler)
+        api.rate_limiter = self._create_rate_limiter(self._settings)
+        api.accounting = self._accounting
+        api.history = self._history
+        self._api = api
+        server.register_instance(api)
+        server.register_introspection_functions()
+        server.register_multicall_functions()
+        server.response_cache = ResponseCache(self._modem_proxy)
+        server.status_waiters = StatusWaiters(api, self._modem_proxy)
+        server.status_waiters.response_cache = server.response_cache
+        loop = EventLoop()
+        self._stop_serving = loop.stop
+        loop.call_every(1, server.close_idle_channels)
+        loop.call_every(0.5, server.status_waiters.expire)
+        loop.call_every(CommandSupervisor.POLL_PERIOD, supervisor.poll)
+        for monitor in self._get_link_monitors():
+            monitor.modem.supervisor = supervisor
+            if isinstance(monitor.modem.probe, ShellProbe):
+                monitor.max_age = None
+
+            def probe_link(monitor=monitor):
+                if monitor.is_probe_due():
+                    monitor.probe_in_background(supervisor)
+
+            loop.call_every(lambda monitor=monitor: monitor.period,
+                            probe_link)
+        pool = self._link_pool
+        if pool is not None:
+            loop.call_every(lambda: pool.period, pool.balance)
+        if self._link_events is not None:
+            LinkEventDispatcher(self._link_events)
+        if self._discovery is not None:
+            DiscoveryDispatcher(self._discovery)
+        sampler = self._sampler
+        loop.call_every(lambda: sampler.period, sampler.sample)
+        state_file = self._state_file
+        if state_file is not None:
+            loop.call_every(state_file.HEARTBEAT_PERIOD, state_file.heartbeat)
+
+        def remove_old_clients():
+            try:
+                profiler.call('remove_old_clients',
+                              self._modem_proxy.remove_old_clients)
+            finally:
+                loop.call_later(self._modem_proxy.seconds_until_expiry(),
+                                remove_old_clients)
+
+        loop.call_later(0, remove_old_clients)
+        loop.run()
 
     def main(self):
         log.info('Starting')
@@ -365,19 +4849,25 @@ class App(object):
             self.daemonise()
         except getopt.GetoptError, e:
             sys.stderr.write("%s\n" % e)
-        
-        thread = AutoDisconnectThread(self._modem_proxy)
-        thread.start()
+        self.start_logging()
+        self.install_signal_handlers()
 
-        addr = ('', self._config.getint('general', 'port'))
-        server = ReusableSimpleXMLRPCServer(addr, logRequests=False)
-        server.allow_reuse_address = True
-        server.register_instance(API(self._modem_proxy))
+        addr = ('', self._settings.port)
         try:
-            server.serve_forever()
-        except KeyboardInterrupt:
-            print "Caught Ctrl-C, shutting down."
-            log.info('Exit')
+            try:
+                if self._use_event_loop:
+                    self._serve_events(addr)
+                else:
+                    self._serve_threads(addr)
+                if self._is_reexec_requested:
+                    self.reexec()
+            except KeyboardInterrupt:
+                print "Caught Ctrl-C, shutting down."
+                log.info('Exit')
+        finally:
+            if self._accounting is not None:
+                self._accounting.close()
+            log.close()
 
     
 if __name__ == "__main__":
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+#
+# landiallerd_bench.py - load generator for the LANdialler daemon
+#
+# Copyright (C) 2001-2004 Graham Ashton
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# $Id$
+
+
+"""measures how well landiallerd copes with lots of clients
+
+Starts landiallerd.py in the foreground, with stub commands that
+"dial up" by creating a file (and hang up by removing it), and then
+simulates a number of clients. Each client connects, polls for the
+status for a while (mostly with wait_for_status(), sometimes with the
+older get_status()), disconnects, pauses and starts again.
+
+When the run is over the number of calls made to each method, the
+calls per second and the 50th and 99th percentile latencies are
+printed, and appended to a CSV file so that runs can be compared.
+Note that the latency of wait_for_status() includes the time spent
+waiting for the status to change.
+
+usage: landiallerd_bench.py [-e] [-c clients] [-t seconds] [-o file]
+
+  -c clients    number of simulated clients (default 20)
+  -e            run the server with its event loop (-e)
+  -o file       append results to file (default landiallerd_bench.csv)
+  -t seconds    length of the run (default 10)
+
+"""
+
+
+import getopt
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+
+CONFIG = """[commands]
+connect: touch %(dir)s/online
+disconnect: rm -f %(dir)s/online
+is_connected: test -f %(dir)s/online
+timeout: 10
+
+[probe]
+backend: shell
+interface: ppp0
+
+[general]
+port: %(port)d
+# measure the server rather than the rate limiter's short cut
+client_rate: 0
+server_rate: 0
+"""
+
+METHODS = ('connect_and_get_status', 'wait_for_status', 'get_status',
+           'disconnect')
+CSV_FIELDS = ('time', 'mode', 'clients', 'seconds', 'method', 'calls',
+              'errors', 'calls_per_second', 'p50_ms', 'p99_ms')
+
+
+def find_free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def percentile(values, percent):
+    """Return the value below which percent of the values fall."""
+    if not values:
+        return 0.0
+    values = values[:]
+    values.sort()
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+class Server(object):
+
+    """Runs landiallerd.py in a directory of its own."""
+
+    STARTUP_TIMEOUT = 10  # seconds
+
+    def __init__(self, use_event_loop=False):
+        self.use_event_loop = use_event_loop
+        self.port = find_free_port()
+        self._dir = tempfile.mkdtemp()
+        self._pid = None
+
+    def _write_config(self):
+        f = open(os.path.join(self._dir, 'landiallerd.conf'), 'w')
+        try:
+            f.write(CONFIG % {'dir': self._dir, 'port': self.port})
+        finally:
+            f.close()
+
+    def _wait_until_listening(self):
+        deadline = time.time() + self.STARTUP_TIMEOUT
+        while time.time() < deadline:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                try:
+                    sock.connect(('127.0.0.1', self.port))
+                    return
+                except socket.error:
+                    time.sleep(0.1)
+            finally:
+                sock.close()
+        raise RuntimeError('landiallerd.py failed to start')
+
+    def start(self):
+        self._write_config()
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'landiallerd.py')
+        args = [sys.executable, script, '-f']
+        if self.use_event_loop:
+            args.append('-e')
+        cwd = os.getcwd()
+        os.chdir(self._dir)  # so the server reads our config file
+        null = os.open('/dev/null', os.O_WRONLY)
+        saved = [os.dup(1), os.dup(2)]
+        try:
+            os.dup2(null, 1)  # keep the server's output out of the report
+            os.dup2(null, 2)
+            self._pid = os.spawnv(os.P_NOWAIT, args[0], args)
+        finally:
+            os.chdir(cwd)
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved + [null]:
+                os.close(fd)
+        self._wait_until_listening()
+
+    def stop(self):
+        if self._pid is not None:
+            os.kill(self._pid, signal.SIGINT)
+            os.waitpid(self._pid, 0)
+            self._pid = None
+        shutil.rmtree(self._dir)
+
+
+class Results(object):
+
+    """Collects the latency of each call, by method."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}  # method -> [seconds]
+        self.errors = {}  # method -> count
+        for method in METHODS:
+            self.latencies[method] = []
+            self.errors[method] = 0
+
+    def record(self, method, seconds, failed=False):
+        self._lock.acquire()
+        try:
+            if failed:
+                self.errors[method] += 1
+            else:
+                self.latencies[method].append(seconds)
+        finally:
+            self._lock.release()
+
+    def summarise(self, seconds):
+        """Return a list of (method, calls, errors, rate, p50, p99)."""
+        rows = []
+        for method in METHODS:
+            latencies = self.latencies[method]
+            rows.append((method, len(latencies), self.errors[method],
+                         len(latencies) / float(seconds),
+                         percentile(latencies, 50) * 1000,
+                         percentile(latencies, 99) * 1000))
+        return rows
+
+
+class Client(threading.Thread):
+
+    """Connects, polls for the status, disconnects, and repeats."""
+
+    POLL_TIMEOUT = 2  # seconds to wait for the status to change
+    MAX_POLLS = 20
+    LEGACY_POLL_CHANCE = 0.2
+    MAX_PAUSE = 1.0  # seconds between disconnecting and reconnecting
+
+    def __init__(self, url, client_id, results, finished):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._server = xmlrpclib.ServerProxy(url)
+        self._client_id = client_id
+        self._results = results
+        self._finished = finished
+
+    def _call(self, method, *args):
+        started = time.time()
+        try:
+            result = getattr(self._server, method)(*args)
+        except (socket.error, xmlrpclib.Error):
+            self._results.record(method, time.time() - started, True)
+            return None
+        self._results.record(method, time.time() - started)
+        return result
+
+    def _poll(self, version):
+        if random.random() < self.LEGACY_POLL_CHANCE:
+            self._call('get_status', self._client_id)
+            return version
+        status = self._call('wait_for_status', self._client_id, version,
+                            self.POLL_TIMEOUT)
+        if status is None:
+            return version
+        if status.get('retry_after'):  # only if the limits are turned on
+            self._finished.wait(status['retry_after'])
+        return status['version']
+
+    def run(self):
+        while not self._finished.isSet():
+            status = self._call('connect_and_get_status', self._client_id)
+            version = -1
+            if status is not None:
+                version = status['version']
+            for i in range(random.randint(1, self.MAX_POLLS)):
+                if self._finished.isSet():
+                    break
+                version = self._poll(version)
+            self._call('disconnect', self._client_id, xmlrpclib.False)
+            self._finished.wait(random.random() * self.MAX_PAUSE)
+
+
+def write_csv(path, rows, mode, clients, seconds):
+    is_new = not os.path.exists(path)
+    f = open(path, 'a')
+    try:
+        if is_new:
+            f.write(','.join(CSV_FIELDS) + '\n')
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        for method, calls, errors, rate, p50, p99 in rows:
+            f.write('%s,%s,%d,%d,%s,%d,%d,%.1f,%.2f,%.2f\n' %
+                    (now, mode, clients, seconds, method, calls, errors,
+                     rate, p50, p99))
+    finally:
+        f.close()
+
+
+def print_table(rows):
+    print '%-24s %8s %7s %10s %9s %9s' % ('method', 'calls', 'errors',
+                                          'calls/s', 'p50 (ms)', 'p99 (ms)')
+    for method, calls, errors, rate, p50, p99 in rows:
+        print '%-24s %8d %7d %10.1f %9.2f %9.2f' % (method, calls, errors,
+                                                     rate, p50, p99)
+
+
+def run(num_clients, seconds, use_event_loop, path):
+    server = Server(use_event_loop)
+    server.start()
+    try:
+        url = 'http://127.0.0.1:%d/' % server.port
+        results = Results()
+        finished = threading.Event()
+        clients = []
+        for i in range(num_clients):
+            client = Client(url, 'bench-%d' % i, results, finished)
+            client.start()
+            clients.append(client)
+        time.sleep(seconds)
+        finished.set()
+        for client in clients:
+            client.join(Client.POLL_TIMEOUT * 2)
+    finally:
+        server.stop()
+    rows = results.summarise(seconds)
+    mode = {True: 'events', False: 'threads'}[bool(use_event_loop)]
+    print_table(rows)
+    write_csv(path, rows, mode, num_clients, seconds)
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'c:eho:t:')
+    except getopt.GetoptError, e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(2)
+    num_clients = 20
+    seconds = 10
+    use_event_loop = False
+    path = 'landiallerd_bench.csv'
+    for o, v in opts:
+        if o == '-c':
+            num_clients = int(v)
+        elif o == '-e':
+            use_event_loop = True
+        elif o == '-h':
+            print __doc__
+            sys.exit()
+        elif o == '-o':
+            path = v
+        elif o == '-t':
+            seconds = int(v)
+    run(num_clients, seconds, use_event_loop, path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# landiallerd_hook.py - tells landiallerd when a PPP link goes up or down
+#
+# Copyright (C) 2001-2004 Graham Ashton
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# $Id$
+
+
+"""tells landiallerd when a PPP link goes up or down
+
+Install this script as /etc/ppp/ip-up.d/landiallerd and as
+/etc/ppp/ip-down.d/landiallerd (or call it from your /etc/ppp/ip-up
+and /etc/ppp/ip-down scripts). pppd runs it with the name of the
+interface as the first argument. It sends an "up" event if it was run
+from a file or directory whose name contains "ip-up", and a "down"
+event if it contains "ip-down".
+
+The event is sent to the Unix socket named by the event_socket option
+in landiallerd.conf. Set the LANDIALLERD_SOCKET environment variable
+if you've changed it from the default (/var/run/landiallerd.sock).
+
+The script never fails. If landiallerd isn't running (or isn't
+listening for events) it will notice the change when it next probes
+the link.
+
+"""
+
+
+import os
+import socket
+import sys
+
+
+SOCKET = '/var/run/landiallerd.sock'
+
+
+def get_event(path):
+    if 'ip-down' in path:
+        return 'down'
+    elif 'ip-up' in path:
+        return 'up'
+    return None
+
+
+def get_interface(args):
+    if args:
+        return args[0]
+    return os.environ.get('PPP_IFACE')
+
+
+def send_event(event, interface, path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto('%s %s\n' % (event, interface), path)
+    finally:
+        sock.close()
+
+
+def main():
+    event = get_event(os.path.abspath(sys.argv[0]))
+    interface = get_interface(sys.argv[1:])
+    if event is None or interface is None:
+        sys.stderr.write('usage: ip-up.d/landiallerd interface\n')
+        return
+    try:
+        send_event(event, interface,
+                   os.environ.get('LANDIALLERD_SOCKET', SOCKET))
+    except socket.error:
+        pass
+
+
+if __name__ == '__main__':
+    main()
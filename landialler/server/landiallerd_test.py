@@ -1,13 +1,24 @@
 # $Id$
 
 
+import asyncore
+import ConfigParser
+import httplib
+import marshal
 import mock
+import os
+import shutil
+import signal
+import socket
+import tempfile
 import time
 import unittest
 import threading
+import urllib2
 import xmlrpclib
 
 import landiallerd
+import landiallerd_hook
 
 
 class MockTime:
@@ -19,6 +30,200 @@ class MockTime:
         return time.time() + self._offset
 
 
+class RecordingSink:
+
+    def __init__(self):
+        self.batches = []
+
+    def write(self, records):
+        self.batches.append(records)
+
+    def _get_messages(self):
+        messages = []
+        for batch in self.batches:
+            messages.extend([msg for level, when, msg in batch])
+        return messages
+
+    messages = property(_get_messages)
+
+
+class LoggerTest(unittest.TestCase):
+
+    def test_queued(self):
+        """Check messages are queued until they're written"""
+        logger = landiallerd.Logger()
+        sink = RecordingSink()
+        logger.add_sink(sink)
+        logger.info('one')
+        logger.error('two')
+        self.assertEqual(sink.messages, [])
+        logger.flush()
+        self.assertEqual(sink.messages, ['one', 'two'])
+        self.assertEqual(len(sink.batches), 1)
+
+    def test_levels(self):
+        """Check sinks are only sent messages at or above their level"""
+        logger = landiallerd.Logger()
+        verbose = RecordingSink()
+        quiet = RecordingSink()
+        logger.add_sink(verbose, logger.DEBUG)
+        logger.add_sink(quiet, logger.WARNING)
+        logger.debug('one')
+        logger.info('two')
+        logger.warn('three')
+        logger.flush()
+        self.assertEqual(verbose.messages, ['one', 'two', 'three'])
+        self.assertEqual(quiet.messages, ['three'])
+
+    def test_dropped(self):
+        """Check messages are dropped and counted when the queue is full"""
+        logger = landiallerd.Logger(max_queued=2)
+        sink = RecordingSink()
+        logger.add_sink(sink)
+        for i in range(5):
+            logger.info('message %d' % i)
+        self.assertEqual(logger.dropped, 3)
+        logger.flush()
+        self.assertEqual(sink.messages, ['message 0', 'message 1',
+                                         'Dropped 3 log messages'])
+        self.assertEqual(logger.dropped, 0)
+
+    def test_failing_sink(self):
+        """Check a failing sink doesn't stop the others being written"""
+        logger = landiallerd.Logger()
+        sink = RecordingSink()
+        logger.add_sink(None)
+        logger.add_sink(sink)
+        logger.info('one')
+        logger.flush()
+        self.assertEqual(sink.messages, ['one'])
+
+    def test_writer_thread(self):
+        """Check messages are written by the writer thread"""
+        logger = landiallerd.Logger()
+        sink = RecordingSink()
+        logger.add_sink(sink)
+        logger.start()
+        for i in range(3):
+            logger.info('message %d' % i)
+        logger.close()
+        self.assertEqual(sink.messages,
+                         ['message 0', 'message 1', 'message 2'])
+
+    def test_file_sink(self):
+        """Check log files are rotated when they get too big"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'landiallerd.log')
+            sink = landiallerd.FileSink(path, max_bytes=100, backups=2)
+            for i in range(4):
+                sink.write([(landiallerd.Logger.INFO, time.time(), 'x' * 80)])
+            self.assertEqual(os.path.getsize(path), 0)
+            self.assert_(os.path.exists(path + '.2'))
+            self.failIf(os.path.exists(path + '.3'))
+            line = open(path + '.1').read()
+            self.assert_(line.endswith(' INFO %s\n' % ('x' * 80)))
+        finally:
+            shutil.rmtree(directory)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counter(self):
+        """Check counters are rendered with their labels"""
+        metrics = landiallerd.Metrics()
+        metrics.describe('calls_total', 'counter', 'Calls made.')
+        metrics.increment('calls_total', (('method', 'connect'),))
+        metrics.increment('calls_total', (('method', 'connect'),), 2)
+        self.assertEqual(metrics.render(),
+                         '# HELP calls_total Calls made.\n'
+                         '# TYPE calls_total counter\n'
+                         'calls_total{method="connect"} 3\n')
+
+    def test_histogram(self):
+        """Check histogram buckets are cumulative"""
+        metrics = landiallerd.Metrics()
+        metrics.observe('duration_seconds', 0.003)
+        metrics.observe('duration_seconds', 2)
+        histogram = metrics.get_histogram('duration_seconds')
+        self.assertEqual(histogram.count, 2)
+        self.assertEqual(histogram.counts[0], 0)
+        self.assertEqual(histogram.counts[1], 1)
+        self.assertEqual(histogram.counts[-1], 2)
+        lines = metrics.render().splitlines()
+        self.assert_('duration_seconds_bucket{le="0.005"} 1' in lines)
+        self.assert_('duration_seconds_bucket{le="+Inf"} 2' in lines)
+        self.assert_('duration_seconds_sum 2.003' in lines)
+        self.assert_('duration_seconds_count 2' in lines)
+
+    def test_gauge(self):
+        """Check gauges are read when the metrics are rendered"""
+        metrics = landiallerd.Metrics()
+        values = [1, 2]
+        metrics.set_gauge('clients', 'Current clients.', lambda: values[0])
+        self.assert_('clients 1\n' in metrics.render())
+        del values[0]
+        self.assert_('clients 2\n' in metrics.render())
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'landiallerd.prof')
+        self.profiler = landiallerd.Profiler(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_disabled(self):
+        """Check calls are passed straight through when not profiling"""
+        self.assertEqual(self.profiler.call('double', lambda x: x * 2, 2), 4)
+        self.profiler.toggle()
+        self.profiler.toggle()
+        self.failIf(os.path.exists(self.profiler.path))
+        report = open(self.profiler.path + '.txt').read()
+        self.failIf('double' in report)
+
+    def test_timings(self):
+        """Check calls are timed while profiling"""
+        self.profiler.toggle()
+        self.assert_(self.profiler.is_enabled)
+        for i in range(3):
+            self.profiler.call('double', lambda x: x * 2, i)
+        self.profiler.toggle()
+        self.failIf(self.profiler.is_enabled)
+        report = open(self.profiler.path + '.txt').read().splitlines()
+        self.assertEqual(report[1].split()[:2], ['double', '3'])
+        if landiallerd.profile is not None:
+            self.assert_(os.path.exists(self.profiler.path))
+
+    def test_failing_call(self):
+        """Check calls that raise an exception are timed"""
+
+        def fail():
+            raise RuntimeError
+
+        self.profiler.toggle()
+        self.assertRaises(RuntimeError, self.profiler.call, 'fail', fail)
+        self.profiler.toggle()
+        report = open(self.profiler.path + '.txt').read().splitlines()
+        self.assertEqual(report[1].split()[:2], ['fail', '1'])
+
+    def test_symlink_not_followed(self):
+        """Check the results replace a symlink rather than its target"""
+        victim = os.path.join(self.directory, 'victim')
+        open(victim, 'w').write('precious')
+        os.symlink(victim, self.profiler.path + '.txt')
+        self.profiler.toggle()
+        self.profiler.toggle()
+        self.assertEqual(open(victim).read(), 'precious')
+        self.failIf(os.path.islink(self.profiler.path + '.txt'))
+        names = os.listdir(self.directory)
+        names.sort()
+        self.assertEqual(names, ['landiallerd.prof.txt', 'victim'])
+
+
 class TimerTest(unittest.TestCase):
 
     def test_start(self):
@@ -79,6 +284,234 @@ class TimerTest(unittest.TestCase):
         self.assertEqual(timer.is_running, False)
 
 
+class ProbeTest(unittest.TestCase):
+
+    PROC_NET_DEV = (
+        'Inter-|   Receive                            |  Transmit\n'
+        ' face |bytes    packets errs drop fifo frame |bytes    packets\n'
+        '    lo:  345678    1234    0    0    0     0    345678    1234\n'
+        '  ppp0:    1566      23    0    0    0     0      2172      25\n')
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_file(self, path, contents):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'w')
+        f.write(contents)
+        f.close()
+        return path
+
+    def test_shell_probe(self):
+        """Check the shell probe uses the command's exit status"""
+        probe = landiallerd.ShellProbe(ModemTest.SUCCESSFUL_COMMAND)
+        self.assertEqual(probe.is_connected(), True)
+        probe = landiallerd.ShellProbe(ModemTest.FAILING_COMMAND)
+        self.assertEqual(probe.is_connected(), False)
+
+    def test_sysfs_probe(self):
+        """Check the sysfs probe reads the interface flags"""
+        self.write_file('ppp0/flags', '0x10d1\n')
+        self.write_file('ppp1/flags', '0x1090\n')
+        probe = landiallerd.SysfsProbe('ppp0', root=self.root)
+        self.assertEqual(probe.is_connected(), True)
+        probe = landiallerd.SysfsProbe('ppp1', root=self.root)
+        self.assertEqual(probe.is_connected(), False)
+        probe = landiallerd.SysfsProbe('ppp2', root=self.root)
+        self.assertEqual(probe.is_connected(), False)
+
+    def test_proc_probe(self):
+        """Check the proc probe looks for the interface"""
+        path = self.write_file('dev', self.PROC_NET_DEV)
+        probe = landiallerd.ProcNetDevProbe('ppp0', path=path)
+        self.assertEqual(probe.is_connected(), True)
+        probe = landiallerd.ProcNetDevProbe('ppp1', path=path)
+        self.assertEqual(probe.is_connected(), False)
+        probe = landiallerd.ProcNetDevProbe('ppp0', path=path + '.missing')
+        self.assertEqual(probe.is_connected(), False)
+
+    def test_ioctl_probe(self):
+        """Check the ioctl probe asks for the interface address"""
+        probe = landiallerd.IoctlProbe('lo')
+        self.assertEqual(probe.is_connected(), True)
+        probe = landiallerd.IoctlProbe('missing0')
+        self.assertEqual(probe.is_connected(), False)
+
+    def test_default_backend(self):
+        """Check the shell probe runs the is_connected command"""
+        config = mock.Mock({'get': ModemTest.SUCCESSFUL_COMMAND})
+        probe = landiallerd.create_probe(landiallerd.LinkSettings(config))
+        self.assert_(isinstance(probe, landiallerd.ShellProbe))
+        self.assertEqual(probe.command, ModemTest.SUCCESSFUL_COMMAND)
+
+    def test_probe_section(self):
+        """Check probes can be configured in other sections"""
+        config = ConfigParser.ConfigParser()
+        config.add_section('link isdn2')
+        config.set('link isdn2', 'connect', 'isdnctrl dial ippp1')
+        config.set('link isdn2', 'disconnect', 'isdnctrl hangup ippp1')
+        config.set('link isdn2', 'backend', 'proc')
+        config.set('link isdn2', 'interface', 'ippp1')
+        settings = landiallerd.LinkSettings(config, 'link isdn2', 'link isdn2')
+        probe = landiallerd.create_probe(settings)
+        self.assert_(isinstance(probe, landiallerd.ProcNetDevProbe))
+
+    def test_configured_backend(self):
+        """Check the configured probe backend is used"""
+        config = mock.Mock({'has_option': True, 'get': 'sysfs'})
+        probe = landiallerd.create_probe(landiallerd.LinkSettings(config))
+        self.assert_(isinstance(probe, landiallerd.SysfsProbe))
+        config = mock.Mock({'has_option': True, 'get': 'bogus'})
+        self.assertRaises(ValueError, landiallerd.LinkSettings, config)
+
+
+class SettingsTest(unittest.TestCase):
+
+    def make_config(self):
+        config = ConfigParser.ConfigParser()
+        config.add_section('commands')
+        config.set('commands', 'connect', 'pon')
+        config.set('commands', 'disconnect', 'poff -a')
+        config.set('commands', 'is_connected', 'true')
+        config.add_section('general')
+        config.set('general', 'port', '6543')
+        return config
+
+    def test_defaults(self):
+        """Check unset options are given their default values"""
+        settings = landiallerd.Settings(self.make_config())
+        self.assertEqual(settings.port, 6543)
+        self.assertEqual(settings.link.connect, 'pon')
+        self.assertEqual(settings.link.timeout, None)
+        self.assertEqual(settings.interface, 'ppp0')
+        self.assertEqual(settings.workers,
+                         landiallerd.PooledXMLRPCServer.WORKERS)
+        self.assertEqual(settings.state_file, None)
+        self.assertEqual(settings.links, ())
+
+    def test_invalid_options(self):
+        """Check invalid config files are rejected"""
+        config = self.make_config()
+        config.set('general', 'workers', '0')
+        self.assertRaises(ValueError, landiallerd.Settings, config)
+        config = self.make_config()
+        config.remove_option('general', 'port')
+        self.assertRaises(ValueError, landiallerd.Settings, config)
+        config = self.make_config()
+        config.add_section('link isdn2')
+        self.assertRaises(ValueError, landiallerd.Settings, config)
+
+    def test_read_only(self):
+        """Check settings can't be changed once they've been read"""
+        settings = landiallerd.Settings(self.make_config())
+        self.assertRaises(AttributeError, setattr, settings, 'port', 80)
+        self.assertRaises(AttributeError, setattr, settings.link, 'connect',
+                          'true')
+
+    def test_restart_options(self):
+        """Check we can tell which changes need a restart"""
+        config = self.make_config()
+        settings = landiallerd.Settings(config)
+        config.set('general', 'workers', '8')
+        config.set('commands', 'timeout', '10')
+        self.assertEqual(
+            settings.get_restart_options(landiallerd.Settings(config)), [])
+        config.set('general', 'port', '6544')
+        config.set('general', 'state_file', '/tmp/landiallerd.state')
+        self.assertEqual(
+            settings.get_restart_options(landiallerd.Settings(config)),
+            ['port', 'state_file'])
+
+
+class CommandSupervisorTest(unittest.TestCase):
+
+    def wait_for_children(self, supervisor):
+        for i in range(100):
+            supervisor.poll()
+            if supervisor.count_children() == 0:
+                break
+            time.sleep(0.01)
+
+    def test_spawn(self):
+        """Check commands are run in the background and reaped"""
+        statuses = []
+        supervisor = landiallerd.CommandSupervisor()
+        supervisor.spawn('exit 0', statuses.append)
+        supervisor.spawn('exit 3', statuses.append)
+        self.wait_for_children(supervisor)
+        statuses.sort()
+        self.assertEqual(statuses, [0, 3 << 8])
+
+    def test_timeout(self):
+        """Check commands are terminated when they time out"""
+        statuses = []
+        supervisor = landiallerd.CommandSupervisor()
+        supervisor.spawn('sleep 5', statuses.append, timeout=0.05)
+        time.sleep(0.1)
+        self.wait_for_children(supervisor)
+        self.assertEqual(len(statuses), 1)
+        self.assert_(os.WIFSIGNALED(statuses[0]))
+
+    def test_kill_escalation(self):
+        """Check commands that ignore SIGTERM are killed"""
+        statuses = []
+        supervisor = landiallerd.CommandSupervisor()
+        supervisor.KILL_GRACE = 0.05
+        supervisor.spawn('trap "" TERM; while :; do sleep 0.01; done',
+                         statuses.append, timeout=0.05)
+        time.sleep(0.1)
+        supervisor.poll()  # sends SIGTERM
+        time.sleep(0.1)
+        self.wait_for_children(supervisor)
+        self.assertEqual(len(statuses), 1)
+        self.assertEqual(os.WTERMSIG(statuses[0]), signal.SIGKILL)
+
+    def test_failing_callback(self):
+        """Check an exception in a callback doesn't stop the supervisor"""
+        statuses = []
+
+        def fail(status):
+            raise RuntimeError
+
+        supervisor = landiallerd.CommandSupervisor()
+        supervisor.spawn('exit 0', fail)
+        supervisor.spawn('exit 0', statuses.append)
+        self.wait_for_children(supervisor)
+        self.assertEqual(statuses, [0])
+
+    def test_supervisor_thread(self):
+        """Check the supervisor can be polled from a thread"""
+        statuses = []
+        supervisor = landiallerd.CommandSupervisor()
+        supervisor.POLL_PERIOD = 0.01
+        thread = landiallerd.CommandSupervisorThread(supervisor)
+        thread.start()
+        try:
+            supervisor.spawn('exit 2', statuses.append)
+            for i in range(100):
+                if statuses:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(statuses, [2 << 8])
+        finally:
+            thread.finished.set()
+            thread.join()
+
+    def test_spawn_returns_immediately(self):
+        """Check spawning a command doesn't wait for it to finish"""
+        supervisor = landiallerd.CommandSupervisor()
+        started = time.time()
+        supervisor.spawn('sleep 1')
+        self.assert_(time.time() - started < 0.5)
+        self.assertEqual(supervisor.count_children(), 1)
+        self.wait_for_children(supervisor)
+
+
 class ModemTest(unittest.TestCase):
 
     SUCCESSFUL_COMMAND = 'ls / > /dev/null'
@@ -87,7 +520,7 @@ class ModemTest(unittest.TestCase):
     def test_dial(self):
         """Check we can dial the modem and receive the return code"""
         config = mock.Mock({'get': self.SUCCESSFUL_COMMAND})
-        modem = landiallerd.Modem(config)
+        modem = landiallerd.Modem(landiallerd.LinkSettings(config))
         try:
             real_os = landiallerd.os
             mock_os = mock.Mock()
@@ -98,10 +531,24 @@ class ModemTest(unittest.TestCase):
         finally:
             landiallerd.os = real_os
 
+    def test_section(self):
+        """Check the modem can run the commands from any section"""
+        config = ConfigParser.ConfigParser()
+        config.add_section('link isdn2')
+        config.set('link isdn2', 'connect', self.SUCCESSFUL_COMMAND)
+        config.set('link isdn2', 'disconnect', self.FAILING_COMMAND)
+        config.set('link isdn2', 'is_connected', self.FAILING_COMMAND)
+        settings = landiallerd.LinkSettings(config, 'link isdn2', 'link isdn2')
+        modem = landiallerd.Modem(settings, mock.Mock())
+        modem.supervisor = mock.Mock()
+        modem.connect()
+        call = modem.supervisor.getNamedCalls('spawn')[0]
+        self.assertEqual(call.getParam(0), self.SUCCESSFUL_COMMAND)
+
     def test_disconnect(self):
         """Check we can hang up the modem and receive the return code"""
         config = mock.Mock({'get': self.SUCCESSFUL_COMMAND})
-        modem = landiallerd.Modem(config)
+        modem = landiallerd.Modem(landiallerd.LinkSettings(config))
         try:
             real_os = landiallerd.os
             mock_os = mock.Mock()
@@ -115,7 +562,7 @@ class ModemTest(unittest.TestCase):
     def test_is_connected(self):
         """Check we can test if we're connected"""
         config = mock.Mock({'get': self.SUCCESSFUL_COMMAND})
-        modem = landiallerd.Modem(config)
+        modem = landiallerd.Modem(landiallerd.LinkSettings(config))
         try:
             real_os = landiallerd.os
             mock_os = mock.Mock({'system': 0})
@@ -130,7 +577,7 @@ class ModemTest(unittest.TestCase):
     def test_timer(self):
         """Check the timer is stopped when we hang up"""
         config = mock.Mock({'get': self.SUCCESSFUL_COMMAND})
-        modem = landiallerd.Modem(config)
+        modem = landiallerd.Modem(landiallerd.LinkSettings(config))
         modem.connect()
         modem.is_connected()
         self.assertEqual(modem.timer.is_running, True)
@@ -148,10 +595,68 @@ class ModemTest(unittest.TestCase):
         finally:
             landiallerd.time = real_time
 
+    def test_probe(self):
+        """Check the modem asks its probe whether we're connected"""
+        probe = mock.Mock({'is_connected': True})
+        settings = landiallerd.LinkSettings(mock.Mock())
+        modem = landiallerd.Modem(settings, probe)
+        self.assertEqual(modem.is_connected(), True)
+        self.assertEqual(len(probe.getNamedCalls('is_connected')), 1)
+
+    def test_supervised_dial(self):
+        """Check the modem can dial through a command supervisor"""
+        config = mock.Mock({'get': self.SUCCESSFUL_COMMAND})
+        modem = landiallerd.Modem(landiallerd.LinkSettings(config))
+        modem.supervisor = mock.Mock()
+        modem.connect()
+        modem.disconnect()
+        calls = modem.supervisor.getNamedCalls('spawn')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0].getParam(0), self.SUCCESSFUL_COMMAND)
+
+    def test_command_timeout(self):
+        """Check the supervisor is given the configured timeout"""
+        config = ConfigParser.ConfigParser()
+        config.add_section('commands')
+        for option in ('connect', 'disconnect', 'is_connected'):
+            config.set('commands', option, self.SUCCESSFUL_COMMAND)
+        config.set('commands', 'timeout', '12.5')
+        modem = landiallerd.Modem(landiallerd.LinkSettings(config),
+                                  mock.Mock())
+        modem.supervisor = mock.Mock()
+        modem.connect()
+        call = modem.supervisor.getNamedCalls('spawn')[0]
+        self.assertEqual(call.getParam(2), 12.5)
+
+    def test_apply_settings(self):
+        """Check new settings are used, and the probe replaced if needed"""
+        config = ConfigParser.ConfigParser()
+        config.add_section('commands')
+        for option in ('connect', 'disconnect', 'is_connected'):
+            config.set('commands', option, self.SUCCESSFUL_COMMAND)
+        modem = landiallerd.Modem(landiallerd.LinkSettings(config))
+        probe = modem.probe
+        config.set('commands', 'connect', self.FAILING_COMMAND)
+        modem.apply_settings(landiallerd.LinkSettings(config))
+        self.assert_(modem.probe is probe)
+        self.assertEqual(modem.settings.connect, self.FAILING_COMMAND)
+        config.add_section('probe')
+        config.set('probe', 'backend', 'proc')
+        modem.apply_settings(landiallerd.LinkSettings(config))
+        self.assert_(isinstance(modem.probe, landiallerd.ProcNetDevProbe))
+
+    def test_exit_status_reported(self):
+        """Check the exit status of a command is passed to the caller"""
+        config = mock.Mock({'get': self.FAILING_COMMAND})
+        modem = landiallerd.Modem(landiallerd.LinkSettings(config))
+        statuses = []
+        modem.connect(statuses.append)
+        self.assertNotEqual(statuses[0], 0)
+
     def test_timer_not_started_unless_online(self):
         """Check the timer not started when not connected"""
         config = mock.Mock({'get': self.FAILING_COMMAND})
-        modem = landiallerd.Modem(config)
+        modem = landiallerd.Modem(landiallerd.LinkSettings(config))
         modem.is_connected()
         try:
             real_time = landiallerd.time
@@ -161,6 +666,642 @@ class ModemTest(unittest.TestCase):
             landiallerd.time = real_time
         
 
+class LinkMonitorTest(unittest.TestCase):
+
+    def test_cached_state(self):
+        """Check the monitor answers from its snapshot"""
+        modem = mock.Mock({'is_connected': True})
+        monitor = landiallerd.LinkMonitor(modem)
+        self.assertEqual(monitor.probe(), True)
+        self.assertEqual(monitor.is_connected(), True)
+        self.assertEqual(monitor.is_connected(), True)
+        self.assertEqual(len(modem.getNamedCalls('is_connected')), 1)
+
+    def test_stale_state_reprobed(self):
+        """Check a stale snapshot is refreshed by the caller"""
+        modem = mock.Mock({'is_connected': True})
+        monitor = landiallerd.LinkMonitor(modem, max_age=5)
+        monitor.probe()
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(6)
+            monitor.is_connected()
+            self.assertEqual(len(modem.getNamedCalls('is_connected')), 2)
+        finally:
+            landiallerd.time = real_time
+
+    def test_thread_probes(self):
+        """Check the monitor thread publishes snapshots"""
+        modem = mock.Mock({'is_connected': True})
+        monitor = landiallerd.LinkMonitor(modem)
+        monitor.start()
+        time.sleep(0.01)
+        monitor.stop()
+        monitor.join()
+        self.assertEqual(monitor.snapshot[0], True)
+        self.assert_(len(modem.getNamedCalls('is_connected')) > 0)
+
+    def test_dialling_wakes_thread(self):
+        """Check connecting or disconnecting causes a fresh probe"""
+        modem = mock.Mock({'is_connected': False})
+        monitor = landiallerd.LinkMonitor(modem, period=60)
+        monitor.start()
+        try:
+            time.sleep(0.01)
+            monitor.connect()
+            time.sleep(0.01)
+            self.assertEqual(len(modem.getNamedCalls('connect')), 1)
+            self.assertEqual(len(modem.getNamedCalls('is_connected')), 2)
+        finally:
+            monitor.stop()
+            monitor.join()
+
+
+    def test_probe_in_background(self):
+        """Check shell probes are run by the supervisor"""
+        probe = landiallerd.ShellProbe(ModemTest.SUCCESSFUL_COMMAND)
+        settings = landiallerd.LinkSettings(mock.Mock())
+        modem = landiallerd.Modem(settings, probe)
+        monitor = landiallerd.LinkMonitor(modem)
+        supervisor = landiallerd.CommandSupervisor()
+        monitor.probe_in_background(supervisor)
+        monitor.probe_in_background(supervisor)
+        self.assertEqual(supervisor.count_children(), 1)
+        CommandSupervisorTest('test_spawn').wait_for_children(supervisor)
+        self.assertEqual(monitor.snapshot[0], True)
+        self.assertEqual(modem.timer.is_running, True)
+
+    def test_native_probe_in_background(self):
+        """Check native probes are run directly"""
+        probe = mock.Mock({'is_connected': True})
+        settings = landiallerd.LinkSettings(mock.Mock())
+        modem = landiallerd.Modem(settings, probe)
+        monitor = landiallerd.LinkMonitor(modem)
+        supervisor = mock.Mock()
+        monitor.probe_in_background(supervisor)
+        self.assertEqual(len(supervisor.getNamedCalls('spawn')), 0)
+        self.assertEqual(monitor.snapshot[0], True)
+
+    def test_events(self):
+        """Check the link isn't probed while events are arriving"""
+        settings = landiallerd.LinkSettings(mock.Mock())
+        modem = landiallerd.Modem(settings, mock.Mock())
+        monitor = landiallerd.LinkMonitor(modem)
+        self.assertEqual(monitor.is_probe_due(), True)
+        proxy = landiallerd.ModemProxy(monitor)
+        version = proxy.version
+        monitor.receive_event(True)
+        self.assertEqual(proxy.version, version + 1)
+        self.assertEqual(monitor.is_connected(), True)
+        self.assertEqual(modem.timer.is_running, True)
+        self.assertEqual(monitor.is_probe_due(), False)
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(monitor.event_period)
+            self.assertEqual(monitor.is_connected(), True)
+            self.assertEqual(monitor.is_probe_due(), True)
+            monitor.event_period = None
+            self.assertEqual(monitor.is_probe_due(), False)
+        finally:
+            landiallerd.time = real_time
+        self.assertEqual(len(modem.probe.getNamedCalls('is_connected')), 0)
+        monitor.receive_event(False)
+        self.assertEqual(monitor.is_connected(), False)
+        self.assertEqual(modem.timer.is_running, False)
+
+    def test_never_stale(self):
+        """Check the caller needn't probe the link itself"""
+        modem = mock.Mock({'is_connected': True})
+        monitor = landiallerd.LinkMonitor(modem, max_age=None)
+        self.assertEqual(monitor.is_connected(), False)
+        self.assertEqual(len(modem.getNamedCalls('is_connected')), 0)
+
+
+class LinkEventListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'events')
+        self.monitor = mock.Mock()
+        self.listener = landiallerd.LinkEventListener(
+            self.path, {'ppp0': self.monitor})
+
+    def tearDown(self):
+        self.listener.close()
+        shutil.rmtree(self.directory)
+
+    def send(self, message):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.sendto(message, self.path)
+        sock.close()
+
+    def get_events(self):
+        calls = self.monitor.getNamedCalls('receive_event')
+        return [call.getParam(0) for call in calls]
+
+    def test_events(self):
+        """Check events are passed to the interface's monitor"""
+        self.send('up ppp0\n')
+        self.listener.read()
+        self.send('down ppp0\n')
+        self.listener.read()
+        self.assertEqual(self.get_events(), [True, False])
+
+    def test_unknown_events_ignored(self):
+        """Check events for other interfaces are ignored"""
+        for message in ('up ppp1', 'sideways ppp0', 'garbage'):
+            self.send(message)
+            self.listener.read()
+        self.assertEqual(self.get_events(), [])
+
+    def test_thread(self):
+        """Check the listener thread reads events"""
+        self.listener.start()
+        try:
+            self.send('up ppp0')
+            for i in range(100):
+                if self.get_events():
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.get_events(), [True])
+        finally:
+            self.listener.stop()
+            self.listener.join()
+
+    def test_stale_socket_replaced(self):
+        """Check the socket left by a previous server is replaced"""
+        self.listener.socket.close()
+        self.listener = landiallerd.LinkEventListener(
+            self.path, {'ppp0': self.monitor})
+        self.send('up ppp0')
+        self.listener.read()
+        self.assertEqual(self.get_events(), [True])
+
+    def test_socket_in_use(self):
+        """Check a running server's socket isn't taken from it"""
+        self.assertRaises(socket.error, landiallerd.LinkEventListener,
+                          self.path, {'ppp0': mock.Mock()})
+        self.send('up ppp0')
+        self.listener.read()
+        self.assertEqual(self.get_events(), [True])
+
+
+class LinkEventHookTest(unittest.TestCase):
+
+    def test_event(self):
+        """Check the event is chosen by the name the hook is run as"""
+        get_event = landiallerd_hook.get_event
+        self.assertEqual(get_event('/etc/ppp/ip-up.d/landiallerd'), 'up')
+        self.assertEqual(get_event('/etc/ppp/ip-down.d/landiallerd'), 'down')
+        self.assertEqual(get_event('/etc/ppp/ip-up.local'), 'up')
+        self.assertEqual(get_event('/usr/local/bin/landiallerd_hook.py'),
+                         None)
+
+    def test_interface(self):
+        """Check the interface is read from the arguments or environment"""
+        get_interface = landiallerd_hook.get_interface
+        saved = os.environ.get('PPP_IFACE')
+        try:
+            os.environ['PPP_IFACE'] = 'ppp1'
+            self.assertEqual(get_interface(['ppp0', '/dev/ttyS0']), 'ppp0')
+            self.assertEqual(get_interface([]), 'ppp1')
+            del os.environ['PPP_IFACE']
+            self.assertEqual(get_interface([]), None)
+        finally:
+            if saved is not None:
+                os.environ['PPP_IFACE'] = saved
+
+    def test_send_event(self):
+        """Check the hook's events are understood by the server"""
+        directory = tempfile.mkdtemp()
+        monitor = mock.Mock()
+        listener = landiallerd.LinkEventListener(
+            os.path.join(directory, 'events'), {'ppp0': monitor})
+        try:
+            landiallerd_hook.send_event('up', 'ppp0', listener.path)
+            listener.read()
+            calls = monitor.getNamedCalls('receive_event')
+            self.assertEqual([call.getParam(0) for call in calls], [True])
+        finally:
+            listener.close()
+            shutil.rmtree(directory)
+
+
+class DiscoveryResponderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.responder = landiallerd.DiscoveryResponder(0, 6543)
+        self.port = self.responder.socket.getsockname()[1]
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        self.client.close()
+        self.responder.close()
+
+    def send(self, message):
+        self.client.sendto(message, ('127.0.0.1', self.port))
+        self.responder.read()
+
+    def test_query_answered(self):
+        """Check a discovery query is answered with the server's port"""
+        self.send('LANDIALLER DISCOVER\n')
+        reply, address = self.client.recvfrom(512)
+        self.assertEqual(reply, 'LANDIALLER SERVER 6543\n')
+        self.assertEqual(address[1], self.port)
+
+    def test_other_messages_ignored(self):
+        """Check messages that aren't queries go unanswered"""
+        self.send('garbage')
+        self.client.settimeout(0.05)
+        self.assertRaises(socket.timeout, self.client.recvfrom, 512)
+
+
+class LinkPoolTest(unittest.TestCase):
+
+    PROC_NET_DEV = (
+        'Inter-|   Receive                            |  Transmit\n'
+        ' face |bytes    packets errs drop fifo frame |bytes    packets\n'
+        '  ppp0: %d 0 0 0 0 0 0 0 %d 0 0 0 0 0 0 0\n'
+        'ippp1: %d 0 0 0 0 0 0 0 %d 0 0 0 0 0 0 0\n')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.proc_net_dev = os.path.join(self.directory, 'dev')
+        self.write_byte_counts(0, 0)
+        self.proxy = mock.Mock({'count_clients': 1, 'is_connected': True})
+        self.monitor = mock.Mock({'is_connected': False})
+        self.link = landiallerd.ExtraLink('isdn2', self.monitor, clients=2,
+                                          throughput=1000, hold_time=0)
+        self.sampler = landiallerd.ThroughputSampler(
+            'ppp0', path=self.proc_net_dev)
+        self.pool = landiallerd.LinkPool(self.proxy, [self.link],
+                                         [self.sampler],
+                                         proc_net_dev=self.proc_net_dev)
+
+    def tearDown(self):
+        self.sampler.close()
+        shutil.rmtree(self.directory)
+
+    def write_byte_counts(self, received, sent, link_received=0,
+                          link_sent=0):
+        f = open(self.proc_net_dev, 'w')
+        f.write(self.PROC_NET_DEV %
+                (received, sent, link_received, link_sent))
+        f.close()
+
+    def test_idle(self):
+        """Check extra links aren't brought up when they're not needed"""
+        self.pool.balance()
+        self.assertEqual(len(self.monitor.getNamedCalls('connect')), 0)
+        self.assertEqual(self.pool.get_links(), [
+            {'name': 'isdn2', 'is_connected': False, 'is_needed': False}])
+
+    def test_bring_up_for_clients(self):
+        """Check extra links are brought up when there are enough clients"""
+        self.proxy.mockReturnValues['count_clients'] = 2
+        self.pool.balance()
+        self.pool.balance()
+        self.assertEqual(len(self.monitor.getNamedCalls('connect')), 1)
+        self.assertEqual(self.link.is_needed, True)
+        self.assertEqual(len(self.proxy.getNamedCalls('links_changed')), 1)
+
+    def test_bring_up_for_throughput(self):
+        """Check extra links are brought up when there's enough traffic"""
+        self.sampler.sample()
+        self.pool.balance()
+        self.write_byte_counts(1000000, 1000000)
+        self.sampler.sample()
+        self.pool.balance()
+        self.assert_(self.pool.throughput > 1000)
+        self.assertEqual(len(self.monitor.getNamedCalls('connect')), 1)
+
+    def test_extra_link_throughput(self):
+        """Check the traffic over the extra links is measured too"""
+        monitor = mock.Mock({'is_connected': True})
+        link = landiallerd.ExtraLink('isdn3', monitor, clients=10,
+                                     interface='ippp1')
+        pool = landiallerd.LinkPool(self.proxy, [self.link, link],
+                                    [self.sampler],
+                                    proc_net_dev=self.proc_net_dev)
+        pool.balance()
+        self.write_byte_counts(0, 0, 1000000, 1000000)
+        pool.balance()
+        self.assert_(pool.throughput > 1000)
+        self.assertEqual(len(self.monitor.getNamedCalls('connect')), 1)
+
+    def test_drop_when_idle(self):
+        """Check extra links are dropped when they're no longer needed"""
+        self.proxy.mockReturnValues['count_clients'] = 2
+        self.pool.balance()
+        self.proxy.mockReturnValues['count_clients'] = 1
+        self.pool.balance()
+        self.assertEqual(len(self.monitor.getNamedCalls('disconnect')), 1)
+        self.assertEqual(self.link.is_needed, False)
+
+    def test_hold_time(self):
+        """Check extra links stay up for their hold time"""
+        self.link.hold_time = 60
+        self.proxy.mockReturnValues['count_clients'] = 2
+        self.pool.balance()
+        self.proxy.mockReturnValues['count_clients'] = 1
+        self.pool.balance()
+        self.assertEqual(len(self.monitor.getNamedCalls('disconnect')), 0)
+
+    def test_drop_with_main_link(self):
+        """Check extra links are dropped when the main link goes down"""
+        self.link.hold_time = 60
+        self.proxy.mockReturnValues['count_clients'] = 2
+        self.pool.balance()
+        self.proxy.mockReturnValues['is_connected'] = False
+        self.pool.balance()
+        self.assertEqual(len(self.monitor.getNamedCalls('disconnect')), 1)
+
+    def fail_to_connect(self, attempt):
+        callback = self.monitor.getNamedCalls('connect')[attempt].getParam(0)
+        callback(1 << 8)
+
+    def test_failed_bring_up_retried(self):
+        """Check links are tried again later if they can't be brought up"""
+        self.proxy.mockReturnValues['count_clients'] = 2
+        self.pool.balance()
+        self.fail_to_connect(0)
+        self.assertEqual(self.link.is_needed, False)
+        self.pool.balance()
+        self.assertEqual(len(self.monitor.getNamedCalls('connect')), 1)
+        real_time = landiallerd.time
+        try:
+            landiallerd.time = MockTime(self.link.RETRY_DELAY)
+            self.pool.balance()
+            self.assertEqual(len(self.monitor.getNamedCalls('connect')), 2)
+            self.fail_to_connect(1)
+            self.pool.balance()
+            self.assertEqual(len(self.monitor.getNamedCalls('connect')), 2)
+            landiallerd.time = MockTime(self.link.RETRY_DELAY * 3)
+            self.pool.balance()
+            self.assertEqual(len(self.monitor.getNamedCalls('connect')), 3)
+        finally:
+            landiallerd.time = real_time
+
+    def test_stale_failure_ignored(self):
+        """Check a failure is ignored once the link's been brought up again"""
+        self.proxy.mockReturnValues['count_clients'] = 2
+        self.pool.balance()
+        self.proxy.mockReturnValues['count_clients'] = 1
+        self.pool.balance()
+        self.proxy.mockReturnValues['count_clients'] = 2
+        self.pool.balance()
+        self.fail_to_connect(0)
+        self.assertEqual(self.link.is_needed, True)
+        self.assert_(self.link.can_bring_up(time.time()))
+
+    def test_create_link(self):
+        """Check extra links are read from the config file"""
+        config = ConfigParser.ConfigParser()
+        config.add_section('link isdn2')
+        config.set('link isdn2', 'connect', 'isdnctrl dial ippp1')
+        config.set('link isdn2', 'disconnect', 'isdnctrl hangup ippp1')
+        config.set('link isdn2', 'is_connected', 'true')
+        config.set('link isdn2', 'clients', '3')
+        config.set('link isdn2', 'interface', 'ippp1')
+        settings = landiallerd.ExtraLinkSettings(config, 'link isdn2')
+        link = landiallerd.create_link(settings)
+        self.assertEqual(link.name, 'isdn2')
+        self.assertEqual(link.clients, 3)
+        self.assertEqual(link.throughput, None)
+        self.assertEqual(link.interface, 'ippp1')
+        config.remove_option('link isdn2', 'clients')
+        self.assertRaises(ValueError, landiallerd.ExtraLinkSettings, config,
+                          'link isdn2')
+
+    def test_status(self):
+        """Check the state of the links is included in the status"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        pool = landiallerd.LinkPool(proxy, [self.link])
+        proxy.link_pool = pool
+        version = proxy.version
+        pool.update()
+        self.assert_(proxy.version > version)
+        status = landiallerd.API(proxy).wait_for_status('client-id-1', -1, 0)
+        self.assertEqual(status['links'], pool.get_links())
+
+
+class ThroughputSamplerTest(unittest.TestCase):
+
+    PROC_NET_DEV = (
+        'Inter-|   Receive                            |  Transmit\n'
+        ' face |bytes    packets errs drop fifo frame |bytes    packets\n'
+        '    lo: %d 10 0 0 0 0 0 0 %d 10 0 0 0 0 0 0\n'
+        '  ppp0: %d %d 0 0 0 0 0 0 %d %d 0 0 0 0 0 0\n')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dev')
+        self.write_counters(0, 0, 0, 0)
+        self.sampler = landiallerd.ThroughputSampler(
+            'ppp0', capacity=1000, history=3, path=self.path)
+
+    def tearDown(self):
+        self.sampler.close()
+        shutil.rmtree(self.directory)
+
+    def write_counters(self, rx_bytes, rx_packets, tx_bytes, tx_packets,
+                       lo_bytes=0):
+        contents = self.PROC_NET_DEV % (lo_bytes, lo_bytes, rx_bytes,
+                                        rx_packets, tx_bytes, tx_packets)
+        f = open(self.path, 'w')
+        f.write(contents)
+        f.close()
+
+    def sample_at(self, offset):
+        saved = landiallerd.time
+        try:
+            landiallerd.time = MockTime(offset)
+            self.sampler.sample()
+        finally:
+            landiallerd.time = saved
+
+    def test_read_counters(self):
+        """Check the interface's byte and packet counters are read"""
+        self.write_counters(1566, 23, 2172, 25)
+        self.assertEqual(self.sampler.read_counters(), (1566, 2172, 23, 25))
+        self.write_counters(1600, 24, 2200, 26, lo_bytes=1234567)
+        self.assertEqual(self.sampler.read_counters(), (1600, 2200, 24, 26))
+        sampler = landiallerd.ThroughputSampler('ppp1', path=self.path)
+        self.assertEqual(sampler.read_counters(), None)
+        sampler = landiallerd.ThroughputSampler('pp0', path=self.path)
+        self.assertEqual(sampler.read_counters(), None)
+
+    def test_rates(self):
+        """Check the rates are calculated from successive samples"""
+        self.sample_at(0)
+        self.assertEqual(self.sampler.get_samples(), [])
+        self.write_counters(2000, 20, 500, 10)
+        self.sample_at(2)
+        self.assertEqual(len(self.sampler.get_samples()), 1)
+        rx_bytes, tx_bytes, rx_packets, tx_packets = \
+                  self.sampler.get_samples()[0]
+        self.assert_(990 < rx_bytes < 1010)
+        self.assert_(240 < tx_bytes < 260)
+        self.assert_(9 < rx_packets < 11)
+        self.assert_(4 < tx_packets < 6)
+
+    def test_observers(self):
+        """Check observers are notified as each sample is recorded"""
+
+        class Observer:
+            updates = 0
+
+            def update(self):
+                self.updates += 1
+
+        observer = Observer()
+        self.sampler.add_observer(observer)
+        self.sample_at(0)
+        self.sample_at(1)
+        self.assertEqual(observer.updates, 1)
+
+    def test_ring_buffer(self):
+        """Check only the most recent samples are kept"""
+        for i in range(5):
+            self.write_counters(i * 100, 0, 0, 0)
+            self.sample_at(i)
+        samples = self.sampler.get_samples()
+        self.assertEqual(len(samples), 3)
+        self.assertEqual(len(self.sampler.get_samples(2)), 2)
+        self.assertEqual(self.sampler.get_samples(2), samples[1:])
+
+    def test_bytes_per_second(self):
+        """Check the mean traffic over recent samples is calculated"""
+        self.assertEqual(self.sampler.get_bytes_per_second(10), 0.0)
+        self.sample_at(0)
+        self.write_counters(1000, 0, 1000, 0)
+        self.sample_at(1)
+        self.write_counters(1000, 0, 1000, 0)
+        self.sample_at(2)
+        rate = self.sampler.get_bytes_per_second(2)
+        self.assert_(900 < rate < 1100)
+        rate = self.sampler.get_bytes_per_second(0.5)
+        self.assert_(-1 < rate < 1)
+
+    def test_link_down(self):
+        """Check nothing is transferred while the interface is missing"""
+        self.write_counters(5000, 0, 0, 0)
+        self.sample_at(0)
+        f = open(self.path, 'w')
+        f.write(self.PROC_NET_DEV.split('  ppp0')[0] % (0, 0))
+        f.close()
+        self.sample_at(1)
+        self.write_counters(100, 0, 0, 0)
+        self.sample_at(2)
+        self.sample_at(3)
+        samples = self.sampler.get_samples()
+        self.assertEqual([s[0] for s in samples], [0, 0, 0])
+
+    def test_saturated(self):
+        """Check the link is saturated when running near its capacity"""
+        self.sample_at(0)
+        self.assertEqual(self.sampler.is_saturated(), False)
+        self.write_counters(950, 0, 0, 0)
+        self.sample_at(1)
+        self.assertEqual(self.sampler.is_saturated(), True)
+        self.sampler.capacity = 0
+        self.assertEqual(self.sampler.is_saturated(), False)
+
+    def test_get_throughput(self):
+        """Check the throughput can be fetched through the API"""
+        self.sample_at(0)
+        self.write_counters(3000, 0, 1000, 0)
+        self.sample_at(1)
+        api = landiallerd.API(mock.Mock(), sampler=self.sampler)
+        throughput = api.get_throughput()
+        self.assertEqual(throughput['interface'], 'ppp0')
+        self.assertEqual(throughput['capacity'], 1000)
+        self.assertEqual(throughput['is_saturated'], True)
+        self.assert_(2900 < throughput['rx_bytes_per_second'] <= 3000)
+        self.assertEqual(len(throughput['history']), 1)
+        self.assertEqual(throughput['history'][0][0],
+                         throughput['rx_bytes_per_second'])
+        api = landiallerd.API(mock.Mock())
+        self.assertRaises(xmlrpclib.Fault, api.get_throughput)
+
+
+class ClientRegistryTest(unittest.TestCase):
+
+    def test_membership(self):
+        """Check the registry knows which clients it contains"""
+        registry = landiallerd.ClientRegistry(30)
+        registry.touch('client-id-1')
+        registry.touch('client-id-1')
+        self.assert_('client-id-1' in registry)
+        self.assertEqual(len(registry), 1)
+        registry.remove('client-id-1')
+        registry.remove('client-id-1')  # mustn't raise
+        self.failIf('client-id-1' in registry)
+        self.assertEqual(len(registry), 0)
+
+    def test_expiry(self):
+        """Check clients expire after the timeout"""
+        registry = landiallerd.ClientRegistry(30)
+        registry.touch('client-id-1')
+        now = time.time()
+        self.assertEqual(registry.pop_expired(now + 29), [])
+        self.assertEqual(registry.pop_expired(now + 31), ['client-id-1'])
+
+    def test_expiry_at_deadline(self):
+        """Check clients expire at the deadline the sweeper waits for"""
+        registry = landiallerd.ClientRegistry(30)
+        registry.touch('client-id-1')
+        deadline = registry.next_deadline()
+        self.assertEqual(registry.pop_expired(deadline), ['client-id-1'])
+
+    def test_refresh_postpones_expiry(self):
+        """Check refreshed clients don't expire at their old deadline"""
+        registry = landiallerd.ClientRegistry(30)
+        registry.touch('client-id-1')
+        registry.touch('client-id-2')
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(20)
+            registry.touch('client-id-1')
+        finally:
+            landiallerd.time = real_time
+        now = time.time()
+        self.assertEqual(registry.pop_expired(now + 31), ['client-id-2'])
+        self.assertEqual(registry.pop_expired(now + 51), ['client-id-1'])
+
+    def test_removed_clients_dont_expire(self):
+        """Check removed clients aren't reported as expired"""
+        registry = landiallerd.ClientRegistry(30)
+        registry.touch('client-id-1')
+        registry.remove('client-id-1')
+        self.assertEqual(registry.pop_expired(time.time() + 31), [])
+        self.assertEqual(registry.next_deadline(), None)
+
+    def test_next_deadline(self):
+        """Check the registry knows when the next client expires"""
+        registry = landiallerd.ClientRegistry(30)
+        self.assertEqual(registry.next_deadline(), None)
+        before = time.time()
+        registry.touch('client-id-1')
+        registry.touch('client-id-2')
+        registry.touch('client-id-1')
+        registry.remove('client-id-2')
+        deadline = registry.next_deadline()
+        self.assert_(before + 30 <= deadline <= time.time() + 30)
+
+    def test_heap_bounded(self):
+        """Check refreshing clients doesn't grow the heap indefinitely"""
+        registry = landiallerd.ClientRegistry(30)
+        for i in range(1000):
+            registry.touch('client-id-%d' % (i % 10))
+        self.assert_(len(registry._deadlines) <= 36)
+        now = time.time()
+        self.assertEqual(len(registry.pop_expired(now + 31)), 10)
+
+
 class MockTimer:
 
     elapsed_seconds = 14
@@ -259,7 +1400,7 @@ class ModemProxyTest(unittest.TestCase):
     def test_timer(self):
         """Check the proxy can return time spent online"""
         timer = MockTimer()
-        modem = landiallerd.Modem(mock.Mock())
+        modem = landiallerd.Modem(landiallerd.LinkSettings(mock.Mock()))
         modem.timer = timer
         proxy = landiallerd.ModemProxy(modem)
         self.assertEqual(proxy.get_time_connected(), 14)
@@ -279,6 +1420,23 @@ class ModemProxyTest(unittest.TestCase):
         finally:
             landiallerd.time = real_time
 
+    def test_expired_clients_counted(self):
+        """Check the number of clients forgotten is recorded"""
+        name = 'landialler_expired_clients_total'
+        expired = landiallerd.metrics.get_counter(name)
+        modem = mock.Mock()
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.add_client('client-id-1')
+        proxy.add_client('client-id-2')
+        try:
+            real_time = landiallerd.time
+            offset = landiallerd.ModemProxy.CLIENT_TIMEOUT
+            landiallerd.time = MockTime(offset)
+            proxy.remove_old_clients()
+        finally:
+            landiallerd.time = real_time
+        self.assertEqual(landiallerd.metrics.get_counter(name), expired + 2)
+
     def test_forgetting_drops_connection(self):
         """Check forgetting the last client drops the connection"""
         modem = mock.Mock({'is_connected': True})
@@ -311,6 +1469,586 @@ class ModemProxyTest(unittest.TestCase):
         finally:
             landiallerd.time = real_time
 
+    def test_dial_phase(self):
+        """Check the proxy tracks the progress of dialling"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+        self.assertEqual(proxy.get_phase(), proxy.OFFLINE)
+        proxy.add_client('client-id-1')
+        self.assertEqual(proxy.get_phase(), proxy.DIALLING)
+        proxy._modem = mock.Mock({'is_connected': True})
+        self.assertEqual(proxy.get_phase(), proxy.ONLINE)
+        proxy.disconnect()
+        proxy._modem = modem
+        self.assertEqual(proxy.get_phase(), proxy.OFFLINE)
+
+    def test_dial_failure(self):
+        """Check the proxy notices when the connect command fails"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.add_client('client-id-1')
+        callback = modem.getNamedCalls('connect')[0].getParam(0)
+        version = proxy.version
+        callback(1 << 8)
+        self.assertEqual(proxy.get_phase(), proxy.FAILED)
+        self.assert_(proxy.version > version)
+        proxy.add_client('client-id-2')
+        self.assertEqual(len(modem.getNamedCalls('connect')), 2)
+        self.assertEqual(proxy.get_phase(), proxy.DIALLING)
+
+    def test_idle_phase(self):
+        """Check the clients are told when we hang up an idle link"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.add_client('client-id-1')
+        proxy.disconnect(is_idle=True)
+        self.assertEqual(proxy.get_phase(), proxy.IDLE)
+        self.assertEqual(proxy.count_clients(), 1)
+        proxy.add_client('client-id-1')
+        self.assertEqual(proxy.get_phase(), proxy.DIALLING)
+
+    def test_dial_duration(self):
+        """Check the time taken to dial is recorded"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.add_client('client-id-1')
+        histogram = landiallerd.metrics.get_histogram(
+            'landialler_dial_duration_seconds')
+        count = histogram and histogram.count or 0
+        proxy._modem = mock.Mock({'is_connected': True})
+        proxy.is_connected()
+        proxy.is_connected()
+        histogram = landiallerd.metrics.get_histogram(
+            'landialler_dial_duration_seconds')
+        self.assertEqual(histogram.count, count + 1)
+
+    def test_dial_success(self):
+        """Check a successful connect command leaves the proxy dialling"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.add_client('client-id-1')
+        modem.getNamedCalls('connect')[0].getParam(0)(0)
+        self.assertEqual(proxy.get_phase(), proxy.DIALLING)
+
+    def test_slow_command_doesnt_block(self):
+        """Check the status can be read while the modem is dialling"""
+        release = threading.Event()
+        dialling = threading.Event()
+
+        class SlowModem:
+            timer = MockTimer()
+
+            def is_connected(self):
+                return False
+
+            def connect(self, callback):
+                dialling.set()
+                release.wait(5)
+
+        proxy = landiallerd.ModemProxy(SlowModem())
+        thread = threading.Thread(target=proxy.add_client,
+                                  args=('client-id-1',))
+        thread.start()
+        try:
+            dialling.wait(5)
+            answered = threading.Event()
+            reader = threading.Thread(
+                target=lambda: (proxy.get_status(), answered.set()))
+            reader.start()
+            answered.wait(5)
+            self.assert_(answered.isSet())
+            self.failIf(release.isSet())
+            self.assertEqual(proxy.get_phase(), proxy.DIALLING)
+        finally:
+            release.set()
+            thread.join()
+            reader.join()
+
+    def test_observers_notified_after_change(self):
+        """Check observers see the change once it's complete"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+
+        def try_lock(results):
+            results.append(proxy._lock.acquire(False))
+            if results[-1]:
+                proxy._lock.release()
+
+        class Observer:
+            def __init__(self):
+                self.seen = []
+
+            def update(self):
+                is_unlocked = []
+                thread = threading.Thread(target=try_lock,
+                                          args=(is_unlocked,))
+                thread.start()
+                thread.join()
+                self.seen.append((is_unlocked[0],
+                                  len(modem.getNamedCalls('connect'))))
+
+        observer = Observer()
+        proxy.add_observer(observer)
+        proxy.add_client('client-id-1')
+        self.assertEqual(observer.seen, [(True, 1)])
+
+    def test_failed_command_callback(self):
+        """Check a command that fails straight away is reported"""
+        modem = mock.Mock({'is_connected': False})
+        modem.connect = lambda callback: callback(1)
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.add_client('client-id-1')
+        self.assertEqual(proxy.get_phase(), proxy.FAILED)
+
+    def test_seconds_until_expiry(self):
+        """Check the proxy knows when the next client will expire"""
+        proxy = landiallerd.ModemProxy(mock.Mock())
+        self.assertEqual(proxy.seconds_until_expiry(), proxy.CLIENT_TIMEOUT)
+        proxy.add_client('client-id-1')
+        self.assert_(proxy.seconds_until_expiry() <= proxy.CLIENT_TIMEOUT)
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(proxy.CLIENT_TIMEOUT + 1)
+            self.assertEqual(proxy.seconds_until_expiry(), 0)
+        finally:
+            landiallerd.time = real_time
+
+    def test_concurrent_clients(self):
+        """Check the proxy can be shared between threads"""
+        modem = mock.Mock({'is_connected': True})
+        proxy = landiallerd.ModemProxy(modem)
+
+        def churn(name):
+            for i in range(50):
+                proxy.add_client('%s-%d' % (name, i))
+            for i in range(50):
+                proxy.remove_client('%s-%d' % (name, i))
+
+        threads = []
+        for i in range(4):
+            thread = threading.Thread(target=churn, args=('client-%d' % i,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(proxy.count_clients(), 0)
+
+    def test_version(self):
+        """Check the proxy's version changes with its state"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+        version = proxy.version
+        proxy.add_client('client-id-1')
+        self.assert_(proxy.version > version)
+        version = proxy.version
+        proxy.refresh_client('client-id-1')
+        proxy.is_connected()
+        self.assertEqual(proxy.version, version)
+        proxy._modem = mock.Mock({'is_connected': True})
+        proxy.is_connected()
+        self.assert_(proxy.version > version)
+        version = proxy.version
+        proxy.remove_client('client-id-1')
+        self.assert_(proxy.version > version)
+
+    def test_link_changes_observed(self):
+        """Check the proxy notices when the monitor sees the link change"""
+        probe = mock.Mock({'is_connected': True})
+        settings = landiallerd.LinkSettings(mock.Mock())
+        monitor = landiallerd.LinkMonitor(landiallerd.Modem(settings, probe))
+        proxy = landiallerd.ModemProxy(monitor)
+        version = proxy.version
+        monitor.probe()
+        self.assert_(proxy.version > version)
+        self.assertEqual(proxy._was_connected, True)
+
+    def test_wait_for_change(self):
+        """Check waiting for a change returns when the state changes"""
+        modem = mock.Mock({'is_connected': True})
+        proxy = landiallerd.ModemProxy(modem)
+        version = proxy.version
+        timer = threading.Timer(0.05, proxy.add_client, ('client-id-1',))
+        timer.start()
+        started = time.time()
+        self.assert_(proxy.wait_for_change(version, 5) > version)
+        self.assert_(time.time() - started < 1)
+        timer.join()
+
+    def test_wait_for_change_timeout(self):
+        """Check waiting for a change gives up after the timeout"""
+        proxy = landiallerd.ModemProxy(mock.Mock())
+        self.assertEqual(proxy.wait_for_change(proxy.version, 0.01),
+                         proxy.version)
+
+    def test_release_waiters(self):
+        """Check waiting threads can be told to stop waiting"""
+        proxy = landiallerd.ModemProxy(mock.Mock())
+        version = proxy.version
+        timer = threading.Timer(0.05, proxy.release_waiters)
+        timer.start()
+        started = time.time()
+        self.assert_(proxy.wait_for_change(version, 5) > version)
+        self.assert_(time.time() - started < 1)
+        timer.join()
+
+
+class StateFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_proxy(self, is_connected=True):
+        modem = mock.Mock({'is_connected': is_connected})
+        modem.timer = landiallerd.Timer()
+        return landiallerd.ModemProxy(modem)
+
+    def test_state_saved_on_change(self):
+        """Check the state is saved when the clients change"""
+        proxy = self.create_proxy()
+        landiallerd.StateFile(self.path, proxy).restore()
+        self.failIf(os.path.exists(self.path))
+        proxy.add_client('client-id-1')
+        state = landiallerd.StateFile(self.path, proxy).load()
+        self.assertEqual(state['clients'], ['client-id-1'])
+        self.assertEqual(state['is_connected'], True)
+        self.assertEqual(os.listdir(self.directory), ['state'])
+
+    def test_symlink_not_followed(self):
+        """Check the state isn't written through a planted symlink"""
+        victim = os.path.join(self.directory, 'victim')
+        open(victim, 'w').write('precious')
+        os.symlink(victim, '%s.%d' % (self.path, os.getpid()))
+        proxy = self.create_proxy()
+        landiallerd.StateFile(self.path, proxy).save()
+        self.assertEqual(open(victim).read(), 'precious')
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+        self.failIf(os.path.islink(self.path))
+
+    def test_restore(self):
+        """Check a restarted server carries on without dialling"""
+        proxy = self.create_proxy()
+        landiallerd.StateFile(self.path, proxy).restore()
+        proxy.add_client('client-id-1')
+        proxy.add_client('client-id-2')
+        start_time = proxy._modem.timer.start_time
+        new_proxy = self.create_proxy()
+        landiallerd.StateFile(self.path, new_proxy).restore()
+        self.assertEqual(new_proxy.count_clients(), 2)
+        self.assertEqual(new_proxy._modem.timer.start_time, start_time)
+        self.assert_(new_proxy.version > proxy.version)
+        new_proxy.add_client('client-id-1')
+        modem = new_proxy._modem
+        self.assertEqual(len(modem.getNamedCalls('connect')), 0)
+        self.assertEqual(len(modem.getNamedCalls('is_connected')), 1)
+
+    def test_restore_while_dialling(self):
+        """Check a restarted server doesn't dial again"""
+        proxy = self.create_proxy(is_connected=False)
+        landiallerd.StateFile(self.path, proxy).restore()
+        proxy.add_client('client-id-1')
+        new_proxy = self.create_proxy(is_connected=False)
+        landiallerd.StateFile(self.path, new_proxy).restore()
+        self.assertEqual(new_proxy.get_phase(), new_proxy.DIALLING)
+        new_proxy.add_client('client-id-2')
+        modem = new_proxy._modem
+        self.assertEqual(len(modem.getNamedCalls('connect')), 0)
+
+    def test_restored_dial_times_out(self):
+        """Check a restored dial fails if the link doesn't come up"""
+        proxy = self.create_proxy(is_connected=False)
+        landiallerd.StateFile(self.path, proxy).restore()
+        proxy.add_client('client-id-1')
+        new_proxy = self.create_proxy(is_connected=False)
+        landiallerd.StateFile(self.path, new_proxy).restore()
+        saved = landiallerd.time
+        try:
+            landiallerd.time = MockTime(new_proxy.RESTORED_DIAL_TIMEOUT + 1)
+            self.assertEqual(new_proxy.get_phase(), new_proxy.FAILED)
+        finally:
+            landiallerd.time = saved
+        new_proxy.add_client('client-id-2')
+        self.assertEqual(new_proxy.get_phase(), new_proxy.DIALLING)
+        modem = new_proxy._modem
+        self.assertEqual(len(modem.getNamedCalls('connect')), 1)
+
+    def test_incomplete_state(self):
+        """Check missing values in the state file take their defaults"""
+        f = open(self.path, 'wb')
+        f.write(marshal.dumps((landiallerd.StateFile.FORMAT, time.time(),
+                               {'clients': ['client-id-1']})))
+        f.close()
+        proxy = self.create_proxy(is_connected=False)
+        landiallerd.StateFile(self.path, proxy).restore()
+        self.assertEqual(proxy.count_clients(), 1)
+        self.assertEqual(proxy.get_phase(), proxy.OFFLINE)
+
+    def test_old_state_ignored(self):
+        """Check state saved long ago is ignored"""
+        proxy = self.create_proxy()
+        state_file = landiallerd.StateFile(self.path, proxy)
+        state_file.restore()
+        proxy.add_client('client-id-1')
+        saved = landiallerd.time
+        try:
+            landiallerd.time = MockTime(state_file.MAX_AGE + 1)
+            self.assertEqual(state_file.load(), None)
+        finally:
+            landiallerd.time = saved
+
+    def test_heartbeat(self):
+        """Check a quiet link's state is still restored after a crash"""
+        proxy = self.create_proxy()
+        state_file = landiallerd.StateFile(self.path, proxy)
+        state_file.restore()
+        proxy.add_client('client-id-1')
+        saved = landiallerd.time
+        try:
+            for offset in range(0, state_file.MAX_AGE * 3,
+                                state_file.HEARTBEAT_PERIOD):
+                landiallerd.time = MockTime(offset)
+                state_file.heartbeat()
+            landiallerd.time = MockTime(state_file.MAX_AGE * 3)
+            state = state_file.load()
+        finally:
+            landiallerd.time = saved
+        self.assertEqual(state['clients'], ['client-id-1'])
+
+    def test_no_heartbeat_without_clients(self):
+        """Check the state isn't saved again when nobody is connected"""
+        proxy = self.create_proxy()
+        state_file = landiallerd.StateFile(self.path, proxy)
+        state_file.restore()
+        state_file.heartbeat()
+        self.failIf(os.path.exists(self.path))
+
+    def test_corrupt_state_ignored(self):
+        """Check the server starts afresh if the state file is corrupt"""
+        f = open(self.path, 'w')
+        f.write('garbage')
+        f.close()
+        proxy = self.create_proxy()
+        landiallerd.StateFile(self.path, proxy).restore()
+        self.assertEqual(proxy.count_clients(), 0)
+
+    def test_sessions_restored(self):
+        """Check a restarted server carries on with the open sessions"""
+        proxy = self.create_proxy()
+        proxy.accounting = landiallerd.AccountingLog(self.directory)
+        landiallerd.StateFile(self.path, proxy).restore()
+        proxy.accounting.start_session('client-id-1', 1000)
+        proxy.add_client('client-id-1')
+        proxy.accounting.close()
+        new_proxy = self.create_proxy()
+        new_proxy.accounting = landiallerd.AccountingLog(self.directory)
+        landiallerd.StateFile(self.path, new_proxy).restore()
+        self.assertEqual(new_proxy.accounting.get_open_sessions(),
+                         {'client-id-1': 1000})
+        new_proxy.accounting.close()
+
+
+class AccountingLogTest(unittest.TestCase):
+
+    DAY = landiallerd.AccountingLog.SECONDS_PER_DAY
+    START = 12000 * DAY  # midnight, some time in 2002
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'accounting')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, accounting, client_id, start, stop):
+        accounting.start_session(client_id, self.START + start)
+        accounting.stop_session(client_id, self.START + stop)
+
+    def test_sessions_recorded(self):
+        """Check the length and number of each client's sessions is kept"""
+        accounting = landiallerd.AccountingLog(self.path)
+        self.record(accounting, 'client-id-1', 0, 60)
+        self.record(accounting, 'client-id-1', 100, 130)
+        self.record(accounting, 'client-id-2', 100, 110)
+        self.assertEqual(accounting.get_usage(), {'client-id-1': [2, 90],
+                                                  'client-id-2': [1, 10]})
+        accounting.close()
+
+    def test_open_sessions_counted(self):
+        """Check sessions in progress count up to the present"""
+        accounting = landiallerd.AccountingLog(self.path)
+        accounting.start_session('client-id-1', time.time() - 10)
+        sessions, seconds = accounting.get_usage()['client-id-1']
+        self.assertEqual(sessions, 1)
+        self.assert_(10 <= seconds <= 11)
+        self.assertEqual(accounting.get_usage(end=self.START), {})
+        accounting.close()
+
+    def test_usage_by_time(self):
+        """Check usage can be limited to the sessions that ended in a range"""
+        accounting = landiallerd.AccountingLog(self.path)
+        self.record(accounting, 'client-id-1', 0, 60)
+        self.record(accounting, 'client-id-1', self.DAY - 10, self.DAY + 10)
+        self.record(accounting, 'client-id-2', 3 * self.DAY, 3 * self.DAY + 5)
+        usage = accounting.get_usage(self.START + self.DAY,
+                                     self.START + 2 * self.DAY)
+        self.assertEqual(usage, {'client-id-1': [1, 20]})
+        usage = accounting.get_usage(self.START + 30, self.START + 61)
+        self.assertEqual(usage, {'client-id-1': [1, 60]})
+        usage = accounting.get_usage(start=self.START + 2 * self.DAY)
+        self.assertEqual(usage, {'client-id-2': [1, 5]})
+        usage = accounting.get_usage(end=self.START + 2 * self.DAY)
+        self.assertEqual(usage, {'client-id-1': [2, 80]})
+        accounting.close()
+
+    def test_reopen(self):
+        """Check the log and its indexes are read back when reopened"""
+        accounting = landiallerd.AccountingLog(self.path)
+        self.record(accounting, u'client-\xe9', 0, 60)
+        self.record(accounting, 'client-id-2', self.DAY, self.DAY + 10)
+        accounting.close()
+        accounting = landiallerd.AccountingLog(self.path)
+        self.record(accounting, 'client-id-2', self.DAY, self.DAY + 10)
+        usage = accounting.get_usage()
+        self.assertEqual(usage, {'client-\xc3\xa9': [1, 60],
+                                 'client-id-2': [2, 20]})
+        usage = accounting.get_usage(start=self.START + self.DAY)
+        self.assertEqual(usage, {'client-id-2': [2, 20]})
+        f = open(os.path.join(self.path, 'clients'))
+        self.assertEqual(len(f.readlines()), 2)
+        f.close()
+        accounting.close()
+
+    def test_damage_repaired(self):
+        """Check a half written record and stale totals are recovered from"""
+        accounting = landiallerd.AccountingLog(self.path)
+        self.record(accounting, 'client-id-1', 0, 60)
+        accounting.close()
+        totals = open(os.path.join(self.path, 'totals'), 'rb').read()
+        accounting = landiallerd.AccountingLog(self.path)
+        self.record(accounting, 'client-id-1', 100, 110)
+        accounting.close()
+        f = open(os.path.join(self.path, 'totals'), 'wb')
+        f.write(totals)
+        f.close()
+        f = open(os.path.join(self.path, 'sessions'), 'ab')
+        f.write('\0\0')
+        f.close()
+        accounting = landiallerd.AccountingLog(self.path)
+        self.assertEqual(accounting.get_usage(), {'client-id-1': [2, 70]})
+        self.record(accounting, 'client-id-1', 200, 201)
+        usage = accounting.get_usage(start=self.START)
+        self.assertEqual(usage, {'client-id-1': [3, 71]})
+        accounting.close()
+
+    def test_late_record(self):
+        """Check sessions recorded after the next day's are found by time"""
+        accounting = landiallerd.AccountingLog(self.path)
+        self.record(accounting, 'client-id-1', 0, self.DAY + 5)
+        self.record(accounting, 'client-id-2', 0, self.DAY - 5)
+        usage = accounting.get_usage(self.START, self.START + self.DAY - 1)
+        self.assertEqual(usage, {'client-id-2': [1, self.DAY - 5]})
+        usage = accounting.get_usage(start=self.START + self.DAY)
+        self.assertEqual(usage, {'client-id-1': [1, self.DAY + 5]})
+        accounting.close()
+
+    def test_totals_saved(self):
+        """Check the totals are saved periodically and when closed"""
+        path = os.path.join(self.path, 'totals')
+        accounting = landiallerd.AccountingLog(self.path)
+        accounting.SAVE_INTERVAL = 2
+        self.record(accounting, 'client-id-1', 0, 60)
+        self.failIf(os.path.exists(path))
+        self.record(accounting, 'client-id-1', 100, 110)
+        self.assert_(os.path.exists(path))
+        self.record(accounting, 'client-id-1', 200, 210)
+        accounting.close()
+        accounting.close()
+        format, count, totals = marshal.loads(open(path, 'rb').read())
+        self.assertEqual(count, 3)
+        names = os.listdir(self.path)
+        names.sort()
+        self.assertEqual(names, ['clients', 'days', 'sessions', 'totals'])
+
+    def test_proxy_records_sessions(self):
+        """Check the proxy records when clients come and go"""
+        accounting = landiallerd.AccountingLog(self.path)
+        proxy = landiallerd.ModemProxy(mock.Mock({'is_connected': True}))
+        proxy.accounting = accounting
+        proxy.add_client('client-id-1')
+        proxy.refresh_client('client-id-2')
+        self.assertEqual(len(accounting.get_open_sessions()), 2)
+        proxy.remove_client('client-id-1')
+        saved = landiallerd.time
+        try:
+            landiallerd.time = MockTime(proxy.CLIENT_TIMEOUT + 1)
+            proxy.remove_old_clients()
+        finally:
+            landiallerd.time = saved
+        self.assertEqual(accounting.get_open_sessions(), {})
+        usage = accounting.get_usage()
+        self.assertEqual(usage['client-id-2'][0], 1)
+        self.assert_(usage['client-id-2'][1] <= 1)  # not the timeout
+        accounting.close()
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_token_bucket(self):
+        """Check the bucket allows bursts, and refills over time"""
+        bucket = landiallerd.TokenBucket(2, 3)
+        now = time.time()
+        for i in range(3):
+            self.assertEqual(bucket.take(now), 0)
+        self.assertEqual(bucket.take(now), 0.5)
+        self.assertEqual(bucket.take(now + 0.5), 0)
+        self.assertEqual(bucket.is_full(now + 0.5), False)
+        self.assertEqual(bucket.is_full(now + 2), True)
+
+    def test_client_limit(self):
+        """Check each client is limited separately"""
+        limiter = landiallerd.RateLimiter(1, 2, 0)
+        name = 'landialler_rate_limited_total'
+        labels = (('scope', 'client'),)
+        limited = landiallerd.metrics.get_counter(name, labels)
+        self.assertEqual(limiter.check('client-id-1'), 0)
+        self.assertEqual(limiter.check('client-id-1'), 0)
+        self.assert_(limiter.check('client-id-1') > 0)
+        self.assertEqual(limiter.check('client-id-2'), 0)
+        self.assertEqual(landiallerd.metrics.get_counter(name, labels),
+                         limited + 1)
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(1)
+            self.assertEqual(limiter.check('client-id-1'), 0)
+        finally:
+            landiallerd.time = real_time
+
+    def test_server_limit(self):
+        """Check the server's limit applies to all clients together"""
+        limiter = landiallerd.RateLimiter(0, 0, 1, 2)
+        self.assertEqual(limiter.check('client-id-1'), 0)
+        self.assertEqual(limiter.check('client-id-2'), 0)
+        self.assert_(limiter.check('client-id-3') > 0)
+
+    def test_idle_clients_forgotten(self):
+        """Check the number of buckets is bounded"""
+        limiter = landiallerd.RateLimiter(1, 1, 0)
+        limiter.MAX_CLIENTS = 2
+        for client_id in ('client-id-1', 'client-id-2', 'client-id-3'):
+            limiter.check(client_id)
+        self.assertEqual(limiter.count_clients(), 2)
+        self.assertEqual(limiter.check('client-id-3'), 0)  # not limited
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(1)
+            limiter.check('client-id-3')
+            self.assertEqual(limiter.count_clients(), 1)
+        finally:
+            landiallerd.time = real_time
+
 
 class APITest(unittest.TestCase):
 
@@ -429,6 +2167,208 @@ class APITest(unittest.TestCase):
         self.assertEqual(api.get_status('client-id-1')[2],
                          MockTimer.elapsed_seconds)
 
+    def test_wait_for_status(self):
+        """Check wait_for_status() returns the status when it changes"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        status = api.wait_for_status('client-id-1', -1, 10)
+        self.assertEqual(status['current_clients'], 1)
+        self.assertEqual(status['is_connected'], True)
+        self.assertEqual(status['seconds_connected'],
+                         MockTimer.elapsed_seconds)
+        timer = threading.Timer(0.05, proxy.add_client, ('client-id-2',))
+        timer.start()
+        status = api.wait_for_status('client-id-1', status['version'], 10)
+        self.assertEqual(status['current_clients'], 2)
+        timer.join()
+
+    def test_connect_and_get_status(self):
+        """Check connect_and_get_status() connects and returns status"""
+        modem = mock.Mock({'is_connected': False})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        status = api.connect_and_get_status('client-id-1')
+        self.assertEqual(len(modem.getNamedCalls('connect')), 1)
+        self.assertEqual(status['current_clients'], 1)
+        self.assertEqual(status['is_connected'], False)
+        self.assertEqual(status['version'], proxy.version)
+        self.assertEqual(status['phase'], proxy.DIALLING)
+
+    def test_wait_for_status_refreshes_client(self):
+        """Check wait_for_status() refreshes the client"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        api.wait_for_status('client-id-1', -1, 0)
+        self.assertEqual(proxy.count_clients(), 1)
+
+    def test_wait_for_status_timeout(self):
+        """Check wait_for_status() returns when it times out"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        version = api.wait_for_status('client-id-1', -1, 0)['version']
+        status = api.wait_for_status('client-id-1', version, 0.01)
+        self.assertEqual(status['version'], version)
+
+    def test_wait_for_status_limited(self):
+        """Check wait_for_status() doesn't wait if too many clients are"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy, max_waiters=0)
+        version = api.wait_for_status('client-id-1', -1, 0)['version']
+        started = time.time()
+        api.wait_for_status('client-id-1', version, 10)
+        self.assert_(time.time() - started < 1)
+
+    def test_rate_limited(self):
+        """Check clients that ask too often are sent the last status"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        api.rate_limiter = landiallerd.RateLimiter(1, 1, 0)
+        status = api.wait_for_status('client-id-1', -1, 0)
+        self.failIf('retry_after' in status)
+        proxy.add_client('client-id-2')
+        started = time.time()
+        status = api.wait_for_status('client-id-1', status['version'], 10)
+        self.assert_(time.time() - started < 1)
+        self.assert_(status['retry_after'] > 0)
+        self.assertEqual(status['current_clients'], 1)
+        self.assertEqual(api.get_status('client-id-1'), [1, True, 14])
+        self.assertEqual(api.get_status('client-id-2'), (2, True, 14))
+
+    def test_get_usage(self):
+        """Check clients can ask how much the connection has been used"""
+        proxy = landiallerd.ModemProxy(mock.Mock())
+        api = landiallerd.API(proxy)
+        self.assertRaises(xmlrpclib.Fault, api.get_usage)
+        api.accounting = mock.Mock({'get_usage': {'client-id-1': [2, 90]}})
+        self.assertEqual(api.get_usage(), [{'client_id': 'client-id-1',
+                                            'sessions': 2, 'seconds': 90}])
+        call = api.accounting.getNamedCalls('get_usage')[0]
+        self.assertEqual(call.getParam(0), None)
+        self.assertEqual(call.getParam(1), None)
+        usage = api.get_client_usage('client-id-2', 100, 200)
+        self.assertEqual(usage, {'client_id': 'client-id-2', 'sessions': 0,
+                                 'seconds': 0})
+        call = api.accounting.getNamedCalls('get_usage')[1]
+        self.assertEqual(call.getParam(0), 100)
+        self.assertEqual(call.getParam(1), 200)
+
+    def test_get_history(self):
+        """Check clients can fetch the history of the connection"""
+        proxy = landiallerd.ModemProxy(mock.Mock({'is_connected': False}))
+        api = landiallerd.API(proxy)
+        self.assertRaises(xmlrpclib.Fault, api.get_history, 'minute')
+        sampler = mock.Mock({'get_samples': [(0.0, 0.0, 0.0, 0.0)]})
+        api.history = landiallerd.ConnectionHistory(proxy, sampler)
+        api.history.update()
+        history = api.get_history('minute')
+        self.assertEqual(history['resolution'], 60)
+        self.assertEqual(history['fields'][:3], ['start', 'link_up',
+                                                 'clients'])
+        self.assertEqual(len(history['periods']), 1)
+        self.assertRaises(xmlrpclib.Fault, api.get_history, 'week')
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        self.proxy = landiallerd.ModemProxy(modem)
+        self.api = landiallerd.API(self.proxy)
+        self.cache = landiallerd.ResponseCache(self.proxy)
+        self.api.connect('client-id-1')
+
+    def dispatch(self, method, *params):
+        return self.cache.dispatch(method, params, self._dispatch)
+
+    def _dispatch(self, method, params):
+        return getattr(self.api, method)(*params)
+
+    def test_response_reused(self):
+        """Check responses are only marshalled once per status"""
+        first = self.dispatch('get_status', 'client-id-1')
+        second = self.dispatch('get_status', 'client-id-1')
+        self.assert_(first is second)
+        self.assertEqual(xmlrpclib.loads(first)[0][0], [1, True, 14])
+
+    def test_method_always_called(self):
+        """Check clients are refreshed when the response is cached"""
+        self.dispatch('get_status', 'client-id-1')
+        self.dispatch('get_status', 'client-id-2')
+        self.assertEqual(self.proxy.count_clients(), 2)
+
+    def test_invalidated_on_change(self):
+        """Check cached responses are discarded when the status changes"""
+        first = self.dispatch('wait_for_status', 'client-id-1', -1, 0)
+        self.api.connect('client-id-2')
+        second = self.dispatch('wait_for_status', 'client-id-1', -1, 0)
+        status = xmlrpclib.loads(second)[0][0]
+        self.assertEqual(status['current_clients'], 2)
+        self.assertNotEqual(first, second)
+
+    def test_invalidated_each_second(self):
+        """Check cached responses are discarded as time passes"""
+        first = self.dispatch('get_status', 'client-id-1')
+        self.proxy._modem.timer.elapsed_seconds = 15
+        second = self.dispatch('get_status', 'client-id-1')
+        self.assertEqual(xmlrpclib.loads(second)[0][0], [1, True, 15])
+
+    def test_change_during_call(self):
+        """Check results aren't cached if the status changes meanwhile"""
+        self.dispatch('get_status', 'client-id-1')
+        first = self.dispatch('get_status', 'client-id-3')
+        second = self.dispatch('get_status', 'client-id-3')
+        self.assertEqual(xmlrpclib.loads(first)[0][0], [2, True, 14])
+        self.assert_(first is not second)
+
+    def test_rate_limited_not_cached(self):
+        """Check responses for clients asking too often aren't cached"""
+        self.api.rate_limiter = landiallerd.RateLimiter(1, 1, 0)
+        self.dispatch('wait_for_status', 'client-id-1', -1, 0)
+        limited = self.dispatch('wait_for_status', 'client-id-1', -1, 0)
+        self.assert_('retry_after' in xmlrpclib.loads(limited)[0][0])
+        response = self.dispatch('wait_for_status', 'client-id-2', -1, 0)
+        self.failIf('retry_after' in xmlrpclib.loads(response)[0][0])
+
+    def test_stale_status_not_cached(self):
+        """Check out of date statuses sent to limited clients aren't cached"""
+        self.api.rate_limiter = landiallerd.RateLimiter(1, 1, 0)
+        self.dispatch('wait_for_status', 'client-id-1', -1, 0)
+        self.api.connect('client-id-2')
+        stale = self.dispatch('get_status', 'client-id-1')
+        self.assertEqual(xmlrpclib.loads(stale)[0][0], [1, True, 14])
+        response = self.dispatch('get_status', 'client-id-2')
+        self.assertEqual(xmlrpclib.loads(response)[0][0], [2, True, 14])
+
+    def test_cached_dispatch(self):
+        """Check servers answer status requests from the cache"""
+        server = landiallerd.AsyncXMLRPCServer(('127.0.0.1', 0))
+        try:
+            server.register_instance(self.api)
+            server.register_function(lambda: 1, 'one')
+            server.response_cache = self.cache
+            request = xmlrpclib.dumps(('client-id-1',), 'get_status')
+            first = server._marshaled_dispatch(request)
+            self.assert_(server._marshaled_dispatch(request) is first)
+            response = server._marshaled_dispatch(xmlrpclib.dumps((), 'one'))
+            self.assertEqual(xmlrpclib.loads(response)[0][0], 1)
+            request = xmlrpclib.dumps((), 'get_status')
+            self.assertRaises(xmlrpclib.Fault, xmlrpclib.loads,
+                              server._marshaled_dispatch(request))
+        finally:
+            server.close()
+
 
 class AutoDisconnecThreadTest(unittest.TestCase):
 
@@ -486,6 +2426,18 @@ class AutoDisconnecThreadTest(unittest.TestCase):
         self.assert_(thread.isDaemon())
         thread.finished.set()
         
+    def test_sleeps_until_deadline(self):
+        """Check the thread wakes up when the next client expires"""
+        proxy = landiallerd.ModemProxy(mock.Mock())
+        proxy.CLIENT_TIMEOUT = 0.05
+        proxy._clients.timeout = 0.05
+        proxy.add_client('client-1')
+        thread = landiallerd.AutoDisconnectThread(proxy)
+        thread.start()
+        time.sleep(0.2)
+        thread.finished.set()
+        self.assertEqual(proxy.count_clients(), 0)
+
     def test_old_clients_removed(self):
         """Check the thread causes old clients to be removed"""
         modem = mock.Mock()
@@ -504,5 +2456,726 @@ class AutoDisconnecThreadTest(unittest.TestCase):
             landiallerd.time = real_time
         
 
+class IdleDetectorTest(unittest.TestCase):
+
+    BUSY = [(2000.0, 300.0, 3.0, 2.0)]
+    IDLE = [(100.0, 40.0, 1.0, 1.0)]
+
+    def setUp(self):
+        self.modem = mock.Mock({'is_connected': True})
+        self.proxy = landiallerd.ModemProxy(self.modem)
+        self.proxy.add_client('client-id-1')
+        self.sampler = mock.Mock({'get_samples': self.IDLE})
+        self.detector = landiallerd.IdleDetector(self.proxy, self.sampler,
+                                                 256, 60)
+
+    def sample_at(self, offset):
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(offset)
+            self.detector.update()
+        finally:
+            landiallerd.time = real_time
+
+    def test_idle_link_dropped(self):
+        """Check we hang up once the link has been idle for the window"""
+        self.sample_at(0)
+        self.sample_at(59)
+        self.assertEqual(len(self.modem.getNamedCalls('disconnect')), 0)
+        self.sample_at(60)
+        self.assertEqual(len(self.modem.getNamedCalls('disconnect')), 1)
+        self.modem.mockReturnValues['is_connected'] = False
+        self.assertEqual(self.proxy.get_phase(), self.proxy.IDLE)
+
+    def test_traffic_keeps_link_up(self):
+        """Check traffic restarts the idle window"""
+        self.sample_at(0)
+        self.sampler.mockReturnValues['get_samples'] = self.BUSY
+        self.sample_at(30)
+        self.sampler.mockReturnValues['get_samples'] = self.IDLE
+        self.sample_at(60)
+        self.assertEqual(len(self.modem.getNamedCalls('disconnect')), 0)
+        self.sample_at(90)
+        self.assertEqual(len(self.modem.getNamedCalls('disconnect')), 1)
+
+    def test_disabled(self):
+        """Check the link is kept up if there's no window"""
+        self.detector.window = None
+        self.sample_at(0)
+        self.sample_at(3600)
+        self.assertEqual(len(self.modem.getNamedCalls('disconnect')), 0)
+
+
+class HistoryTierTest(unittest.TestCase):
+
+    def test_averages(self):
+        """Check the samples in each period are averaged"""
+        tier = landiallerd.HistoryTier(60, 10, 2)
+        tier.add(600, (1, 10))
+        tier.add(659, (0, 20))
+        tier.add(660, (1, 30))
+        self.assertEqual(tier.get_periods(), [[600, 0.5, 15.0],
+                                              [660, 1.0, 30.0]])
+        self.assertEqual(len(tier), 1)
+
+    def test_memory_bounded(self):
+        """Check only the most recent periods are kept"""
+        tier = landiallerd.HistoryTier(60, 3, 1)
+        for minute in range(10):
+            tier.add(minute * 60, (minute,))
+        self.assertEqual(len(tier), 3)
+        self.assertEqual([p[0] for p in tier.get_periods()],
+                         [360, 420, 480, 540])
+
+    def test_since(self):
+        """Check periods that ended before since are left out"""
+        tier = landiallerd.HistoryTier(60, 100, 1)
+        for minute in range(50):
+            tier.add(minute * 60, (minute,))
+        periods = tier.get_periods(45 * 60 + 1)
+        self.assertEqual([p[0] for p in periods], [2700, 2760, 2820, 2880,
+                                                   2940])
+        self.assertEqual(tier.get_periods(50 * 60), [])
+
+    def test_clock_going_back(self):
+        """Check samples taken after the clock goes back aren't lost"""
+        tier = landiallerd.HistoryTier(60, 10, 1)
+        tier.add(600, (1,))
+        tier.add(500, (3,))
+        self.assertEqual(tier.get_periods(), [[600, 2.0]])
+
+
+class ConnectionHistoryTest(unittest.TestCase):
+
+    def test_update(self):
+        """Check each sample is recorded at every resolution"""
+        proxy = landiallerd.ModemProxy(mock.Mock({'is_connected': True}))
+        proxy.add_client('client-id-1')
+        sampler = mock.Mock({'get_samples': [(2000.0, 300.0, 3.0, 2.0)]})
+        history = landiallerd.ConnectionHistory(proxy, sampler)
+        history.update()
+        for resolution in ('minute', 'hour', 'day'):
+            periods = history.get_history(resolution)
+            self.assertEqual(len(periods), 1)
+            self.assertEqual(periods[0][1:], [1.0, 1.0, 2000.0, 300.0])
+        self.assertEqual(history.get_resolution('hour'), 3600)
+        self.assertRaises(KeyError, history.get_history, 'week')
+
+
+class PooledXMLRPCServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = landiallerd.PooledXMLRPCServer(('127.0.0.1', 0),
+                                                     workers=2, backlog=4,
+                                                     keepalive_timeout=0.2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        host, port = self.server.socket.getsockname()
+        self.url = 'http://%s:%d/' % (host, port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_call(self):
+        """Check the pooled server handles requests"""
+        self.server.register_function(lambda x: x * 2, 'double')
+        self.assertEqual(xmlrpclib.ServerProxy(self.url).double(21), 42)
+
+    def test_slow_request_doesnt_block(self):
+        """Check a slow request doesn't hold up other clients"""
+        release = threading.Event()
+
+        def slow():
+            release.wait(5)
+            return True
+
+        self.server.register_function(slow, 'slow')
+        self.server.register_function(lambda: True, 'fast')
+        thread = threading.Thread(
+            target=lambda: xmlrpclib.ServerProxy(self.url).slow())
+        thread.start()
+        answered = threading.Event()
+
+        def fast():
+            xmlrpclib.ServerProxy(self.url).fast()
+            answered.set()
+
+        fast_thread = threading.Thread(target=fast)
+        fast_thread.start()
+        try:
+            answered.wait(5)
+            self.assert_(answered.isSet())
+            self.failIf(release.isSet())
+        finally:
+            release.set()
+            thread.join()
+            fast_thread.join()
+
+    def test_park_after_close(self):
+        """Check connections finished after the server closes are closed"""
+        server = landiallerd.PooledXMLRPCServer(('127.0.0.1', 0), workers=1)
+        server.server_close()
+        request, client = socket.socketpair()
+        try:
+            server._park(request, ('127.0.0.1', 0))
+            self.assertEqual(client.recv(1), '')
+        finally:
+            client.close()
+
+    def count_workers(self):
+        return len([w for w in self.server._workers if w.isAlive()])
+
+    def test_set_workers(self):
+        """Check workers can be added to and removed from the pool"""
+        self.server.set_workers(4)
+        self.assertEqual(self.count_workers(), 4)
+        self.server.set_workers(1)
+        deadline = time.time() + 2
+        while self.count_workers() > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.count_workers(), 1)
+        self.server.register_function(lambda x: x * 2, 'double')
+        self.assertEqual(xmlrpclib.ServerProxy(self.url).double(21), 42)
+
+    def test_resize_while_full(self):
+        """Check the pool can be resized while its queue is full"""
+        server = landiallerd.PooledXMLRPCServer(('127.0.0.1', 0),
+                                                workers=1, backlog=1)
+        clients = []
+        connections = []
+        for i in range(3):
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.connect(server.socket.getsockname())
+            clients.append(client)
+            connections.append(server.socket.accept())
+        queued = threading.Event()
+        resized = threading.Event()
+
+        def queue():
+            server.process_request(*connections[2])
+            queued.set()
+
+        def resize():
+            server.set_workers(0)
+            resized.set()
+
+        threads = [threading.Thread(target=queue),
+                   threading.Thread(target=resize)]
+        try:
+            server.process_request(*connections[0])
+            deadline = time.time() + 2
+            while server._requests and time.time() < deadline:
+                time.sleep(0.01)  # until the worker is waiting for it
+            server.process_request(*connections[1])
+            threads[0].start()
+            queued.wait(0.2)
+            self.failIf(queued.isSet())
+            server.set_backlog(2)
+            queued.wait(5)
+            self.assert_(queued.isSet())
+            threads[1].start()
+            resized.wait(5)
+            self.assert_(resized.isSet())
+        finally:
+            for client in clients:
+                client.close()
+            for thread in threads:
+                if thread.isAlive():
+                    thread.join(5)
+            server.finish_requests(2)
+            server.server_close()
+        self.assertEqual(len([w for w in server._workers if w.isAlive()]), 0)
+
+    def test_multicall(self):
+        """Check several calls can be made in one request"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        self.server.register_instance(landiallerd.API(proxy))
+        self.server.register_multicall_functions()
+        multicall = xmlrpclib.MultiCall(xmlrpclib.ServerProxy(self.url))
+        multicall.connect('client-id-1')
+        multicall.get_status('client-id-1')
+        self.assertEqual(tuple(multicall()), (True, [1, True, 14]))
+
+    def test_metrics(self):
+        """Check the metrics can be fetched over HTTP"""
+        self.server.register_function(lambda x: x * 2, 'double')
+        labels = (('method', 'double'),)
+        calls = landiallerd.metrics.get_counter(
+            'landialler_requests_total', labels)
+        xmlrpclib.ServerProxy(self.url).double(21)
+        self.assertEqual(landiallerd.metrics.get_counter(
+            'landialler_requests_total', labels), calls + 1)
+        response = urllib2.urlopen(self.url + 'metrics')
+        self.assertEqual(response.info()['Content-Type'],
+                         landiallerd.METRICS_CONTENT_TYPE)
+        text = response.read()
+        self.assert_('landialler_requests_total{method="double"}' in text)
+        try:
+            urllib2.urlopen(self.url + 'other')
+            self.fail('GET request for %sother accepted' % self.url)
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+
+    def test_unknown_methods_not_labelled(self):
+        """Check calls to unknown methods share a label"""
+        labels = (('method', 'unknown'),)
+        calls = landiallerd.metrics.get_counter(
+            'landialler_requests_total', labels)
+        server = xmlrpclib.ServerProxy(self.url)
+        self.assertRaises(xmlrpclib.Fault, server.no_such_method)
+        self.assertEqual(landiallerd.metrics.get_counter(
+            'landialler_requests_total', labels), calls + 1)
+
+    def test_methods_registered_later_labelled(self):
+        """Check methods registered after the first call get a label"""
+        server = xmlrpclib.ServerProxy(self.url)
+        self.assertRaises(xmlrpclib.Fault, server.triple, 1)
+        self.server.register_function(lambda x: x * 3, 'triple')
+        labels = (('method', 'triple'),)
+        calls = landiallerd.metrics.get_counter(
+            'landialler_requests_total', labels)
+        self.assertEqual(server.triple(1), 3)
+        self.assertEqual(landiallerd.metrics.get_counter(
+            'landialler_requests_total', labels), calls + 1)
+
+    def call(self, connection, method, *args):
+        connection.request('POST', '/RPC2', xmlrpclib.dumps(args, method))
+        response = connection.getresponse()
+        return xmlrpclib.loads(response.read())[0][0]
+
+    def test_keep_alive(self):
+        """Check idle connections don't tie up the workers"""
+        self.server.register_function(lambda x: x * 2, 'double')
+        host, port = self.server.socket.getsockname()
+        connections = []
+        for i in range(4):
+            connection = httplib.HTTPConnection(host, port)
+            self.assertEqual(self.call(connection, 'double', i), i * 2)
+            connections.append(connection)
+        for i in range(4):
+            self.assertEqual(self.call(connections[i], 'double', i), i * 2)
+        for connection in connections:
+            connection.close()
+
+    def test_idle_timeout(self):
+        """Check idle connections are closed"""
+        self.server.register_function(lambda x: x * 2, 'double')
+        host, port = self.server.socket.getsockname()
+        connection = httplib.HTTPConnection(host, port)
+        self.call(connection, 'double', 1)
+        time.sleep(0.3)
+        for i in range(10):
+            time.sleep(0.1)
+            if not self.server._idle:
+                break
+        self.assertEqual(len(self.server._idle), 0)
+        connection.close()
+
+    def test_high_descriptors(self):
+        """Check connections can be parked beyond select()'s limit"""
+        self.server.register_function(lambda x: x * 2, 'double')
+        host, port = self.server.socket.getsockname()
+        connection = httplib.HTTPConnection(host, port)
+        filler = []
+        try:
+            try:
+                while not filler or filler[-1] < 1024:
+                    filler.append(os.open(os.devnull, os.O_RDONLY))
+            except OSError:
+                return  # not allowed that many open files
+            connection.connect()
+            connection.sock.settimeout(5)
+            self.assertEqual(self.call(connection, 'double', 1), 2)
+        finally:
+            for fd in filler:
+                os.close(fd)
+        try:
+            self.assertEqual(self.call(connection, 'double', 2), 4)
+        finally:
+            connection.close()
+
+    def add_status_waiters(self):
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy, max_waiters=0)
+        self.server.register_instance(api)
+        self.server.status_waiters = landiallerd.StatusWaiters(api, proxy)
+        return proxy
+
+    def test_wait_for_status(self):
+        """Check clients waiting for status don't tie up the workers"""
+        self.add_status_waiters()
+        server = xmlrpclib.ServerProxy(self.url)
+        version = server.wait_for_status('client-id-1', -1, 0)['version']
+        results = []
+
+        def wait():
+            server = xmlrpclib.ServerProxy(self.url)
+            results.append(server.wait_for_status('client-id-1', version, 10))
+
+        threads = [threading.Thread(target=wait) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while (self.server.status_waiters.count() < len(threads) and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(self.server.status_waiters.count(), len(threads))
+        self.assertEqual(server.connect('client-id-2'), True)
+        for thread in threads:
+            thread.join()
+        self.assertEqual([s['current_clients'] for s in results], [2, 2, 2])
+
+    def test_wait_for_status_expires(self):
+        """Check clients waiting for status get a reply on timeout"""
+        self.add_status_waiters()
+        self.server.POLL_PERIOD = 0.01
+        host, port = self.server.socket.getsockname()
+        connection = httplib.HTTPConnection(host, port)
+        status = self.call(connection, 'wait_for_status', 'client-id-1',
+                           -1, 0)
+        version = status['version']
+        for i in range(2):
+            status = self.call(connection, 'wait_for_status', 'client-id-1',
+                               version, 0.05)
+            self.assertEqual(status['version'], version)
+        self.assertEqual(self.server.status_waiters.count(), 0)
+        connection.close()
+
+    def test_close_while_waiting(self):
+        """Check connections waiting for status are closed with the server"""
+        self.add_status_waiters()
+        host, port = self.server.socket.getsockname()
+        connection = httplib.HTTPConnection(host, port)
+        version = self.call(connection, 'wait_for_status', 'client-id-1',
+                            -1, 0)['version']
+        connection.request('POST', '/RPC2', xmlrpclib.dumps(
+            ('client-id-1', version, 10), 'wait_for_status'))
+        deadline = time.time() + 5
+        while (self.server.status_waiters.count() == 0 and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            self.assertEqual(self.server.status_waiters.count(), 0)
+            self.assertRaises(httplib.HTTPException, connection.getresponse)
+            connection.close()
+        finally:
+            self.server = landiallerd.PooledXMLRPCServer(('127.0.0.1', 0))
+
+
+class InheritedSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        host, port = self.socket.getsockname()
+        self.url = 'http://%s:%d/' % (host, port)
+
+    def tearDown(self):
+        self.socket.close()
+
+    def test_no_socket(self):
+        """Check we only use sockets that were passed to our process"""
+        self.assertEqual(landiallerd.get_inherited_socket({}), None)
+        environ = {'LISTEN_PID': str(os.getpid() + 1), 'LISTEN_FDS': '1'}
+        self.assertEqual(landiallerd.get_inherited_socket(environ), None)
+        self.assertEqual(environ, {})
+
+    def test_socket_from_fd(self):
+        """Check inherited sockets keep their address family"""
+        sock = landiallerd.socket_from_fd(self.socket.fileno())
+        try:
+            self.assertEqual(sock.family, socket.AF_INET)
+            self.assertEqual(sock.getsockname(), self.socket.getsockname())
+        finally:
+            sock.close()
+        if landiallerd.SO_DOMAIN is None or not socket.has_ipv6:
+            return
+        listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        try:
+            try:
+                listener.bind(('::1', 0))
+            except socket.error:
+                return  # no IPv6 here
+            sock = landiallerd.socket_from_fd(listener.fileno())
+            self.assertEqual(sock.family, socket.AF_INET6)
+            self.assertEqual(sock.getsockname(), listener.getsockname())
+            sock.close()
+        finally:
+            listener.close()
+
+    def test_unsupported_socket(self):
+        """Check sockets we can't serve from are rejected"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        unix, other = socket.socketpair()
+        read_fd, write_fd = os.pipe()
+        try:
+            for fd in (sock.fileno(), unix.fileno(), read_fd):
+                self.assertRaises(ValueError, landiallerd.socket_from_fd, fd)
+        finally:
+            for s in (sock, unix, other):
+                s.close()
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def call_twice(self):
+        host, port = self.socket.getsockname()
+        connection = httplib.HTTPConnection(host, port)
+        for i in range(2):
+            time.sleep(0.05)  # the server mustn't read before we write
+            connection.request('POST', '/', xmlrpclib.dumps((i,), 'double'))
+            response = connection.getresponse()
+            self.assertEqual(xmlrpclib.loads(response.read())[0][0], i * 2)
+        connection.close()
+
+    def test_pooled_server(self):
+        """Check the pooled server can serve from a listening socket"""
+        server = landiallerd.PooledXMLRPCServer(
+            None, workers=1, listening_socket=self.socket)
+        server.register_function(lambda x: x * 2, 'double')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            self.call_twice()
+        finally:
+            server.shutdown()
+            server.finish_requests(1)
+            thread.join()
+
+    def test_async_server(self):
+        """Check the event loop server can serve from a listening socket"""
+        server = landiallerd.AsyncXMLRPCServer(
+            None, listening_socket=self.socket)
+        server.register_function(lambda x: x * 2, 'double')
+        loop = landiallerd.EventLoop()
+        loop.MAX_TIMEOUT = 0.01
+        thread = threading.Thread(target=loop.run)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            self.call_twice()
+        finally:
+            loop.stop()
+            thread.join()
+            server.finish_requests(1)
+
+
+class EventLoopTest(unittest.TestCase):
+
+    def test_call_later(self):
+        """Check tasks are run in order once they're due"""
+        calls = []
+        loop = landiallerd.EventLoop()
+        loop.call_later(0.02, lambda: calls.append(2))
+        loop.call_later(0.01, lambda: calls.append(1))
+        loop.call_later(0.03, loop.stop)
+        loop.run()
+        self.assertEqual(calls, [1, 2])
+
+    def test_call_every(self):
+        """Check periodic tasks are repeated"""
+        calls = []
+        loop = landiallerd.EventLoop()
+
+        def task():
+            calls.append(1)
+            if len(calls) == 3:
+                loop.stop()
+
+        loop.call_every(0.01, task)
+        loop.call_later(5, loop.stop)
+        loop.run()
+        self.assertEqual(len(calls), 3)
+
+    def test_high_descriptors(self):
+        """Check the loop can watch descriptors beyond select()'s limit"""
+        read_fd, write_fd = os.pipe()
+        high_fd = 2000
+        try:
+            os.dup2(read_fd, high_fd)
+        except OSError:
+            return  # not allowed that many open files
+        loop = landiallerd.EventLoop()
+        calls = []
+
+        class Reader:
+            def readable(self):
+                return True
+
+            def writable(self):
+                return False
+
+            def handle_read_event(self):
+                calls.append(os.read(high_fd, 1))
+                loop.stop()
+
+        asyncore.socket_map[high_fd] = Reader()
+        try:
+            os.write(write_fd, 'x')
+            loop.call_later(1, loop.stop)
+            loop.run()
+        finally:
+            del asyncore.socket_map[high_fd]
+            for fd in (high_fd, read_fd, write_fd):
+                os.close(fd)
+        self.assertEqual(calls, ['x'])
+
+    def test_call_every_changing_period(self):
+        """Check a task's period can be changed while it's scheduled"""
+        calls = []
+        period = [0.01]
+
+        def task():
+            calls.append(1)
+            if len(calls) == 2:
+                period[0] = 10
+                loop.call_later(0.05, loop.stop)
+
+        loop = landiallerd.EventLoop()
+        loop.call_every(lambda: period[0], task)
+        loop.call_later(5, loop.stop)
+        loop.run()
+        self.assertEqual(len(calls), 2)
+
+    def test_failing_task(self):
+        """Check a failing task doesn't stop the loop"""
+        loop = landiallerd.EventLoop()
+        loop.call_later(0, lambda: 1 / 0)
+        loop.call_later(0.01, loop.stop)
+        loop.run()
+
+    def test_interrupted_task(self):
+        """Check KeyboardInterrupt in a task isn't swallowed"""
+
+        def interrupt():
+            raise KeyboardInterrupt
+
+        loop = landiallerd.EventLoop()
+        loop.call_later(0, interrupt)
+        loop.call_later(0.01, loop.stop)
+        self.assertRaises(KeyboardInterrupt, loop.run)
+
+
+class AsyncXMLRPCServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = landiallerd.AsyncXMLRPCServer(('127.0.0.1', 0))
+        self.loop = landiallerd.EventLoop()
+        self.loop.MAX_TIMEOUT = 0.01
+        self.thread = threading.Thread(target=self.loop.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        host, port = self.server.socket.getsockname()
+        self.url = 'http://%s:%d/' % (host, port)
+
+    def tearDown(self):
+        self.loop.stop()
+        self.thread.join()
+        self.server.close()
+
+    def test_api(self):
+        """Check the API is served from the event loop"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        self.server.register_instance(landiallerd.API(proxy))
+        server = xmlrpclib.ServerProxy(self.url)
+        self.assertEqual(server.connect('client-id-1'), True)
+        self.assertEqual(server.get_status('client-id-1'), [1, True, 14])
+        self.assertEqual(server.disconnect('client-id-1'), True)
+        self.assertEqual(proxy.count_clients(), 0)
+
+    def test_keep_alive(self):
+        """Check several requests can share a connection"""
+        self.server.register_function(lambda x: x * 2, 'double')
+        host, port = self.server.socket.getsockname()
+        connection = httplib.HTTPConnection(host, port)
+        for i in range(3):
+            body = xmlrpclib.dumps((i,), 'double')
+            connection.request('POST', '/', body)
+            response = connection.getresponse()
+            self.assertEqual(xmlrpclib.loads(response.read())[0][0], i * 2)
+        connection.close()
+
+    def test_wait_for_status(self):
+        """Check the loop isn't blocked by clients waiting for status"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        self.server.register_instance(api)
+        self.server.status_waiters = landiallerd.StatusWaiters(api, proxy)
+        server = xmlrpclib.ServerProxy(self.url)
+        version = server.wait_for_status('client-id-1', -1, 10)['version']
+        results = []
+
+        def wait():
+            server = xmlrpclib.ServerProxy(self.url)
+            results.append(server.wait_for_status('client-id-1', version, 10))
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(self.server.status_waiters.count(), 1)
+        self.assertEqual(server.connect('client-id-2'), True)
+        thread.join()
+        self.assertEqual(results[0]['current_clients'], 2)
+
+    def test_wait_for_status_expires(self):
+        """Check clients waiting for status get a reply on timeout"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        self.server.register_instance(api)
+        waiters = landiallerd.StatusWaiters(api, proxy)
+        self.server.status_waiters = waiters
+        self.loop.call_every(0.01, waiters.expire)
+        server = xmlrpclib.ServerProxy(self.url)
+        version = server.wait_for_status('client-id-1', -1, 0)['version']
+        status = server.wait_for_status('client-id-1', version, 0.05)
+        self.assertEqual(status['version'], version)
+
+    def test_idle_timeout(self):
+        """Check idle connections are closed"""
+        self.server.register_function(lambda x: x * 2, 'double')
+        host, port = self.server.socket.getsockname()
+        connection = httplib.HTTPConnection(host, port)
+        connection.request('POST', '/', xmlrpclib.dumps((1,), 'double'))
+        connection.getresponse().read()
+        self.assertEqual(self.server.count_channels(), 1)
+        self.server.keepalive_timeout = 0
+        time.sleep(0.01)
+        self.server.close_idle_channels()
+        self.assertEqual(self.server.count_channels(), 0)
+        connection.close()
+
+    def test_metrics(self):
+        """Check the metrics are served from the event loop"""
+        self.server.register_function(lambda x: x * 2, 'double')
+        xmlrpclib.ServerProxy(self.url).double(21)
+        response = urllib2.urlopen(self.url + 'metrics')
+        self.assert_('landialler_requests_total{method="double"}'
+                     in response.read())
+
+    def test_bad_request(self):
+        """Check non XML-RPC requests are rejected"""
+        try:
+            urllib2.urlopen(self.url)
+            self.fail('GET request accepted')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 501)
+        
+
 if __name__ == '__main__':
     unittest.main()